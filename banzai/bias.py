@@ -3,7 +3,8 @@ import logging
 
 import numpy as np
 
-from banzai.stages import Stage
+from banzai import settings
+from banzai.stages import Stage, BandStage
 from banzai.calibrations import CalibrationStacker, ApplyCalibration, CalibrationComparer
 from banzai.utils import stats, fits_utils
 
@@ -34,18 +35,23 @@ class BiasSubtractor(ApplyCalibration):
     def calibration_type(self):
         return 'bias'
 
-    def apply_master_calibration(self, image, master_calibration_image):
+    def apply_master_calibration_to_band(self, image, master_calibration_image, rows):
+        master_bias_level = float(master_calibration_image.header['BIASLVL'])
+
+        image.data[..., rows, :] -= master_bias_level
+        image.data[..., rows, :] -= master_calibration_image.data[..., rows, :]
+
+        image.bpm[..., rows, :] |= master_calibration_image.bpm[..., rows, :]
 
-        master_bias_data = master_calibration_image.data
+    def record_master_calibration(self, image, master_calibration_image):
+        """
+        Add the header keywords and log messages for a bias that has been subtracted from an image
+        """
         master_bias_level = float(master_calibration_image.header['BIASLVL'])
 
         master_logging_tags = {'bias': master_bias_level,
                                'master_bias': os.path.basename(master_calibration_image.filename)}
 
-        image.subtract(master_bias_level)
-        image.subtract(master_bias_data)
-
-        image.bpm |= master_calibration_image.bpm
         image.header['BIASLVL'] = (master_bias_level, 'Mean bias level of master bias')
 
         master_bias_filename = os.path.basename(master_calibration_image.filename)
@@ -60,23 +66,30 @@ class BiasSubtractor(ApplyCalibration):
         return image
 
 
-class OverscanSubtractor(Stage):
+class OverscanSubtractor(BandStage):
     def __init__(self, runtime_context):
         super(OverscanSubtractor, self).__init__(runtime_context)
 
-    def do_stage(self, image):
+    def start_bands(self, image):
         # Subtract the overscan if it exists
         if image.data_is_3d():
             logging_tags = {}
+            overscan_levels = []
             for i in range(image.get_n_amps()):
-                overscan_level = _subtract_overscan_3d(image, i)
-                logging_tags['OVERSCN{0}'.format(i + 1)] = float(overscan_level)
+                overscan_levels.append(_get_overscan_level_3d(image, i))
+                logging_tags['OVERSCN{0}'.format(i + 1)] = float(overscan_levels[i])
         else:
-            overscan_level = _subtract_overscan_2d(image)
-            logging_tags = {'OVERSCAN': float(overscan_level)}
+            overscan_levels = _get_overscan_level_2d(image)
+            logging_tags = {'OVERSCAN': float(overscan_levels)}
         logger.info('Subtracting overscan', image=image, extra_tags=logging_tags)
+        return {'overscan_levels': overscan_levels}
 
-        return image
+    def do_band(self, image, band_state, rows):
+        if image.data_is_3d():
+            for i, overscan_level in enumerate(band_state['overscan_levels']):
+                image.data[i, rows] -= overscan_level
+        else:
+            image.data[rows] -= band_state['overscan_levels']
 
 
 class BiasMasterLevelSubtractor(Stage):
@@ -84,8 +97,14 @@ class BiasMasterLevelSubtractor(Stage):
         super(BiasMasterLevelSubtractor, self).__init__(runtime_context)
 
     def do_stage(self, image):
-        bias_level = stats.sigma_clipped_mean(image.data, 3.5, mask=image.bpm)
-        logger.debug('Subtracting bias level', image=image, extra_tags={'BIASLVL': float(bias_level)})
+        logging_tags = {}
+        if settings.BIAS_LEVEL_STANDARD_ERROR > 0:
+            bias_level, logging_tags['BIASLVL_ERROR'] = stats.subsampled_sigma_clipped_mean(
+                image.data, 3.5, settings.BIAS_LEVEL_STANDARD_ERROR, mask=image.bpm)
+        else:
+            bias_level = stats.sigma_clipped_mean(image.data, 3.5, mask=image.bpm)
+        logging_tags['BIASLVL'] = float(bias_level)
+        logger.debug('Subtracting bias level', image=image, extra_tags=logging_tags)
         image.data -= bias_level
         image.header['BIASLVL'] = bias_level, 'Bias Level that was removed'
         return image
@@ -107,7 +126,7 @@ class BiasComparer(CalibrationComparer):
         return image.readnoise
 
 
-def _subtract_overscan_3d(image, i):
+def _get_overscan_level_3d(image, i):
     overscan_region = fits_utils.parse_region_keyword(image.extension_headers[i].get('BIASSEC'))
     if overscan_region is not None:
         overscan_level = stats.sigma_clipped_mean(image.data[i][overscan_region], 3)
@@ -118,12 +137,10 @@ def _subtract_overscan_3d(image, i):
 
     overscan_comment = 'Overscan value that was subtracted from Q{0}'.format(i + 1)
     image.header['OVERSCN{0}'.format(i + 1)] = (overscan_level, overscan_comment)
-
-    image.data[i] -= overscan_level
     return overscan_level
 
 
-def _subtract_overscan_2d(image):
+def _get_overscan_level_2d(image):
     overscan_region = fits_utils.parse_region_keyword(image.header.get('BIASSEC'))
     if overscan_region is not None:
         overscan_level = stats.sigma_clipped_mean(image.data[overscan_region], 3)
@@ -133,5 +150,4 @@ def _subtract_overscan_2d(image):
         image.header['L1STATOV'] = (0, 'Status flag for overscan correction')
 
     image.header['OVERSCAN'] = (overscan_level, 'Overscan value that was subtracted')
-    image.data -= overscan_level
     return overscan_level
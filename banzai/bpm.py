@@ -48,20 +48,16 @@ def add_empty_bpm(image):
 
 
 def load_bpm(bpm_filename):
-    bpm_hdu = fits_utils.open_fits_file(bpm_filename)
-    bpm_extensions = fits_utils.get_extensions_by_name(bpm_hdu, 'BPM')
-    # Filter out BPM extensions without data
-    bpm_extensions = [extension for extension in bpm_extensions if extension.data is not None]
-    if len(bpm_extensions) > 1:
-        extension_shape = bpm_extensions[0].data.shape
-        bpm_shape = (len(bpm_extensions), extension_shape[0], extension_shape[1])
-        bpm = np.zeros(bpm_shape, dtype=np.uint8)
-        for i, extension in enumerate(bpm_extensions):
-            bpm[i, :, :] = extension.data[:, :]
-    elif len(bpm_extensions) == 1:
-        bpm = np.array(bpm_extensions[0].data, dtype=np.uint8)
-    else:
-        bpm = np.array(bpm_hdu[0].data, dtype=np.uint8)
+    with fits_utils.open_fits_file(bpm_filename, memmap=True) as bpm_hdu:
+        bpm_extensions = fits_utils.get_extensions_by_name(bpm_hdu, 'BPM')
+        # Filter out BPM extensions without data
+        bpm_extensions = [extension for extension in bpm_extensions if extension.data is not None]
+        if len(bpm_extensions) > 1:
+            bpm = fits_utils.stack_extensions(bpm_extensions, np.uint8)
+        elif len(bpm_extensions) == 1:
+            bpm = bpm_extensions[0].data.astype(np.uint8, copy=False)
+        else:
+            bpm = bpm_hdu[0].data.astype(np.uint8, copy=False)
     return bpm
 
 
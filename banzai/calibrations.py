@@ -1,13 +1,18 @@
 import logging
 import abc
 import os
+import hashlib
+import mmap
+import time
 
 import numpy as np
 from astropy.io import fits
 
-from banzai.stages import Stage, MultiFrameStage
+from banzai.stages import BandStage, MultiFrameStage
 from banzai import dbs, logs, settings
-from banzai.utils import image_utils, stats, fits_utils, qc, date_utils, import_utils, file_utils
+from banzai.utils import image_utils, stats, fits_utils, qc, date_utils, import_utils, file_utils, cache_utils
+from banzai.utils.shared_memory_utils import SharedArrayStore
+from banzai.utils import accumulator_utils
 import datetime
 
 FRAME_CLASS = import_utils.import_attribute(settings.FRAME_CLASS)
@@ -15,6 +20,29 @@ FRAME_CLASS = import_utils.import_attribute(settings.FRAME_CLASS)
 logger = logging.getLogger('banzai')
 
 
+def _image_nbytes(image):
+    # Memory mapped arrays are paged in and out by the operating system, so only arrays held in memory count
+    return sum(array.nbytes for array in [image.data, image.bpm]
+               if array is not None and not _is_memory_mapped(array))
+
+
+def _is_memory_mapped(array):
+    while array is not None:
+        if isinstance(array, (np.memmap, mmap.mmap)):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+MASTER_CALIBRATION_CACHE = cache_utils.LRUCache(settings.CALIBRATION_CACHE_MAX_BYTES, size_function=_image_nbytes)
+
+if settings.CALIBRATION_SHARED_MEMORY_DIRECTORY:
+    SHARED_CALIBRATION_STORE = SharedArrayStore(settings.CALIBRATION_SHARED_MEMORY_DIRECTORY,
+                                                settings.CALIBRATION_SHARED_MEMORY_MAX_BYTES)
+else:
+    SHARED_CALIBRATION_STORE = None
+
+
 class CalibrationMaker(MultiFrameStage):
     def __init__(self, runtime_context):
         super(CalibrationMaker, self).__init__(runtime_context)
@@ -62,25 +90,16 @@ class CalibrationStacker(CalibrationMaker):
         # is used to create the filename and select the day directory
         images.sort(key=lambda image: image.dateobs, reverse=True)
 
-        data_stack = np.zeros((images[0].ny, images[0].nx, len(images)), dtype=np.float32)
-        stack_mask = np.zeros((images[0].ny, images[0].nx, len(images)), dtype=np.uint8)
-
         make_calibration_name = file_utils.make_calibration_filename_function(self.calibration_type,
                                                                               self.runtime_context)
 
         master_calibration_filename = make_calibration_name(images[0])
 
-        for i, image in enumerate(images):
+        for image in images:
             logger.debug('Stacking Frames', image=image,
                          extra_tags={'master_calibration': os.path.basename(master_calibration_filename)})
-            data_stack[:, :, i] = image.data[:, :]
-            stack_mask[:, :, i] = image.bpm[:, :]
 
-        stacked_data = stats.sigma_clipped_mean(data_stack, 3.0, axis=2, mask=stack_mask, inplace=True)
-
-        # Memory cleanup
-        del data_stack
-        del stack_mask
+        stacked_data = stack_images(images, settings.CALIBRATION_STACK_MEMORY_BUDGET)
 
         master_bpm = np.array(stacked_data == 0.0, dtype=np.uint8)
 
@@ -95,7 +114,7 @@ class CalibrationStacker(CalibrationMaker):
         return master_image
 
 
-class ApplyCalibration(Stage):
+class ApplyCalibration(BandStage):
     def __init__(self, runtime_context):
         super(ApplyCalibration, self).__init__(runtime_context)
 
@@ -113,14 +132,58 @@ class ApplyCalibration(Stage):
         logger.error(msg.format(stage=self.stage_name), image=image)
         image.is_bad = True
 
-    def do_stage(self, image):
+    def start_bands(self, image):
+        """
+        Find and read the master calibration
+        """
         master_calibration_filename = self.get_calibration_filename(image)
 
         if master_calibration_filename is None:
             self.on_missing_master_calibration(image)
+            return {'master_calibration_image': None}
+
+        master_calibration_image = self.load_master_calibration_image(image, master_calibration_filename)
+        if master_calibration_image is None:
+            return None
+        return {'master_calibration_image': master_calibration_image}
+
+    def do_band(self, image, band_state, rows):
+        if band_state['master_calibration_image'] is not None:
+            self.apply_master_calibration_to_band(image, band_state['master_calibration_image'], rows)
+
+    def finish_bands(self, image, band_state):
+        if band_state['master_calibration_image'] is None:
             return image
+        return self.record_master_calibration(image, band_state['master_calibration_image'])
+
+    @abc.abstractmethod
+    def apply_master_calibration_to_band(self, image, master_calibration_image, rows):
+        """
+        Apply the master calibration in place to image.data[..., rows, :]
+        """
+        pass
 
-        master_calibration_image = FRAME_CLASS(self.runtime_context, filename=master_calibration_filename)
+    def record_master_calibration(self, image, master_calibration_image):
+        """
+        Called once the master calibration has been applied to every band of the image
+
+        Returns
+        -------
+        image: banzai.images.Image
+               The processed image, or None to reject it
+        """
+        return image
+
+    def load_master_calibration_image(self, image, master_calibration_filename):
+        """
+        Read a master calibration frame and check that it matches the image
+
+        Returns
+        -------
+        master_calibration_image: banzai.images.Image or None
+                                  None if the master calibration is not the same format as the image
+        """
+        master_calibration_image = read_master_calibration_image(master_calibration_filename, self.runtime_context)
         try:
             image_utils.check_image_homogeneity([image, master_calibration_image], self.master_selection_criteria)
         except image_utils.InhomogeneousSetException as e:
@@ -129,11 +192,7 @@ class ApplyCalibration(Stage):
             return None
         logger.info('Applying master calibration', image=image,
                     extra_tags={'master_calibration': os.path.basename(master_calibration_filename)})
-        return self.apply_master_calibration(image, master_calibration_image)
-
-    @abc.abstractmethod
-    def apply_master_calibration(self, image, master_calibration_image):
-        pass
+        return master_calibration_image
 
     def get_calibration_filename(self, image):
         return dbs.get_master_calibration_image(image, self.calibration_type, self.master_selection_criteria,
@@ -142,6 +201,9 @@ class ApplyCalibration(Stage):
 
 
 class CalibrationComparer(ApplyCalibration):
+    # The comparison needs the whole frame, so there is nothing to gain from streaming it in bands
+    band_streamable = False
+
     # In a 16 megapixel image, this should flag 0 or 1 pixels statistically, much much less than 5% of the image
     SIGNAL_TO_NOISE_THRESHOLD = 6.0
     ACCEPTABLE_PIXEL_FRACTION = 0.05
@@ -156,7 +218,11 @@ class CalibrationComparer(ApplyCalibration):
         logger.error(msg.format(caltype=self.calibration_type), image=image)
         image.is_bad = True
 
-    def apply_master_calibration(self, image, master_calibration_image):
+    def apply_master_calibration_to_band(self, image, master_calibration_image, rows):
+        # The comparison is made on the whole frame in record_master_calibration
+        pass
+
+    def record_master_calibration(self, image, master_calibration_image):
         # Short circuit
         if master_calibration_image.data is None:
             return image
@@ -201,6 +267,124 @@ class CalibrationComparer(ApplyCalibration):
         return np.ones(image.data.size)
 
 
+def read_master_calibration_image(filename, runtime_context):
+    """
+    Load a master calibration frame, reusing the copy in MASTER_CALIBRATION_CACHE if the file has not changed
+
+    Parameters
+    ----------
+    filename: str
+              Full path to the master calibration file
+    runtime_context: banzai.context.Context
+                     Context object with runtime environment info
+
+    Returns
+    -------
+    master_calibration_image: banzai.images.Image
+                              Master calibration frame. The data and bpm arrays are read-only because the
+                              frame is shared between all of the images reduced by this process.
+    """
+    try:
+        file_stat = os.stat(filename)
+        cache_key = (os.path.abspath(filename), file_stat.st_mtime_ns, file_stat.st_size)
+    except OSError:
+        cache_key = None
+
+    master_calibration_image = MASTER_CALIBRATION_CACHE.get(cache_key)
+    if master_calibration_image is None:
+        if cache_key is not None and SHARED_CALIBRATION_STORE is not None:
+            master_calibration_image = _read_shared_master_calibration_image(filename, cache_key, runtime_context)
+        else:
+            # Master calibrations are only read, so memory map them instead of copying the data
+            master_calibration_image = FRAME_CLASS(runtime_context, filename=filename, memmap=True)
+        if cache_key is not None:
+            for array in [master_calibration_image.data, master_calibration_image.bpm]:
+                if array is not None:
+                    array.flags.writeable = False
+            MASTER_CALIBRATION_CACHE.put(cache_key, master_calibration_image)
+    logger.debug('Read master calibration', extra_tags={'master_calibration': os.path.basename(filename),
+                                                        'cache_hits': MASTER_CALIBRATION_CACHE.hits,
+                                                        'cache_misses': MASTER_CALIBRATION_CACHE.misses,
+                                                        'cache_bytes': MASTER_CALIBRATION_CACHE.size})
+    return master_calibration_image
+
+
+def _read_shared_master_calibration_image(filename, cache_key, runtime_context):
+    """
+    Build a master calibration frame from the arrays in SHARED_CALIBRATION_STORE
+
+    The file is only decompressed by the first process on the node that needs it. Every other
+    process just maps the shared arrays. The headers are stored with the arrays, so the frame is the
+    same as the one read from the file.
+    """
+    def load_arrays():
+        data, header, bpm, extension_headers = fits_utils.open_image(filename, memmap=True)
+        arrays = {'data': data, 'bpm': bpm, 'header': _header_to_array(header)}
+        for i, extension_header in enumerate(extension_headers):
+            arrays['extension_header_{0}'.format(i)] = _header_to_array(extension_header)
+        return arrays
+
+    arrays = SHARED_CALIBRATION_STORE.get(hashlib.md5(repr(cache_key).encode()).hexdigest(), load_arrays)
+    n_extension_headers = len([key for key in arrays if key.startswith('extension_header_')])
+    extension_headers = [_array_to_header(arrays['extension_header_{0}'.format(i)])
+                         for i in range(n_extension_headers)]
+    master_calibration_image = FRAME_CLASS(runtime_context, data=arrays['data'], bpm=arrays['bpm'],
+                                           header=_array_to_header(arrays['header']),
+                                           extension_headers=extension_headers)
+    if filename.endswith('.fz'):
+        filename = filename[:-3]
+    master_calibration_image.filename = os.path.basename(filename)
+    return master_calibration_image
+
+
+def _header_to_array(header):
+    return np.frombuffer(header.tostring().encode('ascii'), dtype=np.uint8)
+
+
+def _array_to_header(array):
+    return fits.Header.fromstring(np.asarray(array).tobytes().decode('ascii'))
+
+
+def stack_images(images, memory_budget):
+    """
+    Take the sigma clipped mean of a set of images, a band of rows at a time
+
+    Parameters
+    ----------
+    images: list of banzai.images.Image
+            Images to combine. They must all have the same shape.
+    memory_budget: int
+                   Maximum size in bytes of the buffers that each band is combined in
+
+    Returns
+    -------
+    stacked_data: float32 numpy array
+                  The sigma clipped mean of the image data, ignoring pixels in the bad pixel masks
+
+    Notes
+    -----
+    Only one band of every image is copied into memory at once, so images whose data are memory mapped
+    are paged in from disk one band at a time. Each pixel is combined independently, so the result does
+    not depend on the band size.
+    """
+    ny, nx = images[0].ny, images[0].nx
+    rows_per_band = int(min(ny, max(1, memory_budget // (nx * len(images) * (np.float32().nbytes + 1)))))
+    data_stack = np.empty((rows_per_band, nx, len(images)), dtype=np.float32)
+    stack_mask = np.empty((rows_per_band, nx, len(images)), dtype=np.uint8)
+    stacked_data = np.empty((ny, nx), dtype=np.float32)
+
+    for band_start in range(0, ny, rows_per_band):
+        band_end = min(ny, band_start + rows_per_band)
+        band_data = data_stack[:band_end - band_start]
+        band_mask = stack_mask[:band_end - band_start]
+        for i, image in enumerate(images):
+            band_data[:, :, i] = image.data[band_start:band_end]
+            band_mask[:, :, i] = image.bpm[band_start:band_end]
+        stacked_data[band_start:band_end] = stats.sigma_clipped_mean(band_data, 3.0, axis=2, mask=band_mask,
+                                                                     inplace=True)
+    return stacked_data
+
+
 def create_master_calibration_header(old_header, images):
     header = fits.Header()
     for key in old_header.keys():
@@ -225,13 +409,142 @@ def create_master_calibration_header(old_header, images):
     return header
 
 
+def read_calibration_images(image_path_list, runtime_context):
+    """
+    Read and munge the individual frames that go into a master calibration in parallel
+
+    Parameters
+    ----------
+    image_path_list: list of str
+                     Paths to the frames
+    runtime_context: banzai.context.Context
+                     Context object with runtime environment info
+
+    Returns
+    -------
+    images: list of banzai.images.Image
+            The frames that could be read, in the same order as image_path_list
+
+    Notes
+    -----
+    Frames that were added to an accumulator when they were reduced are taken from there. The rest are
+    read from disk. Reading is dominated by I/O and decompression, both of which release the GIL, so the
+    frames are read by a pool of settings.CALIBRATION_LOAD_THREADS threads.
+    """
+    start_time = time.perf_counter()
+    accumulated_frames = _find_accumulated_calibration_frames(image_path_list)
+
+    def read_calibration_image(image_path):
+        read_start_time = time.perf_counter()
+        accumulator = accumulated_frames.get(os.path.basename(image_path))
+        image = None
+        if accumulator is not None:
+            image = _read_accumulated_calibration_image(accumulator, os.path.basename(image_path), runtime_context)
+        if image is None:
+            # The frames are only read while stacking, so memory map them and let the stacker page them in by band
+            image = image_utils.read_image(image_path, runtime_context, memmap=True)
+        logger.debug('Read calibration frame', extra_tags={'filename': os.path.basename(image_path),
+                                                           'accumulated': accumulator is not None,
+                                                           'read_time': time.perf_counter() - read_start_time})
+        return image
+
+    images = fits_utils.map_in_threads(read_calibration_image, image_path_list,
+                                       max_workers=settings.CALIBRATION_LOAD_THREADS)
+    images = [image for image in images if image is not None]
+    logger.info('Read calibration frames', extra_tags={'n_frames': len(images),
+                                                       'n_accumulated': len(accumulated_frames),
+                                                       'n_failed': len(image_path_list) - len(images),
+                                                       'read_time': time.perf_counter() - start_time})
+    return images
+
+
+def accumulate_calibration_frame(image, runtime_context):
+    """
+    Keep a reduced calibration frame in an accumulator so the master can be stacked without reading it again
+
+    Parameters
+    ----------
+    image: banzai.images.Image
+           Reduced frame. It must already have been written so its filename matches the calibration database.
+    runtime_context: banzai.context.Context
+                     Context object with runtime environment info
+
+    Notes
+    -----
+    Frames are grouped into one accumulator per instrument, calibration type and night. Nothing is kept
+    if settings.CALIBRATION_ACCUMULATOR_DIRECTORY is not set. This is only an opt-in read cache: the frame
+    is saved from memory as the float32 data that was passed to the writer, so nothing is read back or
+    decompressed. The accumulated data are therefore not quantized like the fpacked files on disk, and a
+    master stacked from the accumulator differs from one stacked from the files by up to the quantization
+    noise of fpack (a small fraction of the noise in each frame).
+    """
+    if not settings.CALIBRATION_ACCUMULATOR_DIRECTORY or image.is_bad:
+        return
+    accumulator_name = '{instrument_id}_{obstype}_{epoch}'.format(instrument_id=image.instrument.id,
+                                                                  obstype=image.obstype, epoch=image.epoch)
+    accumulator_directory = os.path.join(settings.CALIBRATION_ACCUMULATOR_DIRECTORY, accumulator_name)
+    accumulator = accumulator_utils.FrameAccumulator(accumulator_directory)
+    try:
+        # The written file has no extension headers, so neither does the accumulated frame
+        accumulator.add(os.path.basename(image.filename), image.data, image.bpm, image.header)
+        accumulator_utils.remove_old_accumulators(settings.CALIBRATION_ACCUMULATOR_DIRECTORY,
+                                                  settings.CALIBRATION_ACCUMULATOR_MAX_AGE)
+    except OSError:
+        # The frame can still be read from disk when the master is made
+        logger.error('Could not accumulate calibration frame: {error}'.format(error=logs.format_exception()),
+                     image=image)
+
+
+def _find_accumulated_calibration_frames(image_path_list):
+    if not settings.CALIBRATION_ACCUMULATOR_DIRECTORY:
+        return {}
+    filenames = {os.path.basename(image_path) for image_path in image_path_list}
+    accumulated_frames = {}
+    for accumulator in accumulator_utils.get_accumulators(settings.CALIBRATION_ACCUMULATOR_DIRECTORY):
+        for name in accumulator.names():
+            if name in filenames:
+                accumulated_frames[name] = accumulator
+    return accumulated_frames
+
+
+def _read_accumulated_calibration_image(accumulator, name, runtime_context):
+    try:
+        data, bpm, header, extension_headers = accumulator.read(name)
+        # Build and munge the frame exactly as image_utils.read_image does for the file on disk
+        frame_class = import_utils.import_attribute(runtime_context.FRAME_CLASS)
+        image = frame_class(runtime_context, data=data, header=header, bpm=bpm, extension_headers=extension_headers)
+        if name.endswith('.fz'):
+            name = name[:-3]
+        image.filename = name
+        if image.instrument is None:
+            logger.error("Image instrument attribute is None, aborting", image=image)
+            raise IOError
+        image_utils.munge(image)
+        return image
+    except Exception:
+        logger.error('Error reading accumulated frame: {error}'.format(error=logs.format_exception()),
+                     extra_tags={'filename': name})
+
+
+def _discard_accumulated_calibration_frames(image_path_list):
+    accumulated_frames = _find_accumulated_calibration_frames(image_path_list)
+    for accumulator in set(accumulated_frames.values()):
+        try:
+            accumulator.discard(accumulated_frames.keys())
+        except OSError:
+            logger.error('Could not discard accumulated frames: {error}'.format(error=logs.format_exception()),
+                         extra_tags={'accumulator': accumulator.directory})
+
+
 def run_master_maker(image_path_list, runtime_context, frame_type):
-    images = [image_utils.read_image(image_path, runtime_context) for image_path in image_path_list]
+    images = read_calibration_images(image_path_list, runtime_context)
     stage_constructor = import_utils.import_attribute(settings.CALIBRATION_STACKER_STAGE[frame_type.upper()])
     stage_to_run = stage_constructor(runtime_context)
     images = stage_to_run.run(images)
     for image in images:
         image.write(runtime_context)
+    # The frames have been stacked, so they are not needed in the accumulators any more
+    _discard_accumulated_calibration_frames(image_path_list)
 
 
 def process_master_maker(instrument, frame_type, min_date, max_date, runtime_context):
@@ -1,4 +1,5 @@
 import os
+import sys
 import logging
 from datetime import datetime, timedelta
 from dateutil.parser import parse
@@ -7,9 +8,10 @@ from celery import Celery
 
 from banzai import dbs, calibrations, logs
 from banzai.utils import date_utils, realtime_utils, observation_utils
-from banzai.utils.stage_utils import run
-from celery.signals import setup_logging
+from banzai.utils.stage_utils import run, validate_stage_settings
+from celery.signals import setup_logging, worker_init
 from banzai.context import Context
+from banzai.exceptions import PipelineConfigurationException
 
 app = Celery('banzai')
 app.config_from_object('banzai.celeryconfig')
@@ -27,6 +29,25 @@ def setup_loggers(*args, **kwargs):
     logs.set_log_level(os.getenv('BANZAI_WORKER_LOGLEVEL', 'INFO'))
 
 
+@worker_init.connect
+def check_stage_settings(*args, **kwargs):
+    # Fail when the worker starts, before it accepts any tasks, rather than on the first frame if the stage lists
+    # are misconfigured. Celery only logs exceptions raised by signal handlers, so exit explicitly.
+    # The pipeline plans themselves are compiled with the runtime context of the first task.
+    try:
+        validate_stage_settings()
+    except PipelineConfigurationException as e:
+        logger.error('Stopping the worker: {error}'.format(error=e))
+        sys.exit(1)
+
+
+@app.task(name='celery.refresh_instrument_tables')
+def refresh_instrument_tables(runtime_context: dict):
+    runtime_context = Context(runtime_context)
+    logger.info('Refreshing the instrument table from the configdb')
+    dbs.populate_instrument_tables(db_address=runtime_context.db_address)
+
+
 @app.task(name='celery.schedule_calibration_stacking')
 def schedule_calibration_stacking(site: str, runtime_context: dict, min_date=None, max_date=None, frame_types=None):
     runtime_context = Context(runtime_context)
@@ -114,10 +135,6 @@ def process_image(path: str, runtime_context: dict):
     try:
         if realtime_utils.need_to_process_image(path, runtime_context):
             logger.info('Reducing frame', extra_tags={'filename': os.path.basename(path)})
-
-            # Increment the number of tries for this file
-            realtime_utils.increment_try_number(path, db_address=runtime_context.db_address)
-
             run(path, runtime_context)
             realtime_utils.set_file_as_processed(path, db_address=runtime_context.db_address)
 
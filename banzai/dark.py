@@ -3,24 +3,29 @@ import logging
 
 import numpy as np
 
-from banzai.stages import Stage
+from banzai.stages import BandStage
 from banzai.calibrations import CalibrationStacker, ApplyCalibration, CalibrationComparer
 from banzai.utils import qc
 
 logger = logging.getLogger('banzai')
 
 
-class DarkNormalizer(Stage):
+class DarkNormalizer(BandStage):
     def __init__(self, runtime_context):
         super(DarkNormalizer, self).__init__(runtime_context)
 
-    def do_stage(self, image):
+    def start_bands(self, image):
         if image.exptime <= 0.0:
             logger.error('EXPTIME is <= 0.0. Rejecting frame', image=image)
             qc_results = {'exptime': image.exptime, 'rejected': True}
             qc.save_qc_results(self.runtime_context, qc_results, image)
             return None
-        image.data /= image.exptime
+        return {}
+
+    def do_band(self, image, band_state, rows):
+        image.data[..., rows, :] /= image.exptime
+
+    def finish_bands(self, image, band_state):
         logger.info('Normalizing dark by exposure time', image=image)
         return image
 
@@ -42,14 +47,18 @@ class DarkSubtractor(ApplyCalibration):
     def calibration_type(self):
         return 'dark'
 
-    def apply_master_calibration(self, image, master_calibration_image):
-        master_dark_data = master_calibration_image.data
+    def apply_master_calibration_to_band(self, image, master_calibration_image, rows):
+        image.data[..., rows, :] -= master_calibration_image.data[..., rows, :] * image.exptime
+        image.bpm[..., rows, :] |= master_calibration_image.bpm[..., rows, :]
+
+    def record_master_calibration(self, image, master_calibration_image):
+        """
+        Add the header keywords and log messages for a dark that has been subtracted from an image
+        """
         master_dark_filename = os.path.basename(master_calibration_image.filename)
         logging_tags = {'master_dark': os.path.basename(master_calibration_image.filename)}
 
         logger.info('Subtracting dark', image=image, extra_tags=logging_tags)
-        image.data -= master_dark_data * image.exptime
-        image.bpm |= master_calibration_image.bpm
         image.header['L1IDDARK'] = (master_dark_filename, 'ID of dark frame')
         image.header['L1STATDA'] = (1, 'Status flag for dark frame correction')
         return image
@@ -3,6 +3,7 @@ import logging
 
 import numpy as np
 
+from banzai import settings
 from banzai.utils import stats
 from banzai.stages import Stage
 from banzai.calibrations import CalibrationStacker, ApplyCalibration, CalibrationComparer
@@ -16,11 +17,16 @@ class FlatNormalizer(Stage):
 
     def do_stage(self, image):
         # Get the sigma clipped mean of the central 25% of the image
-        flat_normalization = stats.sigma_clipped_mean(image.get_inner_image_section(), 3.5)
+        logging_tags = {}
+        if settings.FLAT_NORMALIZATION_RELATIVE_ERROR > 0:
+            flat_normalization, logging_tags['flat_normalization_error'] = stats.subsampled_sigma_clipped_mean(
+                image.get_inner_image_section(), 3.5, settings.FLAT_NORMALIZATION_RELATIVE_ERROR, relative=True)
+        else:
+            flat_normalization = stats.sigma_clipped_mean(image.get_inner_image_section(), 3.5)
         image.data /= flat_normalization
         image.header['FLATLVL'] = flat_normalization
-        logger.info('Calculate flat normalization', image=image,
-                    extra_tags={'flat_normalization': flat_normalization})
+        logging_tags['flat_normalization'] = flat_normalization
+        logger.info('Calculate flat normalization', image=image, extra_tags=logging_tags)
         return image
 
 
@@ -48,14 +54,17 @@ class FlatDivider(ApplyCalibration):
     def calibration_type(self):
         return 'SKYFLAT'
 
-    def apply_master_calibration(self, image, master_calibration_image):
+    def apply_master_calibration_to_band(self, image, master_calibration_image, rows):
+        image.data[..., rows, :] /= master_calibration_image.data[..., rows, :]
+        image.bpm[..., rows, :] |= master_calibration_image.bpm[..., rows, :]
 
+    def record_master_calibration(self, image, master_calibration_image):
+        """
+        Add the header keywords and log messages for a flat field that has been divided out of an image
+        """
         master_flat_filename = master_calibration_image.filename
-        master_flat_data = master_calibration_image.data
         logging_tags = {'master_flat': os.path.basename(master_calibration_image.filename)}
         logger.info('Flattening image', image=image, extra_tags=logging_tags)
-        image.data /= master_flat_data
-        image.bpm |= master_calibration_image.bpm
         master_flat_filename = os.path.basename(master_flat_filename)
         image.header['L1IDFLAT'] = (master_flat_filename, 'ID of flat frame')
         image.header['L1STATFL'] = (1, 'Status flag for flat field correction')
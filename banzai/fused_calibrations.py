@@ -0,0 +1,121 @@
+import logging
+
+from banzai import settings
+from banzai.stages import BandStage, get_row_bands
+from banzai.bias import BiasSubtractor
+from banzai.dark import DarkSubtractor
+from banzai.flats import FlatDivider
+from banzai.utils import fits_utils
+
+logger = logging.getLogger('banzai')
+
+# Approximate number of pixels in each band of rows apply_calibrations works on. Small enough that a band of the
+# image and of each master stays in cache while all of the calibrations are applied to it.
+BAND_SIZE = 65536
+
+
+class FusedCalibrationApplier(BandStage):
+    """
+    Subtract the bias and dark and divide by the flat field in a single pass over the image
+
+    Notes
+    -----
+    This replaces BiasSubtractor, DarkSubtractor and FlatDivider when settings.FUSE_CALIBRATION_STAGES is set.
+    The masters are found, checked, and recorded in the header and logs by those stages, so the results are
+    exactly the same as running them one after the other, but the image is only swept through memory once.
+    """
+    def __init__(self, runtime_context):
+        super(FusedCalibrationApplier, self).__init__(runtime_context)
+        self.calibration_stages = [BiasSubtractor(runtime_context), DarkSubtractor(runtime_context),
+                                   FlatDivider(runtime_context)]
+
+    def do_stage(self, image):
+        # Run on its own, the frame is split into bands of rows like in a BandStreamer, and the bands are
+        # calibrated in a pool of threads
+        band_state = self.start_bands(image)
+        if band_state is None:
+            return None
+        fits_utils.map_in_threads(lambda rows: self.do_band(image, band_state, rows),
+                                  get_row_bands(image.data.shape, BAND_SIZE),
+                                  max_workers=settings.FUSED_CALIBRATION_THREADS)
+        return self.finish_bands(image, band_state)
+
+    def start_bands(self, image):
+        master_calibration_images = {}
+        for stage in self.calibration_stages:
+            master_calibration_filename = stage.get_calibration_filename(image)
+            if master_calibration_filename is None:
+                stage.on_missing_master_calibration(image)
+                continue
+            master_calibration_image = stage.load_master_calibration_image(image, master_calibration_filename)
+            if master_calibration_image is None:
+                return None
+            master_calibration_images[stage] = master_calibration_image
+        return {'master_calibration_images': master_calibration_images}
+
+    def do_band(self, image, band_state, rows):
+        # The band is already small enough to stay in cache, so it is calibrated in this thread
+        bias, dark, flat = [band_state['master_calibration_images'].get(stage) for stage in self.calibration_stages]
+        apply_calibrations(image.data[..., rows, :], image.bpm[..., rows, :],
+                           bias_level=None if bias is None else float(bias.header['BIASLVL']),
+                           bias=None if bias is None else bias.data[..., rows, :],
+                           bias_bpm=None if bias is None else bias.bpm[..., rows, :],
+                           dark=None if dark is None else dark.data[..., rows, :],
+                           dark_bpm=None if dark is None else dark.bpm[..., rows, :],
+                           exptime=image.exptime,
+                           flat=None if flat is None else flat.data[..., rows, :],
+                           flat_bpm=None if flat is None else flat.bpm[..., rows, :],
+                           max_workers=1)
+
+    def finish_bands(self, image, band_state):
+        for stage, master_calibration_image in band_state['master_calibration_images'].items():
+            image = stage.record_master_calibration(image, master_calibration_image)
+        return image
+
+
+def apply_calibrations(data, bpm, bias_level=None, bias=None, bias_bpm=None, dark=None, dark_bpm=None, exptime=None,
+                       flat=None, flat_bpm=None, max_workers=None):
+    """
+    Apply (data - bias_level - bias - dark * exptime) / flat and OR the master bad pixel masks into bpm in place
+
+    Parameters
+    ----------
+    data: numpy array
+          Image data. Modified in place.
+    bpm: numpy array
+         Bad pixel mask of the image. Modified in place.
+    bias_level: float
+                Bias level to subtract. Skipped if None.
+    bias, dark, flat: numpy arrays
+                      Master calibration data with the same shape as the image. Each one is skipped if it is None.
+    bias_bpm, dark_bpm, flat_bpm: numpy arrays
+                                  Bad pixel masks of the masters. Each one is skipped if it is None.
+    exptime: float
+             Exposure time the dark is scaled by
+    max_workers: int
+                 Number of threads to use
+
+    Notes
+    -----
+    The image is split into bands of rows (along the second to last axis, so multi-amplifier frames are split
+    into bands of rows of every amplifier) of about BAND_SIZE pixels and all of the operations are done on one
+    band before moving on to the next, so the data only goes through main memory once. The bands are
+    processed in a pool of threads (numpy releases the GIL). Each operation is the same numpy operation as in the
+    individual stages, in the same order, so the results are bit for bit identical. The only temporary array is
+    one band of the scaled dark.
+    """
+    def apply_to_band(band):
+        band_data = data[..., band, :]
+        if bias_level is not None:
+            band_data -= bias_level
+        if bias is not None:
+            band_data -= bias[..., band, :]
+        if dark is not None:
+            band_data -= dark[..., band, :] * exptime
+        if flat is not None:
+            band_data /= flat[..., band, :]
+        for master_bpm in [bias_bpm, dark_bpm, flat_bpm]:
+            if master_bpm is not None:
+                bpm[..., band, :] |= master_bpm[..., band, :]
+
+    fits_utils.map_in_threads(apply_to_band, get_row_bands(data.shape, BAND_SIZE), max_workers=max_workers)
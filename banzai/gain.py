@@ -1,36 +1,39 @@
 import logging
 
-from banzai.stages import Stage
+from banzai.stages import BandStage
 
 logger = logging.getLogger('banzai')
 
 
-class GainNormalizer(Stage):
+class GainNormalizer(BandStage):
     def __init__(self, runtime_context):
         super(GainNormalizer, self).__init__(runtime_context)
 
-    def do_stage(self, image):
+    def start_bands(self, image):
         logger.info('Multiplying by gain', image=image, extra_tags={'gain': image.gain})
 
         gain = image.gain
         if validate_gain(gain):
             logger.error('Gain missing. Rejecting image.', image=image)
             return None
+
+        if image.data_is_3d():
+            image.header['SATURATE'] *= min(gain)
+            image.header['MAXLIN'] *= min(gain)
+        else:
+            image.header['SATURATE'] *= gain
+            image.header['MAXLIN'] *= gain
+
+        image.gain = 1.0
+        image.header['GAIN'] = 1.0
+        return {'gain': gain}
+
+    def do_band(self, image, band_state, rows):
+        if image.data_is_3d():
+            for i in range(image.get_n_amps()):
+                image.data[i, rows] *= band_state['gain'][i]
         else:
-            if image.data_is_3d():
-                for i in range(image.get_n_amps()):
-                    image.data[i] *= gain[i]
-                image.header['SATURATE'] *= min(gain)
-                image.header['MAXLIN'] *= min(gain)
-            else:
-                image.data *= image.gain
-                image.header['SATURATE'] *= image.gain
-                image.header['MAXLIN'] *= image.gain
-
-            image.gain = 1.0
-            image.header['GAIN'] = 1.0
-
-        return image
+            image.data[rows] *= band_state['gain']
 
 
 def validate_gain(gain):
@@ -1,7 +1,5 @@
 import os
 import logging
-import tempfile
-import shutil
 import datetime
 
 import numpy as np
@@ -43,7 +41,7 @@ class DataTable(object):
 class Image(object):
 
     def __init__(self, runtime_context, filename=None, data=None, data_tables=None,
-                 header=None, extension_headers=None, bpm=None):
+                 header=None, extension_headers=None, bpm=None, memmap=False):
         if header is None:
             header = fits.Header()
 
@@ -54,7 +52,7 @@ class Image(object):
             extension_headers = []
 
         if filename is not None:
-            data, header, bpm, extension_headers = fits_utils.open_image(filename)
+            data, header, bpm, extension_headers = fits_utils.open_image(filename, memmap=memmap)
             if '.fz' == filename[-3:]:
                 filename = filename[:-3]
             self.filename = os.path.basename(filename)
@@ -147,17 +145,17 @@ class Image(object):
     def _writeto(self, filepath, fpack=False):
         logger.info('Writing file to {filepath}'.format(filepath=filepath), image=self)
         hdu_list = self._get_hdu_list()
-        base_filename = os.path.basename(filepath).split('.fz')[0]
-        with tempfile.TemporaryDirectory() as temp_directory:
-            hdu_list.writeto(os.path.join(temp_directory, base_filename), overwrite=True, output_verify='fix+warn')
+        if fpack:
+            hdu_list = fits_utils.pack(hdu_list)
+        # Write next to the destination and rename so readers never see a partially written file
+        temp_filepath = '{filepath}.{pid}.tmp'.format(filepath=filepath, pid=os.getpid())
+        try:
+            hdu_list.writeto(temp_filepath, overwrite=True, output_verify='fix+warn')
+            os.replace(temp_filepath, filepath)
+        finally:
             hdu_list.close()
-            if fpack:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                command = 'fpack -q 64 {temp_directory}/{basename}'
-                os.system(command.format(temp_directory=temp_directory, basename=base_filename))
-                base_filename += '.fz'
-            shutil.move(os.path.join(temp_directory, base_filename), filepath)
+            if os.path.exists(temp_filepath):
+                os.remove(temp_filepath)
 
     def _get_hdu_list(self):
         image_hdu = fits.PrimaryHDU(self.data.astype(np.float32), header=self.header)
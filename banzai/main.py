@@ -9,6 +9,7 @@ October 2015
 """
 import argparse
 import logging
+import os
 
 from kombu import Exchange, Connection, Queue
 from kombu.mixins import ConsumerMixin
@@ -17,9 +18,9 @@ from types import ModuleType
 
 from banzai import settings, dbs, logs, calibrations
 from banzai.context import Context
-from banzai.utils.stage_utils import run
+from banzai.utils.stage_utils import run, compile_pipeline_plans, reduce_frames
 from banzai.utils import image_utils, date_utils, fits_utils
-from banzai.celery import process_image, app, schedule_calibration_stacking
+from banzai.celery import process_image, app, schedule_calibration_stacking, refresh_instrument_tables
 from celery.schedules import crontab
 import celery
 import celery.bin.beat
@@ -130,6 +131,25 @@ def reduce_single_frame():
         logger.error(logs.format_exception(), extra_tags={'filepath': runtime_context.path})
 
 
+def reduce_directory():
+    extra_console_arguments = [{'args': ['--raw-path'],
+                                'kwargs': {'dest': 'raw_path', 'required': True,
+                                           'help': 'Directory of frames to process or a glob pattern, '
+                                                   'e.g. "/archive/coj/kb98/20190401/raw/*-b00.fits*"'}},
+                               {'args': ['--n-processes'],
+                                'kwargs': {'dest': 'n_processes', 'default': os.cpu_count() or 1, 'type': int,
+                                           'help': 'Number of processes to reduce frames with. '
+                                                   'Defaults to the number of cores.'}}]
+    runtime_context = parse_directory_args(extra_console_arguments=extra_console_arguments)
+    # Fail before reading any frames if the stage lists are misconfigured
+    compile_pipeline_plans(runtime_context)
+    frames = image_utils.select_frames_to_reduce(runtime_context.raw_path, runtime_context,
+                                                 max_workers=runtime_context.n_processes)
+    summary = reduce_frames(frames, runtime_context, n_processes=runtime_context.n_processes)
+    for filename in summary['failed']:
+        logger.error('Frame was not reduced', extra_tags={'filename': filename})
+
+
 def stack_calibrations():
     extra_console_arguments = [{'args': ['--site'],
                                 'kwargs': {'dest': 'site', 'help': 'Site code (e.g. ogg)', 'required': True}},
@@ -164,6 +184,9 @@ def start_stacking_scheduler():
     for site, entry in runtime_context.SCHEDULE_STACKING_CRON_ENTRIES.items():
         app.add_periodic_task(crontab(minute=entry['minute'], hour=entry['hour']),
                               schedule_calibration_stacking.s(site=site, runtime_context=vars(runtime_context)))
+    refresh_entry = runtime_context.REFRESH_INSTRUMENTS_CRON_ENTRY
+    app.add_periodic_task(crontab(minute=refresh_entry['minute'], hour=refresh_entry['hour']),
+                          refresh_instrument_tables.s(runtime_context=vars(runtime_context)))
 
     beat = celery.bin.beat.beat(app=app)
     logger.info('Starting celery beat')
@@ -189,6 +212,9 @@ def run_realtime_pipeline():
     except Exception:
         logger.error('Could not connect to the configdb: {error}'.format(error=logs.format_exception()))
 
+    # Fail now rather than in the workers if the stage lists are misconfigured
+    compile_pipeline_plans(runtime_context)
+
     logger.info('Starting pipeline listener')
 
     fits_exchange = Exchange('fits_files', type='fanout')
@@ -272,3 +298,5 @@ def update_db():
         dbs.populate_instrument_tables(db_address=args.db_address)
     except Exception:
         logger.error('Could not populate instruments table: {error}'.format(error=logs.format_exception()))
+    dbs.migrate_calibration_attribute_columns(db_address=args.db_address)
+    dbs.migrate_processed_image_filename_index(db_address=args.db_address)
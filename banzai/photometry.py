@@ -7,7 +7,7 @@ import sep
 from banzai.utils import stats, array_utils
 from banzai.stages import Stage
 from banzai.images import DataTable
-from banzai import logs
+from banzai import logs, settings
 
 logger = logging.getLogger('banzai')
 
@@ -197,15 +197,25 @@ class SourceDetector(Stage):
             catalog.reverse()
 
             # Save some background statistics in the header
-            mean_background = stats.sigma_clipped_mean(bkg.back(), 5.0)
+            background = bkg.back()
+            if settings.BACKGROUND_STATISTICS_STANDARD_ERROR > 0:
+                mean_background, mean_background_error = stats.subsampled_sigma_clipped_mean(
+                    background, 5.0, settings.BACKGROUND_STATISTICS_STANDARD_ERROR)
+                std_background, std_background_error = stats.subsampled_robust_standard_deviation(
+                    background, settings.BACKGROUND_STATISTICS_STANDARD_ERROR)
+                logger.debug('Estimated background statistics from a subsample', image=image,
+                             extra_tags={'L1MEAN_ERROR': float(mean_background_error),
+                                         'L1SIGMA_ERROR': float(std_background_error)})
+            else:
+                mean_background = stats.sigma_clipped_mean(background, 5.0)
+                std_background = stats.robust_standard_deviation(background)
             image.header['L1MEAN'] = (mean_background,
                                       '[counts] Sigma clipped mean of frame background')
 
-            median_background = np.median(bkg.back())
+            median_background = np.median(background)
             image.header['L1MEDIAN'] = (median_background,
                                         '[counts] Median of frame background')
 
-            std_background = stats.robust_standard_deviation(bkg.back())
             image.header['L1SIGMA'] = (std_background,
                                        '[counts] Robust std dev of frame background')
 
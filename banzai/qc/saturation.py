@@ -1,12 +1,14 @@
 import logging
 
-from banzai.stages import Stage
+import numpy as np
+
+from banzai.stages import BandStage
 from banzai.utils import qc
 
 logger = logging.getLogger('banzai')
 
 
-class SaturationTest(Stage):
+class SaturationTest(BandStage):
     """
     Reject any images that have 5% or more of their pixels saturated.
 
@@ -14,17 +16,23 @@ class SaturationTest(Stage):
     =====
     Typically this means that something went wrong and can lead to bad master flat fields, etc.
     """
+    rejects_after_bands = True
+
     # Empirically we have decided to use a 5% threshold to reject the image
     SATURATION_THRESHOLD = 0.05
 
     def __init__(self, runtime_context):
         super(SaturationTest, self).__init__(runtime_context)
 
-    def do_stage(self, image):
-        saturation_level = float(image.header['SATURATE'])
-        saturated_pixels = image.data >= saturation_level
+    def start_bands(self, image):
+        return {'saturation_level': float(image.header['SATURATE']), 'n_saturated': 0}
+
+    def do_band(self, image, band_state, rows):
+        band_state['n_saturated'] += int(np.sum(image.data[..., rows, :] >= band_state['saturation_level']))
+
+    def finish_bands(self, image, band_state):
         total_pixels = image.data.size
-        saturation_fraction = float(saturated_pixels.sum()) / total_pixels
+        saturation_fraction = float(band_state['n_saturated']) / total_pixels
 
         logging_tags = {'SATFRAC': saturation_fraction,
                         'threshold': self.SATURATION_THRESHOLD}
@@ -2,13 +2,13 @@ import logging
 
 import numpy as np
 
-from banzai.stages import Stage
+from banzai.stages import BandStage
 from banzai.utils import qc
 
 logger = logging.getLogger('banzai')
 
 
-class ThousandsTest(Stage):
+class ThousandsTest(BandStage):
     """
     Reject any images that have 20% or more of their pixels exactly equal to 1000.
 
@@ -18,6 +18,8 @@ class ThousandsTest(Stage):
     in the images. When that happens, a large fraction of the pixels are set exactly to the value
     1000.
     """
+    rejects_after_bands = True
+
     # Empirically we have decided that if 20% of the image exactly equals 1000
     # something bad probably happened, so we reject the image
     THOUSANDS_THRESHOLD = 0.2
@@ -25,9 +27,15 @@ class ThousandsTest(Stage):
     def __init__(self, runtime_context):
         super(ThousandsTest, self).__init__(runtime_context)
 
-    def do_stage(self, image):
+    def start_bands(self, image):
+        return {'n_1000s': 0}
+
+    def do_band(self, image, band_state, rows):
+        band_state['n_1000s'] += int(np.sum(image.data[..., rows, :] == 1000))
+
+    def finish_bands(self, image, band_state):
         npixels = np.product(image.data.shape)
-        fraction_1000s = float(np.sum(image.data == 1000)) / npixels
+        fraction_1000s = float(band_state['n_1000s']) / npixels
         logging_tags = {'FRAC1000': fraction_1000s,
                         'threshold': self.THOUSANDS_THRESHOLD}
         has_1000s_error = fraction_1000s > self.THOUSANDS_THRESHOLD
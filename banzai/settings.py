@@ -29,6 +29,28 @@ ORDERED_STAGES = ['banzai.bpm.BPMUpdater',
                   'banzai.astrometry.WCSSolver',
                   'banzai.qc.pointing.PointingTest']
 
+# Every stage run is timed and logged. Set STAGE_TRACEMALLOC to also trace the peak memory each stage allocates,
+# which slows down every allocation. STAGE_TIMING_HISTORY and STAGE_TIMING_QC write a summary of the timings of
+# each frame to its header and to the QC database. The last STAGE_STATISTICS_WINDOW runs of each stage on each
+# instrument are kept and their p50/p95/p99 are logged every STAGE_STATISTICS_LOG_INTERVAL frames (0 to disable).
+STAGE_TRACEMALLOC = os.getenv('STAGE_TRACEMALLOC', 'false').lower() in ['true', '1']
+STAGE_TIMING_HISTORY = os.getenv('STAGE_TIMING_HISTORY', 'false').lower() in ['true', '1']
+STAGE_TIMING_QC = os.getenv('STAGE_TIMING_QC', 'false').lower() in ['true', '1']
+STAGE_STATISTICS_WINDOW = int(os.getenv('STAGE_STATISTICS_WINDOW', 1000))
+STAGE_STATISTICS_LOG_INTERVAL = int(os.getenv('STAGE_STATISTICS_LOG_INTERVAL', 100))
+
+# Stages that are replaced by FUSED_CALIBRATION_STAGE when FUSE_CALIBRATION_STAGES is set and all of them are run
+FUSED_CALIBRATION_STAGES = ['banzai.bias.BiasSubtractor', 'banzai.dark.DarkSubtractor', 'banzai.flats.FlatDivider']
+FUSED_CALIBRATION_STAGE = 'banzai.fused_calibrations.FusedCalibrationApplier'
+# Apply the bias, dark and flat to science frames in a single pass over the data with this many threads
+FUSE_CALIBRATION_STAGES = os.getenv('FUSE_CALIBRATION_STAGES', 'false').lower() in ['true', '1']
+FUSED_CALIBRATION_THREADS = int(os.getenv('FUSED_CALIBRATION_THREADS', 4))
+
+# Run consecutive band streamable stages (e.g. the QC tests, overscan, gain, bias, dark and flat) on one band of
+# about BAND_STREAMING_BAND_SIZE pixels at a time, so each band stays in cache for all of them
+BAND_STREAMING = os.getenv('BAND_STREAMING', 'false').lower() in ['true', '1']
+BAND_STREAMING_BAND_SIZE = int(os.getenv('BAND_STREAMING_BAND_SIZE', 65536))
+
 CALIBRATION_MIN_FRAMES = {'BIAS': 5,
                           'DARK': 5,
                           'SKYFLAT': 5}
@@ -52,6 +74,56 @@ CALIBRATION_STACKER_STAGE = {'BIAS': 'banzai.bias.BiasMaker',
 
 CALIBRATION_IMAGE_TYPES = ['BIAS', 'DARK', 'SKYFLAT']
 
+# Memory budget in bytes for the master calibration frames each process keeps in memory. Set to 0 to disable.
+CALIBRATION_CACHE_MAX_BYTES = int(os.getenv('CALIBRATION_CACHE_MAX_BYTES', 1024 ** 3))
+
+# Memory budget in bytes for the buffers master calibrations are stacked in. The frames are combined in bands
+# of rows that fit in this budget, so the memory needed does not grow with the number of frames times their size.
+CALIBRATION_STACK_MEMORY_BUDGET = int(os.getenv('CALIBRATION_STACK_MEMORY_BUDGET', 256 * 1024 ** 2))
+
+# Number of threads used to read and munge the frames that go into a master calibration
+CALIBRATION_LOAD_THREADS = int(os.getenv('CALIBRATION_LOAD_THREADS', 4))
+
+# Opt-in read cache where reduced bias, dark and flat frames are kept as memory mappable float32 arrays, so the
+# master calibration can be stacked without decompressing every frame again. The cached frames are not quantized
+# like the fpacked files, so masters differ from ones stacked from disk by the quantization noise. Leave empty to
+# disable.
+CALIBRATION_ACCUMULATOR_DIRECTORY = os.getenv('CALIBRATION_ACCUMULATOR_DIRECTORY', '')
+# Accumulated frames are deleted when their master is written, or after this many seconds without a new frame
+CALIBRATION_ACCUMULATOR_MAX_AGE = int(os.getenv('CALIBRATION_ACCUMULATOR_MAX_AGE', 7 * 24 * 3600))
+
+# Node-local directory (e.g. /dev/shm/banzai) where master calibrations are decompressed once and shared
+# between all worker processes. Leave empty to disable.
+CALIBRATION_SHARED_MEMORY_DIRECTORY = os.getenv('CALIBRATION_SHARED_MEMORY_DIRECTORY', '')
+CALIBRATION_SHARED_MEMORY_MAX_BYTES = int(os.getenv('CALIBRATION_SHARED_MEMORY_MAX_BYTES', 4 * 1024 ** 3))
+
+# Connection pool for the database engine each process keeps. Connections are tested before they are
+# used and replaced after DB_POOL_RECYCLE seconds so the server never closes them under us.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_POOL_MAX_OVERFLOW = int(os.getenv('DB_POOL_MAX_OVERFLOW', 5))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 3600))
+
+# Frames from instruments that are not in the database trigger a refresh of the instrument table from the
+# configdb. Each process refreshes at most once every CONFIGDB_REFRESH_INTERVAL seconds. Set
+# CONFIGDB_BACKGROUND_REFRESH to run the refresh in a background thread so the frame fails immediately
+# instead of waiting for the configdb.
+CONFIGDB_REFRESH_INTERVAL = int(os.getenv('CONFIGDB_REFRESH_INTERVAL', 300))
+CONFIGDB_BACKGROUND_REFRESH = os.getenv('CONFIGDB_BACKGROUND_REFRESH', 'false').lower() in ['true', '1']
+CONFIGDB_TIMEOUT = float(os.getenv('CONFIGDB_TIMEOUT', 10))
+
+# When to refresh the instrument table from the configdb in the celery beat scheduler
+REFRESH_INSTRUMENTS_CRON_ENTRY = {'minute': '*/30', 'hour': '*'}
+
+# Whole-frame statistics that only go into a single number can be estimated from a subsample of the pixels that is
+# grown until it reaches the standard error set here. Set to 0 to use every pixel.
+# Flat normalization: standard error as a fraction of the flat level
+FLAT_NORMALIZATION_RELATIVE_ERROR = float(os.getenv('FLAT_NORMALIZATION_RELATIVE_ERROR', 0))
+# Bias level subtracted from bias frames: standard error in ADU
+BIAS_LEVEL_STANDARD_ERROR = float(os.getenv('BIAS_LEVEL_STANDARD_ERROR', 0))
+# L1MEAN and L1SIGMA of the background map: standard error in counts
+BACKGROUND_STATISTICS_STANDARD_ERROR = float(os.getenv('BACKGROUND_STATISTICS_STANDARD_ERROR', 0))
+
 # Stack delays are expressed in seconds--namely, each is five minutes
 CALIBRATION_STACK_DELAYS = {'BIAS': 300,
                             'DARK': 300,
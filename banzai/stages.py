@@ -1,13 +1,20 @@
 import logging
 import abc
+import time
 import itertools
 
+import numpy as np
+
 from banzai import logs
+from banzai.utils import instrumentation_utils
 
 logger = logging.getLogger('banzai')
 
 
 class Stage(abc.ABC):
+    # Stages that set this implement start_bands, do_band and finish_bands (see BandStage) so that a BandStreamer
+    # can run them on one band of rows at a time
+    band_streamable = False
 
     def __init__(self, runtime_context):
         self.runtime_context = runtime_context
@@ -20,16 +27,175 @@ class Stage(abc.ABC):
         if image is None:
             return image
         logger.info('Running {0}'.format(self.stage_name), image=image)
+        timer = instrumentation_utils.StageTimer()
         try:
-            image = self.do_stage(image)
-            return image
-
+            processed_image = self.do_stage(image)
         except Exception:
             logger.error(logs.format_exception())
+            processed_image = None
+        instrumentation_utils.record_stage_measurement(self.stage_name, timer.stop(), image, processed_image)
+        return processed_image
+
+    @abc.abstractmethod
+    def do_stage(self, image):
+        return image
+
+
+class BandStage(Stage):
+    """
+    A stage whose pixel operations only depend on the rows they are applied to
+
+    Notes
+    -----
+    The work is split into start_bands, which does everything that is not row by row (e.g. reading a master
+    calibration) and returns the state the bands need, do_band, which applies the stage to a band of rows in
+    place, and finish_bands, which uses what was accumulated over the bands and updates the header.
+    Run on its own, the stage treats the whole frame as a single band. In a BandStreamer, start_bands of every
+    stage in the chain is called before any band is processed, so it must not read pixels that an earlier stage
+    in the chain changes.
+    """
+    band_streamable = True
+    # Stages that can only decide to reject an image in finish_bands, once they have seen every band, end a
+    # streamed chain so that no later stage works on (and logs about) an image that is going to be rejected
+    rejects_after_bands = False
+
+    def do_stage(self, image):
+        band_state = self.start_bands(image)
+        if band_state is None:
             return None
+        self.do_band(image, band_state, slice(None))
+        return self.finish_bands(image, band_state)
 
     @abc.abstractmethod
+    def start_bands(self, image):
+        """
+        Returns
+        -------
+        band_state: dict
+                    State passed to do_band and finish_bands, or None to reject the image
+        """
+        return {}
+
+    @abc.abstractmethod
+    def do_band(self, image, band_state, rows):
+        """
+        Apply the stage in place to image.data[..., rows, :]
+        """
+        pass
+
+    def finish_bands(self, image, band_state):
+        """
+        Returns
+        -------
+        image: banzai.images.Image
+               The processed image, or None to reject it
+        """
+        return image
+
+
+def get_row_bands(shape, band_size):
+    """
+    Split the rows of an array into bands
+
+    Parameters
+    ----------
+    shape: tuple
+           Shape of the array. The rows are along the second to last axis, so the bands of a multi-amplifier
+           frame are the same rows of every amplifier.
+    band_size: int
+               Approximate number of pixels in each band
+
+    Returns
+    -------
+    bands: list of slice
+           Rows of each band. The last band may be smaller than the others.
+    """
+    n_rows = shape[-2]
+    n_pixels = int(np.prod(shape))
+    rows_per_band = max(1, band_size * n_rows // max(n_pixels, 1))
+    return [slice(start, start + rows_per_band) for start in range(0, n_rows, rows_per_band)]
+
+
+class BandStreamer(Stage):
+    """
+    Run a chain of band streamable stages one band of rows at a time
+
+    Parameters
+    ----------
+    runtime_context: banzai.context.Context
+    stages: list of banzai.stages.Stage
+            Stages with band_streamable set, in the order they would otherwise be run. Only the last one may
+            set rejects_after_bands (see banzai.utils.stage_utils.stream_band_stages).
+    band_size: int
+               Approximate number of pixels in each band
+
+    Notes
+    -----
+    Each band goes through every stage while it is still in cache rather than every stage sweeping the whole
+    frame. The image is rejected if any stage rejects it. Each stage is still logged and timed on its own: its
+    measurement is the total over its start_bands, do_band and finish_bands calls, with the CPU time and peak
+    memory increase of the bands shared between the stages in proportion to their wall time.
+    """
+    def __init__(self, runtime_context, stages, band_size):
+        super(BandStreamer, self).__init__(runtime_context)
+        self.stages = stages
+        self.band_size = band_size
+
+    @property
+    def stage_name(self):
+        return '.'.join([__name__, '+'.join(stage.__class__.__name__ for stage in self.stages)])
+
+    def run(self, image):
+        if image is None:
+            return image
+        timers = {}
+        try:
+            processed_image = self._stream(image, timers)
+        except Exception:
+            logger.error(logs.format_exception())
+            processed_image = None
+        for stage in self.stages:
+            if stage in timers:
+                instrumentation_utils.record_stage_measurement(stage.stage_name, timers[stage].measurement(),
+                                                               image, processed_image)
+        return processed_image
+
     def do_stage(self, image):
+        return self._stream(image, {})
+
+    def _stream(self, image, timers):
+        band_states = []
+        for stage in self.stages:
+            logger.info('Running {0}'.format(stage.stage_name), image=image)
+            timers[stage] = instrumentation_utils.AccumulatingStageTimer()
+            band_state = timers[stage].call(stage.start_bands, image)
+            if band_state is None:
+                return None
+            band_states.append(band_state)
+
+        # Reading the CPU time and peak memory for every band would cost more than some of the bands themselves,
+        # so they are measured over all of the bands and shared out in proportion to the wall time of each stage
+        band_wall_times = [0.0] * len(self.stages)
+        peak_rss_start = instrumentation_utils.peak_rss()
+        cpu_time_start = time.process_time()
+        for rows in get_row_bands(image.data.shape, self.band_size):
+            wall_time = time.perf_counter()
+            for i, (stage, band_state) in enumerate(zip(self.stages, band_states)):
+                stage.do_band(image, band_state, rows)
+                band_end_time = time.perf_counter()
+                band_wall_times[i] += band_end_time - wall_time
+                wall_time = band_end_time
+        cpu_time = time.process_time() - cpu_time_start
+        peak_rss_increase = instrumentation_utils.peak_rss() - peak_rss_start
+        total_band_wall_time = max(sum(band_wall_times), 1e-9)
+        for stage, band_wall_time in zip(self.stages, band_wall_times):
+            share = band_wall_time / total_band_wall_time
+            timers[stage].add(band_wall_time, cpu_time * share, int(round(peak_rss_increase * share)))
+
+        for stage, band_state in zip(self.stages, band_states):
+            image = timers[stage].call(stage.finish_bands, image, band_state)
+            if image is None:
+                return None
         return image
 
 
@@ -60,7 +226,10 @@ class MultiFrameStage(abc.ABC):
             try:
                 image_set = list(image_set)
                 logger.info('Running {0}'.format(self.stage_name), image=image_set[0])
+                timer = instrumentation_utils.StageTimer()
                 processed_images += self.do_stage(image_set)
+                instrumentation_utils.record_stage_measurement(self.stage_name, timer.stop(), image_set[0],
+                                                               extra_tags={'n_images': len(image_set)})
             except Exception:
                 logger.error(logs.format_exception())
         return processed_images
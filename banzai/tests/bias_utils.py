@@ -3,7 +3,8 @@ import numpy as np
 
 
 class FakeBiasImage(FakeImage):
-    def __init__(self, runtime_context=None, data=None, bias_level=0.0, nx=101, ny=103, header=None, filename=None):
+    def __init__(self, runtime_context=None, data=None, bias_level=0.0, nx=101, ny=103, header=None, filename=None,
+                 **kwargs):
         super(FakeBiasImage, self).__init__(image_multiplier=0.0, nx=nx, ny=ny, runtime_context=runtime_context,
                                             data=data, header=header)
         for key, value in {'BIASLVL': bias_level, 'OBSTYPE': 'BIAS'}.items():
@@ -0,0 +1,71 @@
+import os
+
+import mock
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from banzai.utils.accumulator_utils import FrameAccumulator, get_accumulators, remove_old_accumulators
+
+
+def test_frames_are_read_back(tmpdir):
+    accumulator = FrameAccumulator(str(tmpdir.join('accumulator')))
+    data = np.arange(12, dtype=np.float64).reshape(3, 4)
+    bpm = np.zeros((3, 4), dtype=bool)
+    bpm[1, 2] = True
+    accumulator.add('frame1.fits.fz', data, bpm, fits.Header({'OBSTYPE': 'BIAS'}))
+    accumulator.add('frame2.fits.fz', data + 1, bpm, fits.Header({'OBSTYPE': 'BIAS'}),
+                    [fits.Header({'GAIN': 1.0}), fits.Header({'GAIN': 2.0})])
+    accumulator.add('frame3.fits.fz', data, None, fits.Header())
+    assert accumulator.names() == ['frame1.fits.fz', 'frame2.fits.fz', 'frame3.fits.fz']
+
+    read_data, read_bpm, header, extension_headers = accumulator.read('frame2.fits.fz')
+    np.testing.assert_array_equal(read_data, data + 1)
+    assert read_data.dtype == np.float32
+    np.testing.assert_array_equal(read_bpm, bpm.astype(np.uint8))
+    assert isinstance(read_data, np.memmap)
+    assert header['OBSTYPE'] == 'BIAS'
+    assert [extension_header['GAIN'] for extension_header in extension_headers] == [1.0, 2.0]
+    assert accumulator.read('frame1.fits.fz')[3] == []
+    assert accumulator.read('frame3.fits.fz')[1] is None
+
+
+def test_adding_a_frame_again_replaces_it(tmpdir):
+    accumulator = FrameAccumulator(str(tmpdir.join('accumulator')))
+    bpm = np.zeros((3, 4), dtype=np.uint8)
+    accumulator.add('frame1.fits', np.zeros((3, 4)), bpm, fits.Header())
+    accumulator.add('frame1.fits', np.ones((3, 4)), bpm, fits.Header())
+    assert accumulator.names() == ['frame1.fits']
+    np.testing.assert_array_equal(accumulator.read('frame1.fits')[0], np.ones((3, 4)))
+    assert len([f for f in os.listdir(accumulator.directory) if f.endswith('data.npy')]) == 1
+
+
+def test_remove_old_accumulators(tmpdir):
+    bpm = np.zeros((3, 4), dtype=np.uint8)
+    for name in ['old', 'new']:
+        FrameAccumulator(str(tmpdir.join(name))).add('frame.fits', np.zeros((3, 4)), bpm, fits.Header())
+    os.utime(str(tmpdir.join('old')), (0, 0))
+    remove_old_accumulators(str(tmpdir), 3600)
+    assert [os.path.basename(accumulator.directory) for accumulator in get_accumulators(str(tmpdir))] == ['new']
+
+
+def test_discarded_frames_are_deleted(tmpdir):
+    accumulator = FrameAccumulator(str(tmpdir.join('accumulator')))
+    bpm = np.zeros((3, 4), dtype=np.uint8)
+    for i in range(3):
+        accumulator.add('frame{i}.fits'.format(i=i), np.full((3, 4), i), bpm, fits.Header())
+    accumulator.discard(['frame0.fits', 'frame2.fits', 'other.fits'])
+    assert accumulator.names() == ['frame1.fits']
+    assert sorted(os.listdir(accumulator.directory)) == ['.lock', '0001.bpm.npy', '0001.data.npy',
+                                                         '0001.header0.txt', 'frames.json']
+    # New frames do not reuse the index of a frame that is still there
+    accumulator.add('frame3.fits', np.full((3, 4), 3), bpm, fits.Header())
+    np.testing.assert_array_equal(accumulator.read('frame1.fits')[0], np.full((3, 4), 1))
+    accumulator.discard(['frame1.fits', 'frame3.fits'])
+    assert not os.path.exists(accumulator.directory)
+
+
+@mock.patch('banzai.utils.accumulator_utils.fcntl', None)
+def test_frames_are_not_accumulated_without_file_locking(tmpdir):
+    with pytest.raises(OSError):
+        FrameAccumulator(str(tmpdir)).add('frame.fits', np.zeros((3, 4)), None, fits.Header())
@@ -1,3 +1,4 @@
+import mock
 import pytest
 import numpy as np
 
@@ -45,3 +46,16 @@ def test_bias_master_level_subtraction_is_reasonable(set_random_seed):
 
     np.testing.assert_allclose(np.zeros(image.data.shape), image.data, atol=8 * read_noise)
     np.testing.assert_allclose(image.header.get('BIASLVL'), input_bias, atol=1.0)
+
+
+@mock.patch('banzai.bias.settings.BIAS_LEVEL_STANDARD_ERROR', 0.5)
+def test_bias_master_level_from_subsample(set_random_seed):
+    input_bias = 2000.0
+    read_noise = 15.0
+
+    subtractor = BiasMasterLevelSubtractor(None)
+    image = FakeImage(nx=1000, ny=1000)
+    image.data = np.random.normal(input_bias, read_noise, size=(image.ny, image.nx)).astype(np.float32)
+    image = subtractor.do_stage(image)
+
+    np.testing.assert_allclose(image.header.get('BIASLVL'), input_bias, atol=4 * 0.5)
@@ -0,0 +1,77 @@
+import mock
+
+from banzai.utils.cache_utils import LRUCache, TTLCache
+
+
+def test_get_missing_returns_default():
+    cache = LRUCache(10)
+    assert cache.get('a') is None
+    assert cache.get('a', 5) == 5
+    assert cache.misses == 2
+    assert cache.hits == 0
+
+
+def test_least_recently_used_is_evicted():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert 'c' in cache
+    assert cache.hits == 1
+
+
+def test_evicts_until_under_budget():
+    cache = LRUCache(10, size_function=len)
+    cache.put('a', 'x' * 4)
+    cache.put('b', 'x' * 4)
+    cache.put('c', 'x' * 8)
+    assert len(cache) == 1
+    assert cache.size == 8
+
+
+def test_items_larger_than_budget_are_not_cached():
+    cache = LRUCache(3, size_function=len)
+    cache.put('a', 'xxxx')
+    assert 'a' not in cache
+    assert cache.size == 0
+
+
+def test_nothing_is_cached_without_a_budget():
+    cache = LRUCache(0, size_function=len)
+    cache.put('a', '')
+    assert 'a' not in cache
+
+
+def test_put_replaces_existing_item():
+    cache = LRUCache(10, size_function=len)
+    cache.put('a', 'xxxx')
+    cache.put('a', 'xx')
+    assert cache.get('a') == 'xx'
+    assert cache.size == 2
+
+
+def test_pop_and_clear():
+    cache = LRUCache(10)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.pop('a') == 1
+    assert cache.pop('a') is None
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+def test_ttl_cache_expires_items():
+    cache = TTLCache(10)
+    with mock.patch('banzai.utils.cache_utils.time.monotonic', return_value=100.0):
+        cache.put('a', 1)
+        cache.put('b', 2, ttl=1)
+    with mock.patch('banzai.utils.cache_utils.time.monotonic', return_value=105.0):
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+    with mock.patch('banzai.utils.cache_utils.time.monotonic', return_value=111.0):
+        assert cache.get('a', 'expired') == 'expired'
+    assert len(cache) == 0
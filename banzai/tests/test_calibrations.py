@@ -0,0 +1,181 @@
+import mock
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from banzai import calibrations
+from banzai.utils import fits_utils, image_utils, accumulator_utils
+from banzai.utils.shared_memory_utils import SharedArrayStore
+from banzai.tests.utils import FakeContext, FakeImage
+
+
+@pytest.fixture
+def master_file(tmpdir):
+    calibrations.MASTER_CALIBRATION_CACHE.clear()
+    filename = tmpdir.join('master.fits')
+    filename.write('master')
+    yield str(filename)
+    calibrations.MASTER_CALIBRATION_CACHE.clear()
+
+
+@mock.patch('banzai.calibrations.FRAME_CLASS')
+def test_master_calibration_is_read_once(mock_frame, master_file):
+    mock_frame.side_effect = lambda *args, **kwargs: FakeImage()
+    first_image = calibrations.read_master_calibration_image(master_file, FakeContext())
+    second_image = calibrations.read_master_calibration_image(master_file, FakeContext())
+    assert first_image is second_image
+    assert mock_frame.call_count == 1
+    assert not first_image.data.flags.writeable
+    assert not first_image.bpm.flags.writeable
+
+
+@mock.patch('banzai.calibrations.FRAME_CLASS')
+def test_master_calibration_is_reread_if_file_changes(mock_frame, master_file):
+    mock_frame.side_effect = lambda *args, **kwargs: FakeImage()
+    first_image = calibrations.read_master_calibration_image(master_file, FakeContext())
+    with open(master_file, 'w') as f:
+        f.write('new master')
+    second_image = calibrations.read_master_calibration_image(master_file, FakeContext())
+    assert first_image is not second_image
+    assert mock_frame.call_count == 2
+
+
+@mock.patch('banzai.calibrations.FRAME_CLASS')
+def test_missing_master_calibration_is_not_cached(mock_frame, tmpdir):
+    mock_frame.side_effect = lambda *args, **kwargs: FakeImage()
+    filename = str(tmpdir.join('missing.fits'))
+    calibrations.read_master_calibration_image(filename, FakeContext())
+    calibrations.read_master_calibration_image(filename, FakeContext())
+    assert mock_frame.call_count == 2
+    assert calibrations.MASTER_CALIBRATION_CACHE.size == 0
+
+
+@mock.patch('banzai.calibrations.FRAME_CLASS')
+def test_master_calibration_from_shared_memory(mock_frame, tmpdir):
+    calibrations.MASTER_CALIBRATION_CACHE.clear()
+    data = np.random.normal(size=(2, 11, 13)).astype(np.float32)
+    bpm = np.random.randint(0, 2, size=(2, 11, 13)).astype(np.uint8)
+    filename = str(tmpdir.join('master.fits'))
+    fits.HDUList([fits.PrimaryHDU(header=fits.Header({'OBSTYPE': 'BIAS'})),
+                  fits.ImageHDU(data=data[0], header=fits.Header({'GAIN': 1.0}), name='SCI'),
+                  fits.ImageHDU(data=data[1], header=fits.Header({'GAIN': 2.0}), name='SCI'),
+                  fits.ImageHDU(data=bpm, name='BPM')]).writeto(filename)
+    mock_frame.side_effect = lambda *args, **kwargs: FakeImage(**kwargs)
+    store = SharedArrayStore(str(tmpdir.join('shm')), 1024 ** 2)
+    with mock.patch('banzai.calibrations.SHARED_CALIBRATION_STORE', store):
+        stored_image = calibrations.read_master_calibration_image(filename, FakeContext())
+        calibrations.MASTER_CALIBRATION_CACHE.clear()
+        # Read again from the arrays in the store
+        master_image = calibrations.read_master_calibration_image(filename, FakeContext())
+    calibrations.MASTER_CALIBRATION_CACHE.clear()
+
+    _, expected_header, _, expected_extension_headers = fits_utils.open_image(filename)
+    for image in [stored_image, master_image]:
+        np.testing.assert_array_equal(image.data, data)
+        np.testing.assert_array_equal(image.bpm, bpm)
+        assert image.header == expected_header
+        assert image.extension_headers == expected_extension_headers
+        assert [header['GAIN'] for header in image.extension_headers] == [1.0, 2.0]
+        assert image.filename == 'master.fits'
+    assert len(store.entries()) == 1
+
+
+@mock.patch('banzai.calibrations.FRAME_CLASS')
+def test_only_masters_in_memory_count_towards_the_cache_budget(mock_frame, tmpdir):
+    calibrations.MASTER_CALIBRATION_CACHE.clear()
+    data = np.random.normal(size=(11, 13)).astype(np.float32)
+    bpm = np.zeros((11, 13), dtype=np.uint8)
+    mapped_filename = str(tmpdir.join('mapped.fits'))
+    fits.HDUList([fits.PrimaryHDU(data=data), fits.ImageHDU(data=bpm, name='BPM')]).writeto(mapped_filename)
+    in_memory_filename = str(tmpdir.join('in_memory.fits'))
+    fits.HDUList([fits.PrimaryHDU(data=data.astype(np.float64)),
+                  fits.ImageHDU(data=bpm, name='BPM')]).writeto(in_memory_filename)
+
+    def read_frame(runtime_context, filename=None, memmap=False):
+        frame_data, _, frame_bpm, _ = fits_utils.open_image(filename, memmap=memmap)
+        return FakeImage(data=frame_data, bpm=frame_bpm)
+    mock_frame.side_effect = read_frame
+
+    # float32 data and the uint8 bpm stay memory mapped, so only take page cache, not process memory
+    calibrations.read_master_calibration_image(mapped_filename, FakeContext())
+    assert calibrations.MASTER_CALIBRATION_CACHE.size == 0
+    # float64 data has to be converted to an array in memory
+    calibrations.read_master_calibration_image(in_memory_filename, FakeContext())
+    assert calibrations.MASTER_CALIBRATION_CACHE.size == data.nbytes
+    assert len(calibrations.MASTER_CALIBRATION_CACHE) == 2
+    calibrations.MASTER_CALIBRATION_CACHE.clear()
+
+
+def test_stacking_in_bands_matches_stacking_at_once():
+    np.random.seed(2384)
+    images = []
+    for i in range(7):
+        image = FakeImage(nx=31, ny=29, data=np.random.normal(100.0, 10.0, size=(29, 31)).astype(np.float32))
+        image.bpm = (np.random.uniform(size=(29, 31)) < 0.1).astype(np.uint8)
+        images.append(image)
+    expected = calibrations.stack_images(images, 1024 ** 3)
+    # Small enough that every band is a few rows and the last band is partial
+    actual = calibrations.stack_images(images, 31 * 7 * 5 * 4)
+    np.testing.assert_array_equal(actual, expected)
+    assert actual.shape == (29, 31)
+
+
+@mock.patch('banzai.calibrations.image_utils.read_image')
+def test_read_calibration_images_keeps_order_and_drops_failures(mock_read_image):
+    def read_image(path, *args, **kwargs):
+        if path == 'bad.fits':
+            return None
+        image = FakeImage()
+        image.filename = path
+        return image
+    mock_read_image.side_effect = read_image
+    image_paths = ['1.fits', '2.fits', 'bad.fits', '3.fits', '4.fits']
+    images = calibrations.read_calibration_images(image_paths, FakeContext())
+    assert [image.filename for image in images] == ['1.fits', '2.fits', '3.fits', '4.fits']
+    assert all(call[1]['memmap'] for call in mock_read_image.call_args_list)
+
+
+@mock.patch('banzai.images.dbs.get_instrument')
+def test_accumulated_frames_are_the_frames_in_memory(mock_instrument, tmpdir):
+    mock_instrument.return_value = mock.Mock(site='coj', camera='kb97', type='0m4-SciCam-SBIG')
+    np.random.seed(91275)
+    data = np.random.normal(1000.0, 30.0, size=(103, 101)).astype(np.float32)
+    bpm = np.zeros(data.shape, dtype=np.uint8)
+    bpm[5, 7] = 1
+    header = fits.Header({'SITEID': 'coj', 'INSTRUME': 'kb97', 'OBSTYPE': 'BIAS', 'GAIN': 1.0, 'SATURATE': 0.0,
+                          'NAXIS1': 101, 'NAXIS2': 103})
+    hdu_list = fits_utils.pack(fits.HDUList([fits.PrimaryHDU(data=data, header=header),
+                                             fits.ImageHDU(data=bpm, name='BPM')]))
+    filepath = str(tmpdir.join('bias-0001.fits.fz'))
+    hdu_list.writeto(filepath)
+    image = mock.Mock(filename='bias-0001.fits.fz', obstype='BIAS', epoch='20160101', is_bad=False,
+                      instrument=mock.Mock(id=1), data=data, bpm=bpm, header=header)
+    runtime_context = FakeContext(frame_class='banzai.images.Image')
+    with mock.patch('banzai.calibrations.settings.CALIBRATION_ACCUMULATOR_DIRECTORY', str(tmpdir.join('acc'))):
+        with mock.patch('banzai.calibrations.fits_utils.open_image') as mock_open_image:
+            calibrations.accumulate_calibration_frame(image, runtime_context)
+        # The written file is not read back
+        mock_open_image.assert_not_called()
+        with mock.patch('banzai.calibrations.image_utils.read_image') as mock_read_image:
+            images = calibrations.read_calibration_images([filepath, str(tmpdir.join('bias-0002.fits.fz'))],
+                                                          runtime_context)
+        mock_read_image.assert_called_once()
+        assert mock_read_image.call_args[0][0] == str(tmpdir.join('bias-0002.fits.fz'))
+
+        # The accumulated frame is the data in memory, not quantized like the file, munged as if read from disk
+        image_on_disk = image_utils.read_image(filepath, runtime_context, memmap=True)
+        np.testing.assert_array_equal(images[0].data, data)
+        assert not np.array_equal(image_on_disk.data, data)
+        np.testing.assert_allclose(images[0].data, image_on_disk.data, atol=1.0)
+        np.testing.assert_array_equal(images[0].bpm, image_on_disk.bpm)
+        assert images[0].header['SATURATE'] == image_on_disk.header['SATURATE'] == 64000.0
+        assert (images[0].nx, images[0].ny) == (image_on_disk.nx, image_on_disk.ny) == (101, 103)
+        assert images[0].filename == image_on_disk.filename == 'bias-0001.fits'
+
+        # The frames are not kept once they have been stacked
+        master = mock.Mock()
+        with mock.patch('banzai.calibrations.import_utils.import_attribute') as mock_stage:
+            mock_stage.return_value.return_value.run.return_value = [master]
+            calibrations.run_master_maker([filepath], runtime_context, 'BIAS')
+        master.write.assert_called_once()
+        assert accumulator_utils.get_accumulators(str(tmpdir.join('acc'))) == []
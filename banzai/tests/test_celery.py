@@ -5,8 +5,10 @@ from datetime import datetime, timedelta
 from unittest.mock import ANY
 
 from celery.exceptions import Retry
+from celery.signals import worker_init
 
-from banzai.celery import stack_calibrations, schedule_calibration_stacking
+from banzai.celery import stack_calibrations, schedule_calibration_stacking, check_stage_settings
+from banzai.exceptions import PipelineConfigurationException
 from banzai.settings import CALIBRATION_STACK_DELAYS
 from banzai.utils import date_utils
 from banzai.context import Context
@@ -232,3 +234,12 @@ class TestMain():
             stack_calibrations(self.min_date, self.max_date, 1, self.frame_type, self.context,
                                [self.fake_blocks_response_json['results'][0]])
         assert e.type is Retry
+
+
+@mock.patch('banzai.celery.validate_stage_settings')
+def test_worker_exits_when_the_stages_are_misconfigured(mock_validate):
+    check_stage_settings()
+    mock_validate.side_effect = PipelineConfigurationException('banzai.dark.NoSuchStage cannot be imported')
+    # Celery only logs exceptions from signal handlers, so the worker has to exit itself
+    with pytest.raises(SystemExit):
+        worker_init.send(sender=None)
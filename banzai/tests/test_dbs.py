@@ -1,11 +1,18 @@
 import os
+import time
+import datetime
 
 import mock
+import pytest
+from sqlalchemy import create_engine, inspect, pool, event
 
 from banzai import dbs
 from banzai.tests.utils import FakeResponse
 from astropy.utils.data import get_pkg_data_filename
 
+md5_hash1 = '49a6bb35cdd3859224c0214310b1d9b6'
+md5_hash2 = 'aec5ef355e7e43a59fedc88ac95caed6'
+
 
 @mock.patch('banzai.dbs.requests.get', return_value=FakeResponse(get_pkg_data_filename('data/configdb_example.json',
                                                                                        'banzai.tests')))
@@ -92,3 +99,254 @@ def test_standby_marked_schedulable():
     instrument = dbs.query_for_instrument(db_address='sqlite:///test.db', site='coj', camera='kb98')
     assert instrument.name == 'kb98'
     assert instrument.schedulable == True
+
+
+def test_get_instrument_is_cached():
+    dbs.invalidate_instrument_cache()
+    header = {'SITEID': 'coj', 'INSTRUME': 'kb98'}
+    instrument = dbs.get_instrument(header, db_address='sqlite:///test.db')
+    with mock.patch('banzai.dbs.query_for_instrument') as mock_query:
+        assert dbs.get_instrument(header, db_address='sqlite:///test.db') is instrument
+        mock_query.assert_not_called()
+
+
+@mock.patch('banzai.dbs.populate_instrument_tables')
+def test_get_instrument_caches_missing_instruments(mock_populate):
+    dbs.invalidate_instrument_cache()
+    dbs._LAST_CONFIGDB_REFRESH.clear()
+    header = {'SITEID': 'coj', 'INSTRUME': 'missing-camera'}
+    with mock.patch('banzai.dbs.query_for_instrument', return_value=None) as mock_query:
+        for i in range(2):
+            with pytest.raises(ValueError):
+                dbs.get_instrument(header, db_address='sqlite:///test.db')
+        assert mock_query.call_count == 3
+    assert mock_populate.call_count == 1
+
+
+def test_add_instrument_invalidates_instrument_cache():
+    dbs.invalidate_instrument_cache()
+    header = {'SITEID': 'coj', 'INSTRUME': 'kb98'}
+    dbs.get_instrument(header, db_address='sqlite:///test.db')
+    with dbs.get_session(db_address='sqlite:///test.db') as db_session:
+        dbs.add_instrument({'site': 'coj', 'enclosure': 'clma', 'telescope': '0m4a', 'camera': 'kb98',
+                            'name': 'kb98', 'type': 'SBig', 'schedulable': True}, db_session)
+    with mock.patch('banzai.dbs.query_for_instrument') as mock_query:
+        dbs.get_instrument(header, db_address='sqlite:///test.db')
+        mock_query.assert_called()
+
+
+def test_engine_is_reused():
+    engine, session_factory = dbs.get_engine('sqlite:///test.db')
+    assert dbs.get_engine('sqlite:///test.db')[0] is engine
+    assert dbs.get_engine('sqlite:///other.db')[0] is not engine
+
+
+def test_connections_of_other_processes_are_not_used_or_closed():
+    engine = create_engine('sqlite:///test.db', poolclass=pool.QueuePool)
+    dbs._add_process_guard(engine)
+    with engine.connect() as connection:
+        parent_connection = connection.connection.connection
+    # Pretend we are a forked child with the parent's connection in the pool
+    with mock.patch('banzai.dbs.os.getpid', return_value=-1):
+        with engine.connect() as connection:
+            child_connection = connection.connection.connection
+            assert connection.execute('SELECT 1').scalar() == 1
+    assert child_connection is not parent_connection
+    assert parent_connection.execute('SELECT 1').fetchone()[0] == 1
+
+
+def test_locks_are_reset_after_fork():
+    # A lock held by another thread when the process forked must not deadlock the child
+    held_lock = dbs._ENGINES_LOCK
+    held_lock.acquire()
+    try:
+        dbs._reset_locks_after_fork()
+        assert dbs.get_engine('sqlite:///test.db') is not None
+    finally:
+        held_lock.release()
+
+
+def test_get_master_calibration_image_picks_closest_date():
+    instrument = dbs.query_for_instrument(db_address='sqlite:///test.db', site='coj', camera='kb98')
+    with dbs.get_session(db_address='sqlite:///test.db') as db_session:
+        for day, filter_name in [(1, 'rp'), (10, 'rp'), (14, 'V'), (20, 'rp')]:
+            attributes = {'configuration_mode': 'full_frame', 'ccdsum': '2 2', 'filter': filter_name}
+            record = {'type': 'SKYFLAT', 'filename': 'flat-{0}.fits'.format(day), 'filepath': '/tmp',
+                      'dateobs': datetime.datetime(2020, 1, day), 'datecreated': datetime.datetime(2020, 1, day),
+                      'instrument_id': instrument.id, 'is_master': True, 'is_bad': False, 'attributes': attributes}
+            record.update(dbs.calibration_attribute_columns(attributes))
+            dbs.add_or_update_record(db_session, dbs.CalibrationImage, {'filename': record['filename']}, record)
+    image = mock.Mock(instrument=instrument, configuration_mode='full_frame', ccdsum='2 2', filter='rp',
+                      dateobs=datetime.datetime(2020, 1, 14))
+    criteria = ['configuration_mode', 'ccdsum', 'filter']
+    calibration_file = dbs.get_master_calibration_image(image, 'skyflat', criteria, db_address='sqlite:///test.db')
+    assert calibration_file == '/tmp/flat-10.fits'
+    image.dateobs = datetime.datetime(2020, 1, 16)
+    calibration_file = dbs.get_master_calibration_image(image, 'skyflat', criteria, db_address='sqlite:///test.db')
+    assert calibration_file == '/tmp/flat-20.fits'
+    image.ccdsum = '1 1'
+    assert dbs.get_master_calibration_image(image, 'skyflat', criteria, db_address='sqlite:///test.db') is None
+
+
+@pytest.mark.parametrize('calibration_type, criteria, index_name',
+                         [('BIAS', ['configuration_mode', 'ccdsum'], 'ix_calimages_unfiltered_master_lookup'),
+                          ('SKYFLAT', ['configuration_mode', 'ccdsum', 'filter'], 'ix_calimages_master_lookup')])
+def test_master_calibration_lookup_seeks_on_dateobs(calibration_type, criteria, index_name):
+    engine, _ = dbs.get_engine('sqlite:///test.db')
+    statements = []
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        if 'FROM calimages' in statement:
+            statements.append((statement, parameters))
+    event.listen(engine, 'before_cursor_execute', record_statement)
+    try:
+        image = mock.Mock(instrument=mock.Mock(id=1), configuration_mode='full_frame', ccdsum='2 2', filter='rp',
+                          dateobs=datetime.datetime(2020, 1, 14))
+        dbs.get_master_calibration_image(image, calibration_type, criteria, db_address='sqlite:///test.db')
+    finally:
+        event.remove(engine, 'before_cursor_execute', record_statement)
+    assert len(statements) == 2
+    for statement, parameters in statements:
+        plan = ' '.join(str(row[-1]) for row in engine.execute('EXPLAIN QUERY PLAN ' + statement, parameters))
+        # An equality on every selected column and a range on dateobs means a seek rather than a scan, and the
+        # index order means no sort is needed to find the closest date
+        assert 'USING INDEX {index_name} '.format(index_name=index_name) in plan
+        assert 'dateobs' in plan.split('USING INDEX')[1]
+        assert 'TEMP B-TREE' not in plan
+
+
+def test_migrate_calibration_attribute_columns():
+    engine = create_engine('sqlite:///migrate.db')
+    engine.execute('CREATE TABLE calimages (id INTEGER PRIMARY KEY, type VARCHAR(50), filename VARCHAR(100), '
+                   'filepath VARCHAR(150), dateobs DATETIME, datecreated DATETIME, instrument_id INTEGER, '
+                   'is_master BOOLEAN, is_bad BOOLEAN, attributes JSON)')
+    engine.execute('INSERT INTO calimages (type, filename, attributes) '
+                   'VALUES (\'BIAS\', \'bias.fits\', \'{"ccdsum": "2 2", "configuration_mode": "full_frame"}\')')
+    try:
+        dbs.migrate_calibration_attribute_columns(db_address='sqlite:///migrate.db')
+        with dbs.get_session(db_address='sqlite:///migrate.db') as db_session:
+            calibration_image = db_session.query(dbs.CalibrationImage).one()
+        assert calibration_image.ccdsum == '2 2'
+        assert calibration_image.configuration_mode == 'full_frame'
+        assert calibration_image.filter is None
+        index_names = [index['name'] for index in inspect(engine).get_indexes('calimages')]
+        assert 'ix_calimages_master_lookup' in index_names
+        assert 'ix_calimages_unfiltered_master_lookup' in index_names
+    finally:
+        os.remove('migrate.db')
+
+
+def test_claim_processed_image():
+    db_address = 'sqlite:///test.db'
+    # A new frame is claimed and the attempt is counted
+    assert dbs.claim_processed_image('/tmp/claim.fits', md5_hash1, 2, db_address=db_address)
+    assert dbs.claim_processed_image('/tmp/claim.fits', md5_hash1, 2, db_address=db_address)
+    # Stop once we reach the maximum number of tries
+    assert not dbs.claim_processed_image('/tmp/claim.fits', md5_hash1, 2, db_address=db_address)
+    # A changed file resets the number of tries
+    assert dbs.claim_processed_image('/tmp/claim.fits', md5_hash2, 2, db_address=db_address)
+    dbs.mark_processed_image_as_successful('/tmp/claim.fits', db_address=db_address)
+    assert not dbs.claim_processed_image('/tmp/claim.fits', md5_hash2, 2, db_address=db_address)
+    with dbs.get_session(db_address=db_address) as db_session:
+        processed_images = db_session.query(dbs.ProcessedImage).filter(dbs.ProcessedImage.filename == 'claim.fits')
+        processed_images = processed_images.all()
+    assert len(processed_images) == 1
+    assert processed_images[0].tries == 1
+    assert processed_images[0].success
+
+
+def test_migrate_processed_image_filename_index():
+    engine = create_engine('sqlite:///migrate.db')
+    engine.execute('CREATE TABLE processedimages (id INTEGER PRIMARY KEY, filename VARCHAR(100), '
+                   'checksum CHAR(32), success BOOLEAN, tries INTEGER)')
+    engine.execute('CREATE INDEX ix_processedimages_filename ON processedimages (filename)')
+    engine.execute('CREATE INDEX ix_processedimages_checksum ON processedimages (checksum)')
+    for tries in range(3):
+        engine.execute('INSERT INTO processedimages (filename, checksum, success, tries) '
+                       'VALUES (\'a.fits\', \'{0}\', 0, {1})'.format(md5_hash1, tries))
+    try:
+        dbs.migrate_processed_image_filename_index(db_address='sqlite:///migrate.db')
+        dbs.migrate_processed_image_filename_index(db_address='sqlite:///migrate.db')
+        with dbs.get_session(db_address='sqlite:///migrate.db') as db_session:
+            processed_image = db_session.query(dbs.ProcessedImage).one()
+        assert processed_image.tries == 2
+        indexes = {index['name']: index['unique'] for index in inspect(engine).get_indexes('processedimages')}
+        assert indexes['ix_processedimages_filename']
+    finally:
+        os.remove('migrate.db')
+
+
+@mock.patch('banzai.dbs.populate_instrument_tables')
+def test_instrument_table_refreshes_are_rate_limited(mock_populate):
+    dbs._LAST_CONFIGDB_REFRESH.clear()
+    assert dbs.refresh_instrument_tables(db_address='sqlite:///test.db')
+    assert not dbs.refresh_instrument_tables(db_address='sqlite:///test.db')
+    assert mock_populate.call_count == 1
+    with mock.patch('banzai.dbs.time.monotonic', return_value=time.monotonic() + 3600):
+        assert dbs.refresh_instrument_tables(db_address='sqlite:///test.db')
+    assert mock_populate.call_count == 2
+
+
+@mock.patch('banzai.dbs.populate_instrument_tables', side_effect=ConnectionError)
+def test_failed_instrument_table_refresh_does_not_raise(mock_populate):
+    dbs._LAST_CONFIGDB_REFRESH.clear()
+    assert dbs.refresh_instrument_tables(db_address='sqlite:///test.db')
+
+
+@mock.patch('banzai.dbs.settings.CONFIGDB_BACKGROUND_REFRESH', True)
+@mock.patch('banzai.dbs.refresh_instrument_tables', return_value=True)
+def test_get_instrument_does_not_wait_for_background_refresh(mock_refresh):
+    dbs.invalidate_instrument_cache()
+    header = {'SITEID': 'coj', 'INSTRUME': 'missing-camera'}
+    with mock.patch('banzai.dbs.query_for_instrument', return_value=None) as mock_query:
+        with pytest.raises(ValueError):
+            dbs.get_instrument(header, db_address='sqlite:///test.db')
+        assert mock_query.call_count == 2
+    assert mock_refresh.call_args[1]['background']
+
+
+@mock.patch('banzai.dbs.settings.CONFIGDB_BACKGROUND_REFRESH', True)
+@mock.patch('banzai.dbs.refresh_instrument_tables')
+def test_background_refresh_that_finishes_first_is_not_hidden_by_the_miss(mock_refresh):
+    dbs.invalidate_instrument_cache()
+
+    # A background refresh that completes before get_instrument returns
+    def refresh_instrument_tables(*args, **kwargs):
+        dbs.invalidate_instrument_cache()
+        return True
+    mock_refresh.side_effect = refresh_instrument_tables
+    header = {'SITEID': 'coj', 'INSTRUME': 'new-camera'}
+    with mock.patch('banzai.dbs.query_for_instrument', return_value=None):
+        with pytest.raises(ValueError):
+            dbs.get_instrument(header, db_address='sqlite:///test.db')
+    instrument = mock.MagicMock()
+    with mock.patch('banzai.dbs.query_for_instrument', return_value=instrument):
+        assert dbs.get_instrument(header, db_address='sqlite:///test.db') is instrument
+
+
+def test_bulk_add_or_update_records():
+    with dbs.get_session(db_address='sqlite:///test.db') as db_session:
+        records = [{'id': 'aaa', 'timezone': 1}, {'id': 'bbb', 'timezone': 2}]
+        assert dbs.bulk_add_or_update_records(db_session, dbs.Site, ['id'], records) == (2, 0)
+    with dbs.get_session(db_address='sqlite:///test.db') as db_session:
+        records = [{'id': 'aaa', 'timezone': 1}, {'id': 'bbb', 'timezone': 3}, {'id': 'ccc', 'timezone': 4}]
+        assert dbs.bulk_add_or_update_records(db_session, dbs.Site, ['id'], records) == (1, 1)
+    with dbs.get_session(db_address='sqlite:///test.db') as db_session:
+        query = db_session.query(dbs.Site).filter(dbs.Site.id.in_(['aaa', 'bbb', 'ccc']))
+        assert {site.id: site.timezone for site in query} == {'aaa': 1, 'bbb': 3, 'ccc': 4}
+        query.delete(synchronize_session=False)
+
+
+@mock.patch('banzai.dbs.requests.get', return_value=FakeResponse(get_pkg_data_filename('data/configdb_example.json',
+                                                                                       'banzai.tests')))
+def test_populate_instrument_tables_marks_missing_instruments_unschedulable(mock_requests):
+    with dbs.get_session(db_address='sqlite:///test.db') as db_session:
+        n_instruments = db_session.query(dbs.Instrument).count()
+        dbs.add_instrument({'site': 'coj', 'enclosure': 'doma', 'telescope': '1m0a', 'camera': 'old-camera',
+                            'name': 'old-camera', 'type': 'SBig', 'schedulable': True}, db_session)
+    dbs.populate_instrument_tables(db_address='sqlite:///test.db')
+    with dbs.get_session(db_address='sqlite:///test.db') as db_session:
+        assert db_session.query(dbs.Instrument).count() == n_instruments + 1
+        old_camera = db_session.query(dbs.Instrument).filter(dbs.Instrument.camera == 'old-camera').one()
+        assert not old_camera.schedulable
+        db_session.delete(old_camera)
@@ -1,4 +1,9 @@
+import gc
+import os
+
+import mock
 import numpy as np
+import pytest
 from astropy.table import Table
 from astropy.io import fits
 
@@ -72,3 +77,149 @@ def test_open_image():
         # Read an image with a single extension and a datacube
         # Read an image with multiple sci extensions
         pass
+
+
+def test_open_image_fpacked(tmpdir):
+    data = np.random.randint(0, 65535, size=(103, 101)).astype(np.uint16)
+    bpm = np.random.randint(0, 2, size=(103, 101)).astype(np.uint8)
+    # Compress a primary HDU the same way fpack does so the header is restored as the primary header
+    header = fits.PrimaryHDU(data=data, header=fits.Header({'OBSTYPE': 'BIAS'})).header
+    hdulist = fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data=data, header=header, name='SCI'),
+                            fits.CompImageHDU(data=bpm, name='BPM')])
+    filename = str(tmpdir.join('test.fits.fz'))
+    hdulist.writeto(filename)
+
+    image_data, image_header, image_bpm, extension_headers = fits_utils.open_image(filename)
+
+    assert image_header['OBSTYPE'] == 'BIAS'
+    assert image_data.dtype == np.float32
+    np.testing.assert_array_equal(image_data, data)
+    np.testing.assert_array_equal(image_bpm, bpm)
+    assert extension_headers == []
+
+
+def test_open_image_fpacked_multiple_extensions(tmpdir):
+    hdulist = [fits.PrimaryHDU(header=fits.Header({'OBSTYPE': 'EXPOSE'}))]
+    input_data = []
+    for i in range(4):
+        data = np.random.randint(0, 65535, size=(103, 101)).astype(np.uint16)
+        input_data.append(data)
+        header = fits.Header()
+        header['EXTNAME'] = 'SCI'
+        header['EXTVER'] = i + 1
+        header['GAIN'] = 1.0 + i
+        hdulist.append(fits.CompImageHDU(data=data, header=header))
+    filename = str(tmpdir.join('test.fits.fz'))
+    fits.HDUList(hdulist).writeto(filename)
+
+    image_data, image_header, image_bpm, extension_headers = fits_utils.open_image(filename)
+
+    assert image_header['OBSTYPE'] == 'EXPOSE'
+    assert image_bpm is None
+    assert image_data.shape == (4, 103, 101)
+    for i in range(4):
+        np.testing.assert_array_equal(image_data[i], input_data[i])
+        assert extension_headers[i]['GAIN'] == 1.0 + i
+
+
+def test_open_image_memmap_does_not_modify_file(tmpdir):
+    data = np.random.normal(size=(103, 101)).astype(np.float32)
+    bpm = np.random.randint(0, 2, size=(103, 101)).astype(np.uint8)
+    filename = str(tmpdir.join('test.fits'))
+    fits.HDUList([fits.PrimaryHDU(data=data), fits.ImageHDU(data=bpm, name='BPM')]).writeto(filename)
+
+    image_data, image_header, image_bpm, extension_headers = fits_utils.open_image(filename, memmap=True)
+
+    np.testing.assert_array_equal(image_data, data)
+    np.testing.assert_array_equal(image_bpm, bpm)
+    image_data -= 1.0
+    image_bpm |= 1
+    np.testing.assert_array_equal(fits.getdata(filename), data)
+    np.testing.assert_array_equal(fits.getdata(filename, 'BPM'), bpm)
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason='Needs /proc to list open files')
+def test_open_image_memmap_closes_the_file(tmpdir):
+    data = np.random.normal(size=(103, 101)).astype(np.float32)
+    bpm = np.random.randint(0, 2, size=(103, 101)).astype(np.uint8)
+    filenames = [str(tmpdir.join('test{i}.fits'.format(i=i))) for i in range(5)]
+    for filename in filenames:
+        fits.HDUList([fits.PrimaryHDU(data=data), fits.ImageHDU(data=bpm, name='BPM')]).writeto(filename)
+
+    def open_files():
+        open_filenames = []
+        for file_descriptor in os.listdir('/proc/self/fd'):
+            try:
+                open_filenames.append(os.readlink(os.path.join('/proc/self/fd', file_descriptor)))
+            except OSError:
+                continue
+        return [filename for filename in open_filenames if filename in filenames]
+
+    # Keep the HDULists alive, e.g. as if they were in a reference cycle, so they are not closed when collected
+    hdulists = []
+    fits_utils_open_fits_file = fits_utils.open_fits_file
+
+    def open_fits_file(*args, **kwargs):
+        hdulists.append(fits_utils_open_fits_file(*args, **kwargs))
+        return hdulists[-1]
+
+    with mock.patch('banzai.utils.fits_utils.open_fits_file', side_effect=open_fits_file):
+        images = [fits_utils.open_image(filename, memmap=True) for filename in filenames]
+    # Only the mappings themselves hold the files open, not the HDULists
+    assert len(open_files()) <= len(filenames)
+    for image_data, image_header, image_bpm, extension_headers in images:
+        np.testing.assert_array_equal(image_data, data)
+        np.testing.assert_array_equal(image_bpm, bpm)
+    hdulists.clear()
+    del images, image_data, image_bpm
+    gc.collect()
+    assert open_files() == []
+
+
+def test_to_float32_does_not_copy_big_endian_floats():
+    data = np.ones((10, 10), dtype='>f4')
+    assert fits_utils.to_float32(data, copy=False) is data
+    assert fits_utils.to_float32(data).dtype == np.float32
+    assert fits_utils.to_float32(data.astype('>i2'), copy=False).dtype == np.float32
+
+
+def test_get_primary_header_fpacked(tmpdir):
+    data = np.random.randint(0, 65535, size=(103, 101)).astype(np.uint16)
+    header = fits.PrimaryHDU(data=data, header=fits.Header({'OBSTYPE': 'BIAS', 'SITEID': 'lsc'})).header
+    filename = str(tmpdir.join('test.fits.fz'))
+    fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data=data, header=header)]).writeto(filename)
+
+    primary_header = fits_utils.get_primary_header(filename)
+
+    assert primary_header['OBSTYPE'] == 'BIAS'
+    assert primary_header['SITEID'] == 'lsc'
+    assert primary_header['NAXIS1'] == 101
+    assert primary_header['NAXIS2'] == 103
+    assert set(primary_header.keys()) == set(fits_utils.open_fits_file(filename)[0].header.keys())
+
+
+def test_get_primary_header_multiple_extensions(tmpdir):
+    hdulist = [fits.PrimaryHDU(header=fits.Header({'OBSTYPE': 'EXPOSE'}))]
+    for i in range(4):
+        header = fits.Header()
+        header['EXTNAME'] = 'SCI'
+        header['OBSTYPE'] = 'NOTPRIMARY'
+        hdulist.append(fits.CompImageHDU(data=np.zeros((11, 13), dtype=np.uint16), header=header))
+    filename = str(tmpdir.join('test.fits.fz'))
+    fits.HDUList(hdulist).writeto(filename)
+
+    assert fits_utils.get_primary_header(filename)['OBSTYPE'] == 'EXPOSE'
+
+
+def test_get_primary_header_missing_file(tmpdir):
+    assert fits_utils.get_primary_header(str(tmpdir.join('missing.fits'))) is None
+
+
+def test_stack_extensions():
+    extensions = [fits.ImageHDU(data=np.random.randint(0, 65535, size=(11, 13)).astype(np.uint16))
+                  for i in range(4)]
+    data = fits_utils.stack_extensions(extensions, np.float32)
+    assert data.dtype == np.float32
+    assert data.shape == (4, 11, 13)
+    for i in range(4):
+        np.testing.assert_array_equal(data[i], extensions[i].data)
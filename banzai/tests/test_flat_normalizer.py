@@ -1,3 +1,4 @@
+import mock
 import pytest
 import numpy as np
 
@@ -45,3 +46,13 @@ def test_flat_normalization_is_reasonable(set_random_seed):
     # Assume 50% slop because the variation in the pattern does not decrease like sqrt(n)
     assert np.abs(image.header['FLATLVL'] - input_level) < (3.0 * flat_variation * input_level / (nx * ny) ** 0.5)
     assert np.abs(np.mean(image.data) - 1.0) <= 3.0 * flat_variation / (nx * ny) ** 0.5
+
+
+@mock.patch('banzai.flats.settings.FLAT_NORMALIZATION_RELATIVE_ERROR', 1e-3)
+def test_flat_normalization_from_subsample(set_random_seed):
+    input_level = 10000.0
+    normalizer = FlatNormalizer(None)
+    image = FakeImage(nx=1000, ny=1000)
+    image.data = np.random.poisson(input_level, size=(image.ny, image.nx)).astype(np.float32)
+    image = normalizer.do_stage(image)
+    assert np.abs(image.header['FLATLVL'] - input_level) < 4 * 1e-3 * input_level
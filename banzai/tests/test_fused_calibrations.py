@@ -0,0 +1,184 @@
+import mock
+import pytest
+import numpy as np
+
+from banzai.bias import BiasSubtractor
+from banzai.dark import DarkSubtractor
+from banzai.flats import FlatDivider
+from banzai.fused_calibrations import FusedCalibrationApplier, apply_calibrations, BAND_SIZE
+from banzai.stages import BandStreamer
+from banzai.utils import stage_utils, fits_utils
+from banzai.tests.utils import FakeImage, FakeContext
+
+
+@pytest.fixture(scope='module')
+def set_random_seed():
+    np.random.seed(6234585)
+
+
+def _make_master(filename, data, bpm, **kwargs):
+    master = FakeImage(nx=data.shape[1], ny=data.shape[0], data=data, **kwargs)
+    master.bpm = bpm
+    master.filename = filename
+    return master
+
+
+def _make_masters(ny, nx):
+    masters = {'bias.fits': _make_master('bias.fits', np.random.normal(0.0, 10.0, size=(ny, nx)).astype(np.float32),
+                                         (np.random.uniform(size=(ny, nx)) < 0.01).astype(np.uint8)),
+               'dark.fits': _make_master('dark.fits', np.random.normal(0.1, 0.01, size=(ny, nx)).astype(np.float32),
+                                         (np.random.uniform(size=(ny, nx)) < 0.01).astype(np.uint8) * 2),
+               'flat.fits': _make_master('flat.fits', np.random.normal(1.0, 0.05, size=(ny, nx)).astype(np.float32),
+                                         (np.random.uniform(size=(ny, nx)) < 0.01).astype(np.uint8) * 4)}
+    masters['bias.fits'].header['BIASLVL'] = 503.7
+    return masters
+
+
+def test_apply_calibrations_matches_individual_operations(set_random_seed):
+    ny, nx = 517, 301
+    data = np.random.normal(1000.0, 30.0, size=(ny, nx)).astype(np.float32)
+    bpm = (np.random.uniform(size=(ny, nx)) < 0.01).astype(np.uint8) * 8
+    masters = _make_masters(ny, nx)
+    bias, dark, flat = masters['bias.fits'], masters['dark.fits'], masters['flat.fits']
+
+    expected_data = data.copy()
+    expected_data -= 503.7
+    expected_data -= bias.data
+    expected_data -= dark.data * 33.3
+    expected_data /= flat.data
+    expected_bpm = bpm | bias.bpm | dark.bpm | flat.bpm
+
+    apply_calibrations(data, bpm, bias_level=503.7, bias=bias.data, bias_bpm=bias.bpm, dark=dark.data,
+                       dark_bpm=dark.bpm, exptime=33.3, flat=flat.data, flat_bpm=flat.bpm, max_workers=3)
+    np.testing.assert_array_equal(data, expected_data)
+    np.testing.assert_array_equal(bpm, expected_bpm)
+
+
+def test_apply_calibrations_skips_missing_masters(set_random_seed):
+    data = np.random.normal(1000.0, 30.0, size=(50, 40)).astype(np.float32)
+    bpm = np.zeros(data.shape, dtype=np.uint8)
+    flat = np.random.normal(1.0, 0.05, size=data.shape).astype(np.float32)
+    expected_data = data / flat
+    apply_calibrations(data, bpm, flat=flat, flat_bpm=np.ones(data.shape, dtype=np.uint8))
+    np.testing.assert_array_equal(data, expected_data)
+    assert bpm.all()
+
+
+@mock.patch('banzai.calibrations.read_master_calibration_image')
+@mock.patch.object(FlatDivider, 'get_calibration_filename', return_value='flat.fits')
+@mock.patch.object(DarkSubtractor, 'get_calibration_filename', return_value='dark.fits')
+@mock.patch.object(BiasSubtractor, 'get_calibration_filename', return_value='bias.fits')
+def test_fused_stage_matches_individual_stages(mock_bias_filename, mock_dark_filename, mock_flat_filename,
+                                               mock_read_master, set_random_seed):
+    ny, nx = 103, 101
+    masters = _make_masters(ny, nx)
+    mock_read_master.side_effect = lambda filename, runtime_context: masters[filename]
+    data = np.random.normal(1000.0, 30.0, size=(ny, nx)).astype(np.float32)
+
+    expected_image = FakeImage(nx=nx, ny=ny, data=data.copy())
+    for stage in [BiasSubtractor, DarkSubtractor, FlatDivider]:
+        expected_image = stage(FakeContext()).do_stage(expected_image)
+
+    image = FusedCalibrationApplier(FakeContext()).do_stage(FakeImage(nx=nx, ny=ny, data=data.copy()))
+    np.testing.assert_array_equal(image.data, expected_image.data)
+    np.testing.assert_array_equal(image.bpm, expected_image.bpm)
+    for keyword in ['BIASLVL', 'L1IDBIAS', 'L1STATBI', 'L1IDDARK', 'L1STATDA', 'L1IDFLAT', 'L1STATFL']:
+        assert image.header[keyword] == expected_image.header[keyword]
+
+
+def _make_multi_amp_frame(n_amps, ny, nx, mock_read_master):
+    masters = _make_masters(n_amps * ny, nx)
+    for master in masters.values():
+        master.data = master.data.reshape(n_amps, ny, nx)
+        master.bpm = master.bpm.reshape(n_amps, ny, nx)
+        master.ny = ny
+    mock_read_master.side_effect = lambda filename, runtime_context: masters[filename]
+    data = np.random.normal(1000.0, 30.0, size=(n_amps, ny, nx)).astype(np.float32)
+
+    expected_image = FakeImage(nx=nx, ny=ny, data=data.copy(), bpm=np.zeros(data.shape, dtype=np.uint8))
+    for stage in [BiasSubtractor, DarkSubtractor, FlatDivider]:
+        expected_image = stage(FakeContext()).do_stage(expected_image)
+    image = FakeImage(nx=nx, ny=ny, data=data.copy(), bpm=np.zeros(data.shape, dtype=np.uint8))
+    return image, expected_image
+
+
+@mock.patch('banzai.calibrations.read_master_calibration_image')
+@mock.patch.object(FlatDivider, 'get_calibration_filename', return_value='flat.fits')
+@mock.patch.object(DarkSubtractor, 'get_calibration_filename', return_value='dark.fits')
+@mock.patch.object(BiasSubtractor, 'get_calibration_filename', return_value='bias.fits')
+def test_fused_stage_splits_multi_amp_frames_into_bands_of_rows(mock_bias_filename, mock_dark_filename,
+                                                                mock_flat_filename, mock_read_master,
+                                                                set_random_seed):
+    n_amps, ny, nx = 4, 517, 301
+    image, expected_image = _make_multi_amp_frame(n_amps, ny, nx, mock_read_master)
+    with mock.patch('banzai.fused_calibrations.fits_utils.map_in_threads',
+                    wraps=fits_utils.map_in_threads) as mock_map:
+        image = FusedCalibrationApplier(FakeContext()).do_stage(image)
+    # Bands of rows of every amplifier of about BAND_SIZE pixels, not one band per amplifier
+    bands = mock_map.call_args_list[0][0][1]
+    rows_per_band = BAND_SIZE // (n_amps * nx)
+    assert len(bands) == int(np.ceil(ny / rows_per_band))
+    assert all(band.stop - band.start == rows_per_band for band in bands)
+    np.testing.assert_array_equal(image.data, expected_image.data)
+    np.testing.assert_array_equal(image.bpm, expected_image.bpm)
+
+
+@mock.patch('banzai.calibrations.read_master_calibration_image')
+@mock.patch.object(FlatDivider, 'get_calibration_filename', return_value='flat.fits')
+@mock.patch.object(DarkSubtractor, 'get_calibration_filename', return_value='dark.fits')
+@mock.patch.object(BiasSubtractor, 'get_calibration_filename', return_value='bias.fits')
+def test_fused_stage_streams_bands_of_multi_amp_frames(mock_bias_filename, mock_dark_filename, mock_flat_filename,
+                                                       mock_read_master, set_random_seed):
+    n_amps, ny, nx = 4, 53, 47
+    image, expected_image = _make_multi_amp_frame(n_amps, ny, nx, mock_read_master)
+
+    # Bands of a few rows of every amplifier with a partial band at the end
+    streamer = BandStreamer(FakeContext(), [FusedCalibrationApplier(FakeContext())], 5 * n_amps * nx)
+    with mock.patch('banzai.fused_calibrations.apply_calibrations', wraps=apply_calibrations) as mock_apply:
+        image = streamer.do_stage(image)
+    assert [call[0][0].shape for call in mock_apply.call_args_list] == [(n_amps, 5, nx)] * 10 + [(n_amps, 3, nx)]
+    np.testing.assert_array_equal(image.data, expected_image.data)
+    np.testing.assert_array_equal(image.bpm, expected_image.bpm)
+
+
+@mock.patch('banzai.calibrations.read_master_calibration_image')
+@mock.patch.object(FlatDivider, 'get_calibration_filename', return_value='flat.fits')
+@mock.patch.object(DarkSubtractor, 'get_calibration_filename', return_value=None)
+@mock.patch.object(BiasSubtractor, 'get_calibration_filename', return_value='bias.fits')
+def test_fused_stage_flags_missing_master(mock_bias_filename, mock_dark_filename, mock_flat_filename,
+                                          mock_read_master, set_random_seed):
+    masters = _make_masters(103, 101)
+    mock_read_master.side_effect = lambda filename, runtime_context: masters[filename]
+    image = FusedCalibrationApplier(FakeContext()).do_stage(FakeImage())
+    assert image.is_bad
+    assert 'L1IDDARK' not in image.header
+    assert image.header['L1IDFLAT'] == 'flat.fits'
+
+
+@mock.patch('banzai.calibrations.read_master_calibration_image')
+@mock.patch.object(FlatDivider, 'get_calibration_filename', return_value='flat.fits')
+@mock.patch.object(DarkSubtractor, 'get_calibration_filename', return_value='dark.fits')
+@mock.patch.object(BiasSubtractor, 'get_calibration_filename', return_value='bias.fits')
+def test_fused_stage_rejects_inhomogeneous_master(mock_bias_filename, mock_dark_filename, mock_flat_filename,
+                                                  mock_read_master, set_random_seed):
+    masters = _make_masters(103, 101)
+    masters['dark.fits'].ccdsum = '1 1'
+    mock_read_master.side_effect = lambda filename, runtime_context: masters[filename]
+    assert FusedCalibrationApplier(FakeContext()).do_stage(FakeImage()) is None
+
+
+def test_fuse_calibration_stages():
+    stage_names = ['banzai.trim.Trimmer', 'banzai.bias.BiasSubtractor', 'banzai.dark.DarkSubtractor',
+                   'banzai.flats.FlatDivider', 'banzai.photometry.SourceDetector']
+    assert stage_utils.fuse_calibration_stages(stage_names) == ['banzai.trim.Trimmer',
+                                                                'banzai.fused_calibrations.FusedCalibrationApplier',
+                                                                'banzai.photometry.SourceDetector']
+    # Flats only have the bias and dark applied so there is nothing to fuse
+    assert stage_utils.fuse_calibration_stages(stage_names[:3]) == stage_names[:3]
+
+
+@mock.patch('banzai.utils.stage_utils.settings.FUSE_CALIBRATION_STAGES', True)
+def test_get_stages_todo_uses_fused_stage():
+    stages = stage_utils.get_stages_todo(['banzai.bias.BiasSubtractor', 'banzai.dark.DarkSubtractor',
+                                          'banzai.flats.FlatDivider'])
+    assert stages == [FusedCalibrationApplier]
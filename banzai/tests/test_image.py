@@ -5,6 +5,7 @@ from astropy.io import fits
 
 from banzai.images import Image, DataTable, regenerate_data_table_from_fits_hdu_list
 from banzai.tests.utils import FakeContext, FakeImage
+from banzai.utils import fits_utils
 
 
 @pytest.fixture(scope='module')
@@ -85,3 +86,32 @@ def test_data_table_adds_columns():
     assert np.allclose(data_table['b'], np.arange(2))
     data_table.add_column(np.arange(1, 3), name='c', index=1)
     assert np.allclose(data_table['c'], np.arange(1, 3))
+
+
+def test_writeto_fpack_round_trip(tmpdir, set_random_seed):
+    data = np.random.normal(1000.0, 10.0, size=(103, 101)).astype(np.float32)
+    test_image = FakeImage(data=data, data_tables={}, header=fits.Header({'OBSTYPE': 'EXPOSE'}))
+    test_image.bpm = np.random.randint(0, 4, size=data.shape).astype(np.uint8)
+    filepath = str(tmpdir.join('test.fits.fz'))
+
+    test_image._writeto(filepath, fpack=True)
+
+    hdulist = fits.open(filepath)
+    assert isinstance(hdulist['SCI'], fits.CompImageHDU)
+    assert isinstance(hdulist['BPM'], fits.CompImageHDU)
+    read_data, header, bpm, _ = fits_utils.open_image(filepath)
+    assert header['OBSTYPE'] == 'EXPOSE'
+    np.testing.assert_allclose(read_data, data, atol=1.0)
+    np.testing.assert_array_equal(bpm, test_image.bpm)
+    assert tmpdir.listdir() == [tmpdir.join('test.fits.fz')]
+
+
+def test_writeto_replaces_existing_file(tmpdir):
+    test_image = FakeImage(data_tables={}, header=fits.Header({'OBSTYPE': 'EXPOSE'}))
+    filepath = str(tmpdir.join('test.fits'))
+    with open(filepath, 'w') as f:
+        f.write('old file')
+
+    test_image._writeto(filepath)
+
+    np.testing.assert_array_equal(fits.getdata(filepath), test_image.data)
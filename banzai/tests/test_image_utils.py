@@ -1,4 +1,6 @@
+import mock
 import pytest
+from astropy.io import fits
 
 from banzai.utils import image_utils
 from banzai.tests.utils import FakeImage
@@ -32,3 +34,18 @@ def test_raises_exception_if_ccdsums_are_different():
 
 def test_raises_exception_if_filters_are_different():
     throws_inhomogeneous_set_exception(FakeImage(filter='w'), FakeImage(filter='V'), 'filter', ['filter'])
+
+
+@mock.patch('banzai.utils.image_utils.image_can_be_processed')
+@mock.patch('banzai.utils.image_utils.get_primary_header')
+@mock.patch('banzai.utils.image_utils.make_image_path_list')
+def test_select_frames_to_reduce_puts_calibrations_first(mock_path_list, mock_header, mock_can_be_processed):
+    obstypes = {'a.fits': 'EXPOSE', 'b.fits': 'SKYFLAT', 'c.fits': 'BIAS', 'd.fits': 'DARK', 'e.fits': 'BIAS',
+                'f.fits': 'GUIDE', 'g.fits': 'STANDARD'}
+    mock_path_list.return_value = list(obstypes.keys())
+    mock_header.side_effect = lambda filename: fits.Header({'OBSTYPE': obstypes[filename]})
+    mock_can_be_processed.side_effect = lambda header, context: header['OBSTYPE'] != 'GUIDE'
+    context = mock.MagicMock(ignore_schedulability=True, CALIBRATION_IMAGE_TYPES=['BIAS', 'DARK', 'SKYFLAT'])
+    frames = image_utils.select_frames_to_reduce('/raw', context, max_workers=4)
+    assert frames == [('c.fits', 'BIAS'), ('e.fits', 'BIAS'), ('d.fits', 'DARK'), ('b.fits', 'SKYFLAT'),
+                      ('a.fits', 'EXPOSE'), ('g.fits', 'STANDARD')]
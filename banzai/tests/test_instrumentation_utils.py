@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import importlib.util
+import tracemalloc
+
+import mock
+import numpy as np
+import pytest
+
+from banzai.utils import instrumentation_utils
+from banzai.utils.instrumentation_utils import StageTimer, StageStatistics
+from banzai.tests.utils import FakeImage, FakeContext, FakeStage
+
+
+def test_stage_timer_measures_wall_time():
+    timer = StageTimer()
+    time.sleep(0.05)
+    measurement = timer.stop()
+    assert measurement['wall_time'] >= 0.05
+    assert measurement['cpu_time'] < measurement['wall_time']
+    assert measurement['peak_rss_increase'] >= 0
+
+
+def test_instrumentation_utils_imports_without_resource():
+    # Load a separate copy of the module so the one the stages use is left alone
+    spec = importlib.util.spec_from_file_location('instrumentation_utils_copy', instrumentation_utils.__file__)
+    module = importlib.util.module_from_spec(spec)
+    with mock.patch.dict(sys.modules, {'resource': None}):
+        spec.loader.exec_module(module)
+    assert module.resource is None
+    assert module.StageTimer().stop()['peak_rss_increase'] >= 0
+
+
+@pytest.mark.parametrize('proc_exists', [True, False])
+@mock.patch('banzai.utils.instrumentation_utils.resource', None)
+def test_peak_rss_without_resource(proc_exists):
+    if proc_exists and not os.path.exists('/proc/self/status'):
+        pytest.skip('/proc is only available on Linux')
+    if proc_exists:
+        assert instrumentation_utils.peak_rss() >= instrumentation_utils.current_rss() > 0
+    else:
+        with mock.patch('builtins.open', side_effect=OSError):
+            assert instrumentation_utils.peak_rss() == 0
+
+
+@pytest.mark.parametrize('has_reset_peak', [True, False])
+@mock.patch('banzai.utils.instrumentation_utils.settings.STAGE_TRACEMALLOC', True)
+def test_stage_timer_traces_memory(has_reset_peak):
+    if has_reset_peak and not hasattr(tracemalloc, 'reset_peak'):
+        pytest.skip('tracemalloc.reset_peak needs python 3.9')
+    functions = ['start', 'is_tracing', 'clear_traces', 'get_traced_memory'] + ['reset_peak'] * has_reset_peak
+    tracemalloc_module = mock.Mock(spec=functions, wraps=tracemalloc)
+    tracemalloc.start()
+    try:
+        with mock.patch('banzai.utils.instrumentation_utils.tracemalloc', tracemalloc_module):
+            # Allocate more than the stage so the peak would be wrong if it was not reset
+            data = np.ones(2 * 10 ** 6)
+            del data
+            timer = StageTimer()
+            data = np.ones(10 ** 6)
+            del data
+            measurement = timer.stop()
+    finally:
+        tracemalloc.stop()
+    assert 8 * 10 ** 6 <= measurement['peak_traced_memory'] < 16 * 10 ** 6
+    assert tracemalloc_module.clear_traces.called != has_reset_peak
+
+
+def test_stage_statistics_percentiles():
+    statistics = StageStatistics(max_samples=100)
+    for wall_time in range(1, 201):
+        statistics.add('banzai.stages.FakeStage', 'kb76', {'wall_time': float(wall_time)})
+    percentiles = statistics.percentiles('banzai.stages.FakeStage', 'kb76')
+    # Only the last 100 runs are kept
+    assert percentiles['n'] == 100
+    np.testing.assert_allclose([percentiles['p50'], percentiles['p95'], percentiles['p99']],
+                               np.percentile(np.arange(101, 201), [50, 95, 99]))
+    assert statistics.percentiles('banzai.stages.FakeStage', 'fa15') == {'n': 0}
+    assert list(statistics.summary().keys()) == [('banzai.stages.FakeStage', 'kb76')]
+
+
+def test_stage_run_records_measurement():
+    instrumentation_utils.STAGE_STATISTICS.clear()
+    image = FakeStage(FakeContext()).run(FakeImage())
+    stage_name, measurement = image.stage_measurements[-1]
+    assert stage_name == 'banzai.stages.FakeStage'
+    assert 'wall_time' in measurement and 'cpu_time' in measurement
+    assert instrumentation_utils.STAGE_STATISTICS.percentiles(stage_name, 'kb76')['n'] == 1
+
+
+class FailingStage(FakeStage):
+    def do_stage(self, image):
+        raise ValueError('Stage failed')
+
+
+def test_failed_stage_is_still_measured():
+    instrumentation_utils.STAGE_STATISTICS.clear()
+    assert FailingStage(FakeContext()).run(FakeImage()) is None
+    assert instrumentation_utils.STAGE_STATISTICS.percentiles('banzai.stages.FailingStage', 'kb76')['n'] == 1
+
+
+@mock.patch('banzai.utils.instrumentation_utils.qc.save_qc_results')
+@mock.patch('banzai.utils.instrumentation_utils.settings.STAGE_TIMING_QC', True)
+@mock.patch('banzai.utils.instrumentation_utils.settings.STAGE_TIMING_HISTORY', True)
+def test_summarize_frame(mock_save_qc):
+    image = FakeStage(FakeContext()).run(FakeImage())
+    instrumentation_utils.summarize_frame(image, FakeContext())
+    history = [str(record) for record in image.header['HISTORY']]
+    assert history[0].startswith('Stage timings')
+    assert history[1].startswith('FakeStage ')
+    qc_results = mock_save_qc.call_args[0][1]
+    assert set(qc_results.keys()) == {'stage_timing.FakeStage.wall_time', 'stage_timing.FakeStage.cpu_time'}
+
+
+@mock.patch('banzai.utils.instrumentation_utils.log_stage_statistics')
+@mock.patch('banzai.utils.instrumentation_utils.settings.STAGE_STATISTICS_LOG_INTERVAL', 3)
+def test_stage_statistics_are_logged_periodically(mock_log_statistics):
+    instrumentation_utils._FRAME_COUNTER['frames_since_summary'] = 0
+    for i in range(7):
+        instrumentation_utils.summarize_frame(FakeImage(), FakeContext())
+    assert mock_log_statistics.call_count == 2
@@ -181,6 +181,70 @@ def test_median2d_uniform_distribution_nomask():
         _compare_median2d(a.astype('f4'), np.zeros((size_y, size_x), dtype=np.uint8))
 
 
+def test_median2d_small_stacks_with_ties():
+    # Short rows go through the sorting network, longer ones through quick select
+    for size_x in range(1, 70):
+        a = np.round(np.random.normal(0.0, 3.0, size=(20, size_x))).astype(np.float32)
+        actual = median_utils.median2d(a, np.zeros(a.shape, dtype=np.uint8))
+        np.testing.assert_array_equal(actual, np.median(a, axis=1).astype(np.float32))
+
+
+def test_median2d_small_stacks_mask():
+    for size_x in range(1, 70):
+        a = np.random.normal(1000.0, 10.0, size=(20, size_x)).astype(np.float32)
+        mask = np.zeros(a.shape, dtype=np.uint8)
+        mask[:, np.random.randint(0, size_x)] = 1
+        actual = median_utils.median2d(a, mask)
+        if size_x > 1:
+            expected = np.median(a[mask == 0].reshape(20, size_x - 1), axis=1).astype(np.float32)
+        else:
+            expected = np.zeros(20, dtype=np.float32)
+        np.testing.assert_array_equal(actual, expected)
+
+
+def _compare_parallel_median1d(a, mask):
+    actual = median_utils.parallel_median1d(a, mask)
+    assert actual == median_utils.median1d(a.copy(), mask)
+    if np.any(mask == 0):
+        assert actual == np.median(a[mask == 0])
+    else:
+        assert actual == 0.0
+
+
+def test_parallel_median1d_matches_median():
+    for i in range(20):
+        size = np.random.randint(1, 10000)
+        a = np.random.normal(np.random.uniform(-1000.0, 1000.0), np.random.uniform(0, 100.0), size=size)
+        _compare_parallel_median1d(a.astype(np.float32), np.zeros(size, dtype=np.uint8))
+        mask = (np.random.uniform(size=size) < 0.3).astype(np.uint8)
+        _compare_parallel_median1d(a.astype(np.float32), mask)
+
+
+def test_parallel_median1d_repeated_values():
+    for i in range(20):
+        size = np.random.randint(1, 10000)
+        a = np.random.randint(-5, 5, size=size).astype(np.float32)
+        _compare_parallel_median1d(a, np.zeros(size, dtype=np.uint8))
+
+
+def test_parallel_median1d_wide_range():
+    a = np.random.uniform(-1e30, 1e30, size=1000).astype(np.float32)
+    _compare_parallel_median1d(a, np.zeros(1000, dtype=np.uint8))
+
+
+def test_parallel_median1d_all_masked_returns_zero():
+    a = np.ones(1000, dtype=np.float32)
+    _compare_parallel_median1d(a, np.ones(1000, dtype=np.uint8))
+
+
+def test_median1d_large_array_uses_parallel_median():
+    size = 2 ** 20 + 2
+    a = np.random.normal(1000.0, 10.0, size=size).astype(np.float32)
+    mask = np.zeros(size, dtype=np.uint8)
+    mask[:3] = 1
+    assert median_utils.median1d(a, mask) == np.median(a[3:])
+
+
 # def test_median2d_bimodel_arange_nomask():
 #     for i in range(100):
 #         size1 = np.random.randint(1, 10000)
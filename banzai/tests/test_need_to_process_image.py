@@ -4,90 +4,49 @@ from banzai.tests.utils import FakeInstrument, FakeContext
 from banzai.utils.realtime_utils import need_to_process_image
 
 md5_hash1 = '49a6bb35cdd3859224c0214310b1d9b6'
-md5_hash2 = 'aec5ef355e7e43a59fedc88ac95caed6'
 
 
-class FakeRealtimeImage(object):
-    def __init__(self, success=False, checksum=md5_hash1, tries=0):
-        self.success = success
-        self.checksum = checksum
-        self.tries = tries
-
-
-@mock.patch('banzai.utils.file_utils.get_md5')
-@mock.patch('banzai.dbs.get_processed_image')
-@mock.patch('banzai.utils.fits_utils.get_primary_header')
-@mock.patch('banzai.dbs.get_instrument')
-@mock.patch('banzai.utils.image_utils.image_can_be_processed')
-def test_no_processing_if_previous_success(mock_can_process, mock_instrument, mock_header, mock_processed, mock_md5):
-    mock_can_process.return_value = True
-    mock_instrument.return_value = FakeInstrument()
-    mock_processed.return_value = FakeRealtimeImage(success=True, checksum=md5_hash1)
-    mock_md5.return_value = md5_hash1
-    assert not need_to_process_image('test.fits', FakeContext())
-
-
-@mock.patch('banzai.dbs.commit_processed_image')
-@mock.patch('banzai.utils.file_utils.get_md5')
-@mock.patch('banzai.dbs.get_processed_image')
-@mock.patch('banzai.utils.fits_utils.get_primary_header')
-@mock.patch('banzai.dbs.get_instrument')
-@mock.patch('banzai.utils.image_utils.image_can_be_processed')
-def test_do_process_if_never_tried(mock_can_process, mock_instrument, mock_header, mock_processed, mock_md5, mock_commit):
-    mock_can_process.return_value = True
-    mock_instrument.return_value = FakeInstrument()
-    mock_processed.return_value = FakeRealtimeImage(success=False, checksum=md5_hash1, tries=0)
-    mock_md5.return_value = md5_hash1
-    assert need_to_process_image('test.fits', FakeContext())
-
-
-@mock.patch('banzai.dbs.commit_processed_image')
+@mock.patch('banzai.dbs.claim_processed_image')
 @mock.patch('banzai.utils.file_utils.get_md5')
-@mock.patch('banzai.dbs.get_processed_image')
 @mock.patch('banzai.utils.fits_utils.get_primary_header')
 @mock.patch('banzai.dbs.get_instrument')
 @mock.patch('banzai.utils.image_utils.image_can_be_processed')
-def test_do_process_if_tries_less_than_max(mock_can_process, mock_instrument, mock_header, mock_processed, mock_md5, mock_commit):
+def test_claims_frame_with_checksum(mock_can_process, mock_instrument, mock_header, mock_md5, mock_claim):
     mock_can_process.return_value = True
     mock_instrument.return_value = FakeInstrument()
-    mock_processed.return_value = FakeRealtimeImage(success=False, checksum=md5_hash1, tries=3)
     mock_md5.return_value = md5_hash1
+    mock_claim.return_value = True
     context = FakeContext()
     context.max_tries = 5
     assert need_to_process_image('test.fits', context)
+    mock_claim.assert_called_with('test.fits', md5_hash1, 5, db_address=context.db_address)
 
 
-@mock.patch('banzai.dbs.commit_processed_image')
+@mock.patch('banzai.dbs.claim_processed_image')
 @mock.patch('banzai.utils.file_utils.get_md5')
-@mock.patch('banzai.dbs.get_processed_image')
 @mock.patch('banzai.utils.fits_utils.get_primary_header')
 @mock.patch('banzai.dbs.get_instrument')
 @mock.patch('banzai.utils.image_utils.image_can_be_processed')
-def test_no_processing_if_tries_at_max(mock_can_process, mock_instrument, mock_header, mock_processed, mock_md5, mock_commit):
+def test_no_processing_if_claim_fails(mock_can_process, mock_instrument, mock_header, mock_md5, mock_claim):
     mock_can_process.return_value = True
     mock_instrument.return_value = FakeInstrument()
-    max_tries = 5
-    mock_processed.return_value = FakeRealtimeImage(success=False, checksum=md5_hash1, tries=max_tries)
     mock_md5.return_value = md5_hash1
-    context = FakeContext()
-    context.max_tries = max_tries
-    assert not need_to_process_image('test.fits', context)
+    mock_claim.return_value = False
+    assert not need_to_process_image('test.fits', FakeContext())
 
 
-@mock.patch('banzai.dbs.commit_processed_image')
-@mock.patch('banzai.utils.file_utils.get_md5')
-@mock.patch('banzai.dbs.get_processed_image')
+@mock.patch('banzai.dbs.claim_processed_image')
 @mock.patch('banzai.utils.fits_utils.get_primary_header')
 @mock.patch('banzai.dbs.get_instrument')
 @mock.patch('banzai.utils.image_utils.image_can_be_processed')
-def test_do_process_if_new_checksum(mock_can_process, mock_instrument, mock_header, mock_processed, mock_md5, mock_commit):
-    # assert that tries and success are reset to 0
-    image = FakeRealtimeImage(success=True, checksum=md5_hash1, tries=3)
+def test_no_claim_if_instrument_not_schedulable(mock_can_process, mock_instrument, mock_header, mock_claim):
     mock_can_process.return_value = True
-    mock_processed.return_value = image
-    mock_md5.return_value = md5_hash2
-    mock_instrument.return_value = FakeInstrument()
-    assert need_to_process_image('test.fits', FakeContext())
-    assert not image.success
-    assert image.tries == 0
-    assert image.checksum == md5_hash2
+    mock_instrument.return_value = FakeInstrument(schedulable=False)
+    assert not need_to_process_image('test.fits', FakeContext())
+    mock_claim.assert_not_called()
+
+
+@mock.patch('banzai.dbs.claim_processed_image')
+def test_no_claim_if_not_a_fits_file(mock_claim):
+    assert not need_to_process_image('test.txt', FakeContext())
+    mock_claim.assert_not_called()
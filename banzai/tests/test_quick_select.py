@@ -76,3 +76,12 @@ def test_quick_select_bimodal_uniformal_distribution():
         a = np.append(np.random.normal(-1000.0, 1000.0, size=size1) + center1,
                       np.random.normal(-1000.0, 1000.0, size=size2) + center2)
         _compare_quick_select(a, index)
+
+
+def test_quick_select_adversarial_orderings():
+    size = 5001
+    sorted_array = np.arange(size, dtype=np.float32)
+    organ_pipe = np.append(np.arange(0, size, 2), np.arange(size - 2, 0, -2)).astype(np.float32)
+    for a in [sorted_array, sorted_array[::-1], organ_pipe, np.zeros(size, dtype=np.float32)]:
+        for index in [0, size // 2, size - 1]:
+            _compare_quick_select(a.copy(), index)
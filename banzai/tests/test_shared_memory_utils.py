@@ -0,0 +1,70 @@
+import os
+import shutil
+
+import mock
+import numpy as np
+
+from banzai.utils.shared_memory_utils import SharedArrayStore
+
+
+def test_arrays_are_only_loaded_once(tmpdir):
+    data = np.random.normal(size=(11, 13)).astype(np.float32)
+    loader = mock.Mock(return_value={'data': data, 'bpm': None})
+    # Two stores pointing at the same directory behave like two worker processes
+    first_arrays = SharedArrayStore(str(tmpdir), 1024 ** 2).get('master', loader)
+    second_arrays = SharedArrayStore(str(tmpdir), 1024 ** 2).get('master', loader)
+    assert loader.call_count == 1
+    for arrays in [first_arrays, second_arrays]:
+        np.testing.assert_array_equal(arrays['data'], data)
+        assert not arrays['data'].flags.writeable
+        assert arrays['bpm'] is None
+
+
+def test_big_endian_arrays_are_stored_native(tmpdir):
+    data = np.arange(20, dtype='>f4')
+    arrays = SharedArrayStore(str(tmpdir), 1024 ** 2).get('master', lambda: {'data': data})
+    assert arrays['data'].dtype == np.float32
+    np.testing.assert_array_equal(arrays['data'], data)
+
+
+def test_least_recently_used_entries_are_evicted(tmpdir):
+    store = SharedArrayStore(str(tmpdir), 4000)
+    for name in ['a', 'b']:
+        store.get(name, lambda: {'data': np.zeros(200)})
+    # Make sure the access times are ordered even on file systems with coarse timestamps
+    os.utime(str(tmpdir.join('a')), (0, 0))
+    store.get('c', lambda: {'data': np.zeros(200)})
+    assert [entry[0] for entry in store.entries()] == ['b', 'c']
+
+
+def test_entry_evicted_between_store_and_load(tmpdir):
+    data = np.random.normal(size=(11, 13)).astype(np.float32)
+    store = SharedArrayStore(str(tmpdir), 1024 ** 2)
+
+    def evicted_by_another_process(keep=None):
+        shutil.rmtree(str(tmpdir.join(keep)))
+
+    with mock.patch.object(store, 'evict', side_effect=evicted_by_another_process):
+        arrays = store.get('master', lambda: {'data': data, 'bpm': None})
+    np.testing.assert_array_equal(arrays['data'], data)
+    assert arrays['bpm'] is None
+    assert store.entries() == []
+
+
+def test_entry_evicted_while_it_is_mapped(tmpdir):
+    data = np.random.normal(size=(11, 13)).astype(np.float32)
+    store = SharedArrayStore(str(tmpdir), 1024 ** 2)
+    store.get('master', lambda: {'data': data, 'bpm': np.zeros((11, 13), dtype=np.uint8)})
+    np_load = np.load
+
+    def evict_then_load(filename, **kwargs):
+        # Another process evicts the entry after we listed its files but before we mapped them all
+        if os.path.isdir(str(tmpdir.join('master'))):
+            shutil.rmtree(str(tmpdir.join('master')))
+        return np_load(filename, **kwargs)
+
+    loader = mock.Mock(return_value={'data': data, 'bpm': None})
+    with mock.patch('banzai.utils.shared_memory_utils.np.load', side_effect=evict_then_load):
+        arrays = store.get('master', loader)
+    assert loader.call_count == 1
+    np.testing.assert_array_equal(arrays['data'], data)
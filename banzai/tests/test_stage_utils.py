@@ -0,0 +1,221 @@
+import mock
+import numpy as np
+import pytest
+from astropy.io.fits import Header
+
+from banzai.bias import OverscanSubtractor, BiasSubtractor
+from banzai.dark import DarkSubtractor
+from banzai.flats import FlatDivider
+from banzai.gain import GainNormalizer
+from banzai.qc.saturation import SaturationTest
+from banzai.qc.sinistro_1000s import ThousandsTest
+from banzai.stages import BandStreamer
+from banzai.trim import Trimmer
+from banzai.exceptions import PipelineConfigurationException
+from banzai.utils import stage_utils
+from banzai.tests.utils import FakeContext, FakeImage
+
+ORDERED_STAGES = ['banzai.tests.utils.FakeStage', 'banzai.trim.Trimmer', 'banzai.bias.BiasSubtractor']
+
+
+@pytest.fixture(autouse=True)
+def clear_pipeline_plans():
+    stage_utils.clear_pipeline_plans()
+    yield
+    stage_utils.clear_pipeline_plans()
+
+
+@mock.patch('banzai.utils.stage_utils.settings.EXTRA_STAGES', {'BIAS': ['banzai.bias.BiasComparer']})
+@mock.patch('banzai.utils.stage_utils.settings.LAST_STAGE', {'BIAS': 'banzai.trim.Trimmer'})
+@mock.patch('banzai.utils.stage_utils.settings.ORDERED_STAGES', ORDERED_STAGES)
+def test_pipeline_plan_is_compiled_once():
+    runtime_context = FakeContext()
+    plan = stage_utils.get_pipeline_plan('BIAS', runtime_context)
+    assert [stage.__class__.__name__ for stage in plan.stages] == ['FakeStage', 'Trimmer', 'BiasComparer']
+    assert all(stage.runtime_context is runtime_context for stage in plan.stages)
+    assert stage_utils.get_pipeline_plan('BIAS', runtime_context) is plan
+    # An equivalent context (e.g. rebuilt from the arguments of a celery task) reuses the plan
+    assert stage_utils.get_pipeline_plan('BIAS', FakeContext()) is plan
+    assert stage_utils.get_pipeline_plan('BIAS', FakeContext(preview_mode=True)) is not plan
+
+
+@mock.patch('banzai.utils.stage_utils.settings.EXTRA_STAGES', {'EXPOSE': None})
+@mock.patch('banzai.utils.stage_utils.settings.LAST_STAGE', {'EXPOSE': None})
+@mock.patch('banzai.utils.stage_utils.settings.ORDERED_STAGES', ORDERED_STAGES)
+def test_pipeline_plan_is_recompiled_when_the_stages_change():
+    plan = stage_utils.get_pipeline_plan('EXPOSE', FakeContext())
+    with mock.patch('banzai.utils.stage_utils.settings.ORDERED_STAGES', ORDERED_STAGES[:1]):
+        assert len(stage_utils.get_pipeline_plan('EXPOSE', FakeContext()).stages) == 1
+    assert len(plan.stages) == 3
+
+
+@mock.patch('banzai.utils.stage_utils.settings.EXTRA_STAGES', {'BIAS': ['banzai.bias.BiasMaker'],
+                                                               'DARK': ['banzai.dark.NoSuchStage'],
+                                                               'EXPOSE': None})
+@mock.patch('banzai.utils.stage_utils.settings.LAST_STAGE', {'BIAS': None, 'DARK': None,
+                                                             'EXPOSE': 'banzai.flats.FlatDivider'})
+@mock.patch('banzai.utils.stage_utils.settings.ORDERED_STAGES', ORDERED_STAGES)
+def test_misconfigured_stages_fail_at_startup():
+    with pytest.raises(PipelineConfigurationException) as exception_info:
+        stage_utils.validate_stage_settings()
+    message = str(exception_info.value)
+    # Every problem is reported at once
+    assert 'banzai.bias.BiasMaker is not a banzai.stages.Stage' in message
+    assert 'banzai.dark.NoSuchStage cannot be imported' in message
+    assert 'banzai.flats.FlatDivider for EXPOSE frames is not in ORDERED_STAGES' in message
+    with pytest.raises(PipelineConfigurationException):
+        stage_utils.compile_pipeline_plans(FakeContext(), obstypes=['BIAS'])
+    assert set(stage_utils.compile_pipeline_plans(FakeContext(), obstypes=[]).keys()) == set()
+
+
+def test_default_settings_compile():
+    plans = stage_utils.compile_pipeline_plans(FakeContext())
+    assert set(plans.keys()) == set(stage_utils.settings.LAST_STAGE.keys())
+
+
+@mock.patch('banzai.utils.stage_utils.image_utils.read_image')
+@mock.patch('banzai.utils.stage_utils.settings.EXTRA_STAGES', {'EXPOSE': None})
+@mock.patch('banzai.utils.stage_utils.settings.LAST_STAGE', {'EXPOSE': None})
+@mock.patch('banzai.utils.stage_utils.settings.ORDERED_STAGES', ORDERED_STAGES[:1])
+def test_run_reuses_pipeline_plan(mock_read_image):
+    images = [FakeImage(), FakeImage()]
+    for image in images:
+        image.obstype = 'EXPOSE'
+        image.write = mock.MagicMock()
+    mock_read_image.side_effect = images
+    with mock.patch('banzai.tests.utils.FakeStage.__init__', autospec=True, return_value=None) as mock_init:
+        for image in images:
+            stage_utils.run(image.filename, FakeContext())
+    assert mock_init.call_count == 1
+    for image in images:
+        image.write.assert_called_once()
+
+
+@mock.patch('banzai.utils.stage_utils.run')
+def test_reduce_frames_isolates_failures(mock_run):
+    def reduce_frame(filename, runtime_context):
+        if filename == 'bad.fits':
+            raise ValueError('Bad frame')
+        return None if filename == 'stopped.fits' else FakeImage()
+    mock_run.side_effect = reduce_frame
+    frames = [('science.fits', 'EXPOSE'), ('bad.fits', 'DARK'), ('bias.fits', 'BIAS'), ('stopped.fits', 'EXPOSE')]
+    summary = stage_utils.reduce_frames(frames, FakeContext())
+    reduced_filenames = [call[0][0] for call in mock_run.call_args_list]
+    assert reduced_filenames == ['bias.fits', 'bad.fits', 'science.fits', 'stopped.fits']
+    assert summary['n_frames'] == 4
+    assert summary['n_reduced'] == 2
+    assert sorted(summary['failed']) == ['bad.fits', 'stopped.fits']
+
+
+def test_reduce_frames_in_process_pool():
+    # The frames do not exist, so every worker fails to read its frame without affecting the others
+    frames = [('/tmp/missing{0}.fits'.format(i), 'EXPOSE') for i in range(3)]
+    summary = stage_utils.reduce_frames(frames, FakeContext(), n_processes=2)
+    assert summary['n_frames'] == 3
+    assert sorted(summary['failed']) == sorted(filename for filename, _ in frames)
+
+
+def test_stream_band_stages():
+    context = FakeContext()
+    stages = [Trimmer(context), ThousandsTest(context), SaturationTest(context), Trimmer(context),
+              GainNormalizer(context), Trimmer(context), BiasSubtractor(context), DarkSubtractor(context)]
+    streamed_stages = stage_utils.stream_band_stages(stages, context, 1000)
+    # The QC tests only reject images after every band, so each one ends a chain
+    assert [stage.__class__ for stage in streamed_stages] == [Trimmer, ThousandsTest, SaturationTest, Trimmer,
+                                                              GainNormalizer, Trimmer, BandStreamer]
+    assert streamed_stages[-1].stage_name == 'banzai.stages.BiasSubtractor+DarkSubtractor'
+    streamed_stages = stage_utils.stream_band_stages([OverscanSubtractor(context), SaturationTest(context),
+                                                      GainNormalizer(context), BiasSubtractor(context)], context, 1000)
+    assert [stage.__class__ for stage in streamed_stages] == [BandStreamer, BandStreamer]
+    assert [stage.__class__ for stage in streamed_stages[0].stages] == [OverscanSubtractor, SaturationTest]
+
+
+@mock.patch('banzai.utils.stage_utils.settings.BAND_STREAMING', True)
+def test_pipeline_plan_streams_bands():
+    stage_names = [stage.stage_name for stage in stage_utils.get_pipeline_plan('EXPOSE', FakeContext()).stages]
+    assert 'banzai.stages.BiasSubtractor+DarkSubtractor+FlatDivider' in stage_names
+    assert 'banzai.stages.SourceDetector' in stage_names
+
+
+def _make_raw_image(n_amps, ny=103, nx=101):
+    image = FakeImage(nx=nx, ny=ny, n_amps=n_amps, header=Header({'SATURATE': 1090.0, 'MAXLIN': 1080.0}),
+                      data=np.random.normal(1000.0, 30.0, size=(ny, nx)).astype(np.float32))
+    image.data[:, :5] = 1000.0
+    image.gain = [1.0 + 0.1 * i for i in range(n_amps)] if n_amps > 1 else 1.5
+    image.extension_headers = [Header({'BIASSEC': '[91:101,1:103]'}) for i in range(n_amps)]
+    if n_amps == 1:
+        image.header['BIASSEC'] = '[91:101,1:103]'
+    return image
+
+
+@pytest.mark.parametrize('n_amps', [1, 4])
+@mock.patch('banzai.utils.qc.save_qc_results')
+def test_band_streamer_matches_whole_frame_stages(mock_save_qc, n_amps):
+    np.random.seed(81723)
+    image = _make_raw_image(n_amps)
+    expected_image = FakeImage(data=image.data.copy(), header=image.header.copy(), gain=image.gain,
+                               extension_headers=image.extension_headers)
+    stage_types = [ThousandsTest, SaturationTest, OverscanSubtractor, GainNormalizer]
+    for stage_type in stage_types:
+        expected_image = stage_type(FakeContext()).do_stage(expected_image)
+
+    # Bands of a few rows with a partial band at the end
+    streamer = BandStreamer(FakeContext(), [stage_type(FakeContext()) for stage_type in stage_types], 7 * 101)
+    image = streamer.do_stage(image)
+    np.testing.assert_array_equal(image.data, expected_image.data)
+    assert dict(image.header) == dict(expected_image.header)
+
+
+@mock.patch('banzai.utils.qc.save_qc_results')
+def test_band_streamer_rejects_image(mock_save_qc):
+    np.random.seed(81723)
+    image = _make_raw_image(1)
+    image.data[:50] = 2000.0
+    context = FakeContext()
+    stages = stage_utils.stream_band_stages([ThousandsTest(context), SaturationTest(context),
+                                             OverscanSubtractor(context), GainNormalizer(context)], context, 1000)
+    with mock.patch.object(OverscanSubtractor, 'start_bands') as mock_overscan:
+        for stage in stages:
+            image = stage.run(image)
+    assert image is None
+    assert mock_save_qc.call_args[0][1]['saturated.failed']
+    # Nothing after the saturation test is run on a rejected image
+    mock_overscan.assert_not_called()
+
+
+@mock.patch('banzai.utils.qc.save_qc_results')
+def test_band_streamer_times_each_stage(mock_save_qc):
+    np.random.seed(81723)
+    image = _make_raw_image(4)
+    stage_types = [OverscanSubtractor, GainNormalizer]
+    streamer = BandStreamer(FakeContext(), [stage_type(FakeContext()) for stage_type in stage_types], 7 * 101)
+    with mock.patch('banzai.stages.logger') as mock_logger:
+        image = streamer.run(image)
+    stage_names = ['banzai.stages.OverscanSubtractor', 'banzai.stages.GainNormalizer']
+    assert [call[0][0] for call in mock_logger.info.call_args_list] == ['Running ' + name for name in stage_names]
+    assert [stage_name for stage_name, _ in image.stage_measurements] == stage_names
+    for _, measurement in image.stage_measurements:
+        assert set(measurement.keys()) == {'wall_time', 'cpu_time', 'peak_rss_increase'}
+        assert 0 < measurement['wall_time']
+
+
+@mock.patch('banzai.calibrations.ApplyCalibration.load_master_calibration_image')
+@mock.patch('banzai.calibrations.ApplyCalibration.get_calibration_filename', return_value='master.fits')
+def test_band_streamer_applies_calibrations(mock_filename, mock_load_master):
+    np.random.seed(81723)
+    master = FakeImage(data=np.random.normal(1.0, 0.1, size=(103, 101)).astype(np.float32),
+                       header=Header({'BIASLVL': 10.0}))
+    master.bpm = (np.random.uniform(size=master.data.shape) < 0.1).astype(np.uint8)
+    mock_load_master.return_value = master
+    data = np.random.normal(1000.0, 30.0, size=(103, 101)).astype(np.float32)
+
+    stage_types = [BiasSubtractor, DarkSubtractor, FlatDivider]
+    expected_image = FakeImage(data=data.copy())
+    for stage_type in stage_types:
+        expected_image = stage_type(FakeContext()).do_stage(expected_image)
+
+    streamer = BandStreamer(FakeContext(), [stage_type(FakeContext()) for stage_type in stage_types], 1000)
+    image = streamer.do_stage(FakeImage(data=data.copy()))
+    np.testing.assert_array_equal(image.data, expected_image.data)
+    np.testing.assert_array_equal(image.bpm, expected_image.bpm)
+    assert image.header['L1IDFLAT'] == expected_image.header['L1IDFLAT']
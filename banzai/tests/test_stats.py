@@ -680,3 +680,163 @@ def test_mad_3d_axis_2_mask(set_random_seed):
 #         expected = np.std(a)
 #         actual = stats.robust_standard_deviation(a)
 #         np.testing.assert_allclose(actual, np.float32(expected), atol= sigma / (size ** 0.5))
+
+
+def test_sigma_clipped_mean_fused_matches_numpy(set_random_seed):
+    for i in range(20):
+        size1 = np.random.randint(1, 20)
+        size2 = np.random.randint(1, 20)
+        size3 = np.random.randint(1, 200)
+        mean = np.random.uniform(-1000, 1000)
+        sigma = np.random.uniform(0, 1000)
+        a = np.random.normal(mean, sigma, size=(size1, size2, size3)).astype(np.float32)
+        a[..., 0] += 10 * sigma
+        value_to_mask = np.random.uniform(0, 0.8)
+        mask = (np.random.uniform(0, 1.0, size=(size1, size2, size3)) < value_to_mask).astype(np.uint8)
+        expected = stats._sigma_clipped_mean_numpy(a.copy(), 3.5, axis=2, mask=mask)
+        actual = stats.sigma_clipped_mean(a, 3.5, axis=2, mask=mask)
+        np.testing.assert_array_equal(actual, expected)
+        assert actual.dtype == np.float32
+
+
+def test_sigma_clipped_mean_fully_masked_uses_fill_value():
+    a = np.ones((2, 3, 5), dtype=np.float32)
+    mask = np.zeros(a.shape, dtype=np.uint8)
+    mask[0, 1, :] = 1
+    actual = stats.sigma_clipped_mean(a, 3.0, axis=2, mask=mask, fill_value=-1.0)
+    expected = np.ones((2, 3), dtype=np.float32)
+    expected[0, 1] = -1.0
+    np.testing.assert_array_equal(actual, expected)
+
+
+def _raw_frame(shape=(300, 400)):
+    return np.random.poisson(np.random.uniform(0.0, 2000.0), size=shape).astype(np.float32)
+
+
+def test_integer_histogram():
+    a = _raw_frame()
+    mask = (np.random.uniform(size=a.shape) < 0.2).astype(np.uint8)
+    expected = np.bincount(a[mask == 0].astype(int), minlength=65536)
+    np.testing.assert_array_equal(stats.integer_histogram(a, mask=mask), expected)
+    np.testing.assert_array_equal(stats.integer_histogram(a, mask=mask > 0), expected)
+
+
+def test_integer_histogram_rejects_non_integer_data():
+    a = _raw_frame()
+    a[100, 100] += 0.5
+    assert stats.integer_histogram(a) is None
+    a[100, 100] = -1.0
+    assert stats.integer_histogram(a) is None
+    a[100, 100] = 65536.0
+    assert stats.integer_histogram(a) is None
+    a[100, 100] = np.nan
+    assert stats.integer_histogram(a) is None
+
+
+def test_integer_histogram_ignores_masked_non_integer_values():
+    a = _raw_frame()
+    mask = np.zeros(a.shape, dtype=np.uint8)
+    a[5, 7] = -10.5
+    mask[5, 7] = 1
+    assert stats.integer_histogram(a, mask=mask).sum() == a.size - 1
+
+
+def test_integer_histogram_skips_small_and_non_float32_arrays():
+    assert stats.integer_histogram(np.ones(100, dtype=np.float32)) is None
+    assert stats.integer_histogram(_raw_frame().astype(np.float64)) is None
+
+
+def test_integer_histogram_non_contiguous():
+    a = _raw_frame(shape=(1000, 500))
+    section = a[::2, 100:400]
+    np.testing.assert_array_equal(stats.integer_histogram(section),
+                                  np.bincount(section.ravel().astype(int), minlength=65536))
+
+
+def test_histogram_median_matches_median():
+    for i in range(20):
+        a = _raw_frame(shape=(np.random.randint(200, 300), 400))
+        mask = (np.random.uniform(size=a.shape) < 0.3).astype(np.uint8)
+        assert stats.median(a, mask=mask) == np.median(a[mask == 0])
+        assert stats.median(a) == np.median(a)
+
+
+def test_histogram_median_absolute_deviation_matches_float_path():
+    for i in range(20):
+        # Few distinct values so that the median is often halfway between two integers
+        a = np.random.randint(0, np.random.randint(2, 10), size=(256, 257)).astype(np.float32)
+        expected = np.median(np.abs(a - np.median(a)))
+        assert stats.median_absolute_deviation(a) == expected
+        assert stats.histogram_median_absolute_deviation(stats.integer_histogram(a)) == expected
+
+
+def test_histogram_sigma_clipped_mean_matches_float_path():
+    for i in range(20):
+        a = _raw_frame()
+        a[np.random.randint(0, 300, size=50), np.random.randint(0, 400, size=50)] = 65535.0
+        mask = (np.random.uniform(size=a.shape) < 0.1).astype(np.uint8)
+        expected = stats._sigma_clipped_mean_numpy(a, 3.0, mask=mask)
+        np.testing.assert_allclose(stats.sigma_clipped_mean(a, 3.0, mask=mask), expected, rtol=1e-6)
+
+
+def test_histogram_sigma_clipped_mean_all_masked():
+    a = _raw_frame()
+    assert stats.sigma_clipped_mean(a, 3.0, mask=np.ones(a.shape, dtype=np.uint8), fill_value=-1.0) == -1.0
+
+
+def test_subsample_strided():
+    a = np.arange(1000 * 800, dtype=np.float32).reshape(1000, 800)
+    mask = (a % 3 == 0).astype(np.uint8)
+    samples, sample_mask = stats.subsample(a, 1000, mask=mask)
+    assert 1000 <= samples.size < 4000
+    np.testing.assert_array_equal(sample_mask, samples % 3 == 0)
+
+
+def test_subsample_random_is_reproducible():
+    a = np.random.normal(size=(500, 400)).astype(np.float32)
+    samples, sample_mask = stats.subsample(a, 1000, method='random')
+    assert samples.size == 1000
+    assert sample_mask is None
+    assert len(np.unique(samples)) == 1000
+    np.testing.assert_array_equal(samples, stats.subsample(a, 1000, method='random')[0])
+
+
+def test_subsample_whole_array():
+    a = np.random.normal(size=(50, 40)).astype(np.float32)
+    samples, _ = stats.subsample(a, 5000)
+    np.testing.assert_array_equal(samples, a.ravel())
+
+
+def test_subsample_unknown_method():
+    with pytest.raises(ValueError):
+        stats.subsample(np.zeros(100), 10, method='bootstrap')
+
+
+def test_subsampled_sigma_clipped_mean_reaches_requested_error(set_random_seed):
+    a = np.random.normal(1000.0, 50.0, size=(2000, 1000)).astype(np.float32)
+    a[np.random.randint(0, 2000, size=1000), np.random.randint(0, 1000, size=1000)] = 60000.0
+    for method in ['strided', 'random']:
+        mean_value, error = stats.subsampled_sigma_clipped_mean(a, 3.5, 0.5, method=method)
+        assert error <= 0.5
+        assert np.abs(mean_value - 1000.0) < 4 * 0.5
+
+
+def test_subsampled_sigma_clipped_mean_relative_error(set_random_seed):
+    a = np.random.normal(1000.0, 50.0, size=(2000, 1000)).astype(np.float32)
+    mean_value, error = stats.subsampled_sigma_clipped_mean(a, 3.5, 1e-3, relative=True)
+    assert error <= 1e-3 * mean_value
+
+
+def test_subsampled_sigma_clipped_mean_falls_back_to_whole_array(set_random_seed):
+    a = np.random.normal(1000.0, 50.0, size=(200, 100)).astype(np.float32)
+    mask = (np.random.uniform(size=a.shape) < 0.1).astype(np.uint8)
+    mean_value, error = stats.subsampled_sigma_clipped_mean(a, 3.5, 1e-6, mask=mask)
+    assert mean_value == stats.sigma_clipped_mean(a, 3.5, mask=mask)
+    assert error > 1e-6
+
+
+def test_subsampled_robust_standard_deviation(set_random_seed):
+    a = np.random.normal(1000.0, 50.0, size=(2000, 1000)).astype(np.float32)
+    robust_std, error = stats.subsampled_robust_standard_deviation(a, 0.5)
+    assert error <= 0.5
+    assert np.abs(robust_std - 50.0) < 4 * 0.5
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+from astropy.io import fits
+
+try:
+    import fcntl
+except ImportError:
+    # e.g. Windows, where frames cannot be accumulated
+    fcntl = None
+
+logger = logging.getLogger('banzai')
+
+
+class FrameAccumulator:
+    """
+    Persistent cache of reduced frames waiting to be combined into a master calibration
+
+    Parameters
+    ----------
+    directory: str
+               Directory to keep the frames in. It is created when the first frame is added.
+
+    Notes
+    -----
+    Each frame is saved as uncompressed .npy files that are memory mapped when the frames are read back,
+    so combining them does not need to decompress or re-reduce anything. Frames are written to temporary
+    files and renamed into place before the manifest is updated, and the manifest is only changed while
+    holding a lock on the directory, so several worker processes can add frames at the same time.
+    Locking needs fcntl, so frames cannot be accumulated on Windows.
+    """
+    MANIFEST_FILENAME = 'frames.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def add(self, name, data, bpm, header, extension_headers=None):
+        """
+        Add a frame, replacing any earlier frame with the same name
+
+        Parameters
+        ----------
+        name: str
+              Name of the frame, e.g. the filename it was written to
+        data: numpy array
+              Image data. Saved as float32.
+        bpm: numpy array or None
+             Bad pixel mask. Saved as uint8.
+        header: astropy.io.fits.Header
+                Header of the frame
+        extension_headers: list of astropy.io.fits.Header
+                           Headers of the SCI extensions of multi-extension frames
+        """
+        if extension_headers is None:
+            extension_headers = []
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock():
+            manifest = self._read_manifest()
+            if name in manifest:
+                index = manifest[name]['index']
+            else:
+                index = max([frame['index'] for frame in manifest.values()], default=-1) + 1
+            self._save(index, 'data.npy', lambda f: np.save(f, np.asarray(data, dtype=np.float32)))
+            if bpm is not None:
+                self._save(index, 'bpm.npy', lambda f: np.save(f, np.asarray(bpm, dtype=np.uint8)))
+            for i, frame_header in enumerate([header] + list(extension_headers)):
+                self._save(index, 'header{i}.txt'.format(i=i), lambda f: f.write(frame_header.tostring().encode()))
+            manifest[name] = {'index': index, 'has_bpm': bpm is not None,
+                              'n_extension_headers': len(extension_headers), 'time_added': time.time()}
+            self._write_manifest(manifest)
+
+    def names(self):
+        """
+        Names of the frames that have been added
+        """
+        return list(self._read_manifest().keys())
+
+    def read(self, name):
+        """
+        Read a frame back
+
+        Parameters
+        ----------
+        name: str
+              Name the frame was added with
+
+        Returns
+        -------
+        data, bpm, header, extension_headers: read-only memory mapped numpy arrays (bpm is None if the frame
+                                              was added without one) and the astropy.io.fits.Headers
+        """
+        frame = self._read_manifest()[name]
+        data = np.load(self._path(frame['index'], 'data.npy'), mmap_mode='r')
+        bpm = np.load(self._path(frame['index'], 'bpm.npy'), mmap_mode='r') if frame['has_bpm'] else None
+        headers = []
+        for i in range(frame['n_extension_headers'] + 1):
+            with open(self._path(frame['index'], 'header{i}.txt'.format(i=i))) as header_file:
+                headers.append(fits.Header.fromstring(header_file.read()))
+        return data, bpm, headers[0], headers[1:]
+
+    def discard(self, names):
+        """
+        Delete frames, e.g. once they have been stacked into a master. The accumulator is removed when it is empty.
+
+        Parameters
+        ----------
+        names: iterable of str
+               Names of the frames. Names that are not in the accumulator are ignored.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        with self._lock():
+            manifest = self._read_manifest()
+            for name in set(names) & set(manifest.keys()):
+                frame = manifest.pop(name)
+                for filename in os.listdir(self.directory):
+                    if filename.startswith('{index:04d}.'.format(index=frame['index'])):
+                        os.remove(os.path.join(self.directory, filename))
+            if manifest:
+                self._write_manifest(manifest)
+            else:
+                self.remove()
+
+    def remove(self):
+        """
+        Delete the accumulator and all of its frames
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _path(self, index, suffix):
+        if index is None:
+            return os.path.join(self.directory, suffix)
+        return os.path.join(self.directory, '{index:04d}.{suffix}'.format(index=index, suffix=suffix))
+
+    def _save(self, index, suffix, write_function):
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as temp_file:
+                write_function(temp_file)
+            os.replace(temp_path, self._path(index, suffix))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _read_manifest(self):
+        try:
+            with open(self._path(None, self.MANIFEST_FILENAME)) as manifest_file:
+                return json.load(manifest_file)
+        except FileNotFoundError:
+            return {}
+
+    def _write_manifest(self, manifest):
+        self._save(None, self.MANIFEST_FILENAME, lambda f: f.write(json.dumps(manifest).encode()))
+
+    @contextmanager
+    def _lock(self):
+        if fcntl is None:
+            raise OSError('Calibration frames cannot be accumulated without fcntl file locking')
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_accumulators(directory):
+    """
+    Get all of the accumulators kept in a directory
+
+    Parameters
+    ----------
+    directory: str
+               Parent directory of the accumulators
+
+    Returns
+    -------
+    accumulators: list of FrameAccumulator
+    """
+    if not os.path.isdir(directory):
+        return []
+    return [FrameAccumulator(os.path.join(directory, name)) for name in sorted(os.listdir(directory))
+            if not name.startswith('.') and os.path.isdir(os.path.join(directory, name))]
+
+
+def remove_old_accumulators(directory, max_age):
+    """
+    Delete accumulators that have not had a frame added to them for max_age seconds
+    """
+    for accumulator in get_accumulators(directory):
+        try:
+            age = time.time() - os.path.getmtime(accumulator.directory)
+        except OSError:
+            # Another process removed it
+            continue
+        if age > max_age:
+            logger.info('Removing old calibration accumulator', extra_tags={'accumulator': accumulator.directory})
+            accumulator.remove()
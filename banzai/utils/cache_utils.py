@@ -0,0 +1,122 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread safe least recently used cache with a size budget
+
+    Parameters
+    ----------
+    max_size: int
+              Total size of the cached items above which the least recently used items are evicted
+    size_function: callable
+                   Function that returns the size of an item. Defaults to 1 per item.
+
+    Notes
+    -----
+    Items larger than max_size are never cached, and nothing is cached if max_size is 0, even items of
+    size 0. hits and misses count the calls to get.
+    """
+    def __init__(self, max_size, size_function=None):
+        self.max_size = max_size
+        if size_function is None:
+            size_function = _unit_size
+        self._size_function = size_function
+        self._items = OrderedDict()
+        self._item_sizes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        item_size = self._size_function(value)
+        with self._lock:
+            self._remove(key)
+            if self.max_size <= 0 or item_size > self.max_size:
+                return
+            while self.size + item_size > self.max_size:
+                self._remove(next(iter(self._items)))
+            self._items[key] = value
+            self._item_sizes[key] = item_size
+            self.size += item_size
+
+    def pop(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            self._remove(key)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._item_sizes.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        if key in self._items:
+            del self._items[key]
+            self.size -= self._item_sizes.pop(key)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
+def _unit_size(item):
+    return 1
+
+
+class TTLCache:
+    """
+    Thread safe cache whose items expire a fixed time after they were added
+
+    Parameters
+    ----------
+    ttl: float
+         Default number of seconds an item stays in the cache
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                value, expiration_time = self._items[key]
+                if time.monotonic() < expiration_time:
+                    return value
+                del self._items[key]
+            return default
+
+    def put(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + ttl)
+
+    def pop(self, key):
+        with self._lock:
+            value, _ = self._items.pop(key, (None, None))
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
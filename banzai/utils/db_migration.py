@@ -120,6 +120,7 @@ def migrate_db():
             row['type'] = 'BPM'
             row['is_master'] = True
             row['attributes'] = {'ccdsum': row.pop('ccdsum')}
+            row.update(dbs.calibration_attribute_columns(row['attributes']))
             del(row['id'])
         change_key_name(bpms, 'creation_date', 'dateobs')
         change_key_name(bpms, 'telescope_id', 'instrument_id')
@@ -140,6 +141,7 @@ def migrate_db():
         for row in calibrations:
             row['is_master'] = True
             row['attributes'] = {'filter': row.pop('filter_name'), 'ccdsum': row.pop('ccdsum')}
+            row.update(dbs.calibration_attribute_columns(row['attributes']))
             del(row['id'])
         change_key_name(calibrations, 'dayobs', 'dateobs')
         change_key_name(calibrations, 'telescope_id', 'instrument_id')
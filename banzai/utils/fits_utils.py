@@ -1,7 +1,7 @@
 import os
-import tempfile
 import logging
 import copy
+from concurrent.futures import ThreadPoolExecutor
 
 from banzai import logs
 
@@ -102,7 +102,7 @@ def parse_ra_dec(header):
     return ra, dec
 
 
-def open_fits_file(filename):
+def open_fits_file(filename, memmap=False):
     """
     Load a fits file
 
@@ -110,6 +110,9 @@ def open_fits_file(filename):
     ----------
     filename: str
               File name/path to open
+    memmap: bool
+            Memory map the data of uncompressed files instead of reading them into memory.
+            The maps are copy-on-write so modifying the arrays never changes the file on disk.
 
     Returns
     -------
@@ -117,16 +120,19 @@ def open_fits_file(filename):
 
     Notes
     -----
-    This is a wrapper to astropy.io.fits.open but funpacks the file first.
+    This is a wrapper to astropy.io.fits.open. Tile compressed (fpacked) files are decompressed
+    in memory so the returned HDUList has the same structure as the output of funpack. The memmap
+    option has no effect on compressed files. Memory mapped HDULists keep the file open until they
+    are closed, so close them as soon as the data has been accessed.
     """
     base_filename, file_extension = os.path.splitext(os.path.basename(filename))
     if file_extension == '.fz':
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            output_filename = os.path.join(tmpdirname, base_filename)
-            os.system('funpack -O {0} {1}'.format(output_filename, filename))
-            hdulist = fits.open(output_filename, 'readonly')
-            hdulist_copy = copy.deepcopy(hdulist)
-            hdulist.close()
+        with fits.open(filename, 'readonly', memmap=False) as hdulist:
+            hdulist_copy = unpack(hdulist)
+    elif memmap:
+        # Callers should close the HDUList once they have the arrays they need. Arrays that were already
+        # accessed keep their mapping, so closing only releases the file handle.
+        hdulist_copy = fits.open(filename, 'copyonwrite', memmap=True)
     else:
         hdulist = fits.open(filename, 'readonly')
         hdulist_copy = copy.deepcopy(hdulist)
@@ -134,16 +140,119 @@ def open_fits_file(filename):
     return hdulist_copy
 
 
+def unpack(compressed_hdulist):
+    """
+    Decompress the tile compressed extensions of an HDUList in memory
+
+    Parameters
+    ----------
+    compressed_hdulist: astropy.io.fits.HDUList
+                        HDUList that may contain CompImageHDUs
+
+    Returns
+    -------
+    hdulist: astropy.io.fits.HDUList
+             HDUList with all of the data read into memory
+
+    Notes
+    -----
+    This mirrors funpack: if the first extension was the primary HDU before compression
+    (ZSIMPLE is set), it replaces the empty primary HDU. The extensions are decompressed in parallel.
+    """
+    compressed_hdus = [hdu for hdu in compressed_hdulist if isinstance(hdu, fits.CompImageHDU)]
+    # Read the compressed tiles serially because the file handle is shared, then decompress
+    # each extension in its own thread. The decompressed arrays are cached on the HDUs.
+    for hdu in compressed_hdus:
+        hdu.compressed_data
+    map_in_threads(lambda hdu: hdu.data, compressed_hdus)
+
+    hdus = []
+    for hdu in compressed_hdulist:
+        if isinstance(hdu, fits.CompImageHDU):
+            if 'SIMPLE' in hdu.header and len(hdus) == 1 and hdus[0].data is None:
+                hdus[0] = fits.PrimaryHDU(data=hdu.data, header=hdu.header)
+            else:
+                hdus.append(fits.ImageHDU(data=hdu.data, header=hdu.header))
+        else:
+            # Make sure the data is read before the file is closed
+            hdu.data
+            hdus.append(hdu)
+    return fits.HDUList(hdus)
+
+
+def pack(uncompressed_hdulist, quantize_level=64):
+    """
+    Tile compress the image extensions of an HDUList the same way fpack does
+
+    Parameters
+    ----------
+    uncompressed_hdulist: astropy.io.fits.HDUList
+                          HDUList to compress
+    quantize_level: float
+                    Quantization level for floating point data (the fpack -q option)
+
+    Returns
+    -------
+    hdulist: astropy.io.fits.HDUList
+             HDUList with an empty primary HDU and the images stored as CompImageHDUs
+
+    Notes
+    -----
+    Images are RICE compressed one row per tile. Floating point data is quantized with
+    subtractive dithering like fpack; integer data (e.g. the BPM) is compressed losslessly.
+    Table extensions are left as they are.
+    """
+    hdus = [fits.PrimaryHDU()]
+    for hdu in uncompressed_hdulist:
+        if isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)) and hdu.data is not None:
+            # quantize_method=1 is SUBTRACTIVE_DITHER_1, the fpack default
+            hdus.append(fits.CompImageHDU(data=hdu.data, header=hdu.header, compression_type='RICE_1',
+                                          quantize_level=quantize_level, quantize_method=1))
+        elif isinstance(hdu, fits.PrimaryHDU):
+            hdus[0] = hdu
+        else:
+            hdus.append(hdu)
+    return fits.HDUList(hdus)
+
+
 def get_primary_header(filename):
+    """
+    Read the primary header of a fits file without reading any pixel data
+
+    Parameters
+    ----------
+    filename: str
+              File name/path to open
+
+    Returns
+    -------
+    header: astropy.io.fits.Header
+            The header that would be in the primary HDU after funpacking the file. None if the
+            file cannot be read.
+
+    Notes
+    -----
+    Only the header blocks are parsed. For fpacked files where the primary HDU was compressed into
+    the first extension (ZSIMPLE), the image header is rebuilt from the compressed header without
+    decompressing the data.
+    """
     try:
-        hdulist = open_fits_file(filename)
-        return hdulist[0].header
+        with fits.open(filename, 'readonly') as hdulist:
+            header = hdulist[0].header
+            if header.get('NAXIS', 0) == 0:
+                try:
+                    first_extension = hdulist[1]
+                except IndexError:
+                    first_extension = None
+                if isinstance(first_extension, fits.CompImageHDU) and 'SIMPLE' in first_extension.header:
+                    header = first_extension.header
+        return header
     except Exception:
         logger.error("Unable to open fits file: {}".format(logs.format_exception()), extra_tags={'filename': filename})
         return None
 
 
-def open_image(filename):
+def open_image(filename, memmap=False):
     """
     Load an image from a FITS file
 
@@ -151,6 +260,10 @@ def open_image(filename):
     ----------
     filename: str
               Full path of the file to open
+    memmap: bool
+            Return memory mapped arrays for uncompressed files. Data that is already 32-bit float
+            is not converted (it may be big endian) so no copy is made. Intended for read-only
+            use, e.g. master calibration frames.
 
     Returns
     -------
@@ -172,33 +285,108 @@ def open_image(filename):
     Sinsitro frames that were taken as datacubes will be munged later so that the
     output images are consistent
     """
-    hdulist = open_fits_file(filename)
-
-    # Get the main header
-    header = hdulist[0].header
-
-    # Check for multi-extension fits
-    extension_headers = []
-    sci_extensions = get_extensions_by_name(hdulist, 'SCI')
-    if len(sci_extensions) > 1:
-        data = np.zeros((len(sci_extensions), sci_extensions[0].data.shape[0],
-                         sci_extensions[0].data.shape[1]), dtype=np.float32)
-        for i, hdu in enumerate(sci_extensions):
-            data[i, :, :] = hdu.data[:, :]
-            extension_headers.append(hdu.header)
-    elif len(sci_extensions) == 1:
-        data = sci_extensions[0].data.astype(np.float32)
-    else:
-        data = hdulist[0].data.astype(np.float32)
+    # Memory mapped arrays stay valid once the HDUList is closed, so no file handle is kept per image
+    with open_fits_file(filename, memmap=memmap) as hdulist:
+        # Get the main header
+        header = hdulist[0].header
+
+        # Check for multi-extension fits
+        extension_headers = []
+        sci_extensions = get_extensions_by_name(hdulist, 'SCI')
+        if len(sci_extensions) > 1:
+            data = stack_extensions(sci_extensions, np.float32)
+            extension_headers = [hdu.header for hdu in sci_extensions]
+        elif len(sci_extensions) == 1:
+            data = to_float32(sci_extensions[0].data, copy=not memmap)
+        else:
+            data = to_float32(hdulist[0].data, copy=not memmap)
 
-    try:
-        bpm = hdulist['BPM'].data.astype(np.uint8)
-    except KeyError:
-        bpm = None
+        try:
+            bpm = hdulist['BPM'].data.astype(np.uint8, copy=not memmap)
+        except KeyError:
+            bpm = None
 
     return data, header, bpm, extension_headers
 
 
+def to_float32(data, copy=True):
+    """
+    Convert an array to 32-bit floats
+
+    Parameters
+    ----------
+    data: numpy array
+          Input array
+    copy: bool
+          If False, 32-bit float data of either byte order is returned as is
+
+    Returns
+    -------
+    data: numpy array
+          32-bit float array
+    """
+    if not copy and data.dtype.kind == 'f' and data.dtype.itemsize == 4:
+        return data
+    return data.astype(np.float32)
+
+
+def map_in_threads(function, items, max_workers=None):
+    """
+    Apply a function to each item using one thread per item
+
+    Parameters
+    ----------
+    function: callable
+              Function to apply. Should release the GIL (e.g. numpy operations or file I/O) to benefit.
+    items: list
+           Items to pass to the function
+    max_workers: int
+                 Maximum number of threads to use. Defaults to one thread per item.
+
+    Returns
+    -------
+    results: list
+             Return values of the function in the same order as the items
+    """
+    if max_workers is None:
+        max_workers = len(items)
+    if len(items) < 2 or max_workers < 2:
+        return [function(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(function, items))
+
+
+def stack_extensions(extensions, dtype):
+    """
+    Copy the data from a list of extensions into a 3D array
+
+    Parameters
+    ----------
+    extensions: list of astropy.io.fits HDUs
+                Extensions that all have data of the same shape
+    dtype: numpy dtype
+           Data type of the output array
+
+    Returns
+    -------
+    data: numpy array
+          Array of shape (n_extensions, ny, nx)
+
+    Notes
+    -----
+    The data is read from the HDUs serially, then each extension is converted and copied into
+    its slice of the output array in a separate thread.
+    """
+    extension_data = [extension.data for extension in extensions]
+    data = np.zeros((len(extension_data),) + extension_data[0].shape, dtype=dtype)
+
+    def copy_extension(i):
+        data[i, :, :] = extension_data[i][:, :]
+
+    map_in_threads(copy_extension, list(range(len(extension_data))))
+    return data
+
+
 def get_extensions_by_name(fits_hdulist, name):
     """
     Get a list of the science extensions from a multi-extension fits file (HDU list)
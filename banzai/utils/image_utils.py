@@ -5,7 +5,7 @@ import logging
 from banzai import logs
 from banzai import dbs
 from banzai.munge import munge
-from banzai.utils.fits_utils import get_primary_header
+from banzai.utils.fits_utils import get_primary_header, map_in_threads
 from banzai.utils.instrument_utils import instrument_passes_criteria
 from banzai.utils import import_utils
 from banzai.exceptions import InhomogeneousSetException
@@ -25,21 +25,67 @@ def is_master(header):
     return header.get('ISMASTER', False)
 
 
-def select_images(image_list, image_type, context):
-    images = []
-    for filename in image_list:
-        try:
-            header = get_primary_header(filename)
-            should_process = image_can_be_processed(header, context)
-            should_process &= (image_type is None or get_obstype(header) == image_type)
-            if not context.ignore_schedulability:
-                instrument = dbs.get_instrument(header, db_address=context.db_address)
-                should_process &= instrument.schedulable
-            if should_process:
-                images.append(filename)
-        except Exception:
-            logger.error(logs.format_exception(), extra_tags={'filename': filename})
-    return images
+def select_images(image_list, image_type, context, max_workers=1):
+    headers = map_in_threads(lambda filename: _get_header_to_process(filename, image_type, context), image_list,
+                             max_workers=max_workers)
+    return [filename for filename, header in zip(image_list, headers) if header is not None]
+
+
+def _get_header_to_process(filename, image_type, context):
+    """
+    Primary header of a file if it should be processed, otherwise None. Only the header is read.
+    """
+    try:
+        header = get_primary_header(filename)
+        should_process = image_can_be_processed(header, context)
+        should_process &= (image_type is None or get_obstype(header) == image_type)
+        if should_process and not context.ignore_schedulability:
+            instrument = dbs.get_instrument(header, db_address=context.db_address)
+            should_process &= instrument.schedulable
+        if should_process:
+            return header
+    except Exception:
+        logger.error(logs.format_exception(), extra_tags={'filename': filename})
+    return None
+
+
+def select_frames_to_reduce(raw_path, context, max_workers=1):
+    """
+    Find the frames in a directory (or matching a glob) that should be reduced, in the order to reduce them
+
+    Parameters
+    ----------
+    raw_path: str
+              Directory or glob pattern of the raw frames
+    context: banzai.context.Context
+    max_workers: int
+                 Number of threads to read the headers with
+
+    Returns
+    -------
+    frames: list of tuples
+            (filename, obstype) of each frame to reduce. Calibration frames come first in the order of
+            context.CALIBRATION_IMAGE_TYPES, followed by all other frames. Frames of the same type are sorted by
+            filename.
+
+    Notes
+    -----
+    Only the primary header of each frame is read to decide whether it should be reduced.
+    """
+    image_list = sorted(make_image_path_list(raw_path))
+    headers = map_in_threads(lambda filename: _get_header_to_process(filename, None, context), image_list,
+                             max_workers=max_workers)
+    frames = [(filename, get_obstype(header)) for filename, header in zip(image_list, headers) if header is not None]
+    return sorted(frames, key=lambda frame: get_reduction_phase(frame[1], context.CALIBRATION_IMAGE_TYPES))
+
+
+def get_reduction_phase(obstype, calibration_image_types):
+    """
+    Position of the calibration type in calibration_image_types, or len(calibration_image_types) for science frames
+    """
+    if obstype in calibration_image_types:
+        return calibration_image_types.index(obstype)
+    return len(calibration_image_types)
 
 
 def make_image_path_list(raw_path):
@@ -93,10 +139,13 @@ def image_can_be_processed(header, context):
     return passes
 
 
-def read_image(filename, runtime_context):
+def read_image(filename, runtime_context, memmap=False):
     try:
         frame_class = import_utils.import_attribute(runtime_context.FRAME_CLASS)
-        image = frame_class(runtime_context, filename=filename)
+        if memmap:
+            image = frame_class(runtime_context, filename=filename, memmap=True)
+        else:
+            image = frame_class(runtime_context, filename=filename)
         if image.instrument is None:
             logger.error("Image instrument attribute is None, aborting", image=image)
             raise IOError
@@ -0,0 +1,275 @@
+import sys
+import mmap
+import time
+import logging
+import threading
+import tracemalloc
+from collections import defaultdict, deque
+
+import numpy as np
+
+from banzai import settings
+from banzai.utils import qc
+
+try:
+    import resource
+except ImportError:
+    # e.g. Windows
+    resource = None
+
+logger = logging.getLogger('banzai')
+
+# ru_maxrss is in kilobytes on Linux but in bytes on macOS
+_MAX_RSS_UNITS = 1 if sys.platform == 'darwin' else 1024
+
+
+def current_rss():
+    """
+    Resident set size of this process in bytes, or None if it cannot be read (only Linux has /proc/self/statm)
+    """
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * mmap.PAGESIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def peak_rss():
+    """
+    Largest resident set size this process has had so far in bytes
+
+    Without the resource module it is read from /proc/self/status, or is 0 if that does not exist either.
+    """
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAX_RSS_UNITS
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    return 0
+
+
+class StageTimer:
+    """
+    Measure the wall time, CPU time and memory use of a stage from when the timer is created until stop is called
+
+    Notes
+    -----
+    peak_rss_increase is how far the stage pushed the high water mark of the process memory, so it is only non-zero
+    for stages that need more memory than anything that ran before them. If settings.STAGE_TRACEMALLOC is set,
+    tracemalloc is also used to measure the peak memory allocated while the stage ran (numpy arrays included), at
+    the cost of slowing down every allocation. On python < 3.9 the traces are cleared when each stage starts.
+    """
+    def __init__(self):
+        if settings.STAGE_TRACEMALLOC and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._tracing = tracemalloc.is_tracing()
+        if self._tracing:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                # python < 3.9 has no reset_peak, but clearing the traces also resets the peak
+                tracemalloc.clear_traces()
+            self._traced_memory_start = tracemalloc.get_traced_memory()[0]
+        self._rss_start = current_rss()
+        self._peak_rss_start = peak_rss()
+        self._cpu_time_start = time.process_time()
+        self._wall_time_start = time.perf_counter()
+
+    def stop(self):
+        """
+        Returns
+        -------
+        measurement: dict
+                     wall_time and cpu_time in seconds, and rss_change, peak_rss_increase and (if tracing)
+                     peak_traced_memory in bytes
+        """
+        measurement = {'wall_time': time.perf_counter() - self._wall_time_start,
+                       'cpu_time': time.process_time() - self._cpu_time_start,
+                       'peak_rss_increase': peak_rss() - self._peak_rss_start}
+        rss = current_rss()
+        if rss is not None and self._rss_start is not None:
+            measurement['rss_change'] = rss - self._rss_start
+        if self._tracing and tracemalloc.is_tracing():
+            measurement['peak_traced_memory'] = tracemalloc.get_traced_memory()[1] - self._traced_memory_start
+        return measurement
+
+
+class AccumulatingStageTimer:
+    """
+    Add up the wall time, CPU time and peak memory increase of a stage whose work is split over many calls,
+    e.g. the bands of a banzai.stages.BandStreamer
+
+    Notes
+    -----
+    Each call only reads the clocks and the peak RSS, so this is much cheaper than a StageTimer per call.
+    tracemalloc is not used.
+    """
+    def __init__(self):
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_rss_increase = 0
+
+    def call(self, function, *args):
+        peak_rss_start = peak_rss()
+        cpu_time_start = time.process_time()
+        wall_time_start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.add(time.perf_counter() - wall_time_start, time.process_time() - cpu_time_start,
+                     peak_rss() - peak_rss_start)
+
+    def add(self, wall_time, cpu_time, peak_rss_increase):
+        """
+        Add time and memory that were measured elsewhere
+        """
+        self.wall_time += wall_time
+        self.cpu_time += cpu_time
+        self.peak_rss_increase += peak_rss_increase
+
+    def measurement(self):
+        """
+        Returns
+        -------
+        measurement: dict
+                     wall_time and cpu_time in seconds and peak_rss_increase in bytes, like StageTimer.stop
+        """
+        return {'wall_time': self.wall_time, 'cpu_time': self.cpu_time, 'peak_rss_increase': self.peak_rss_increase}
+
+
+class StageStatistics:
+    """
+    Thread safe rolling record of the measurements of each stage for each instrument
+
+    Parameters
+    ----------
+    max_samples: int
+                 Number of the most recent runs of each stage on each instrument to keep
+    """
+    def __init__(self, max_samples):
+        self.max_samples = max_samples
+        self._measurements = defaultdict(lambda: deque(maxlen=self.max_samples))
+        self._lock = threading.Lock()
+
+    def add(self, stage_name, instrument, measurement):
+        with self._lock:
+            self._measurements[(stage_name, instrument)].append(measurement)
+
+    def percentiles(self, stage_name, instrument, quantity='wall_time', percentiles=(50, 95, 99)):
+        """
+        Percentiles of a measured quantity over the recent runs of a stage on an instrument
+
+        Returns
+        -------
+        percentiles: dict
+                     e.g. {'n': 100, 'p50': 0.1, 'p95': 0.2, 'p99': 0.3}. Only n (zero) if the stage has not run.
+        """
+        with self._lock:
+            values = [measurement[quantity] for measurement in self._measurements.get((stage_name, instrument), [])
+                      if quantity in measurement]
+        result = {'n': len(values)}
+        if values:
+            for percentile, value in zip(percentiles, np.percentile(values, percentiles)):
+                result['p{0}'.format(percentile)] = float(value)
+        return result
+
+    def summary(self, quantity='wall_time'):
+        """
+        Percentiles of a measured quantity for every stage and instrument
+
+        Returns
+        -------
+        summary: dict
+                 Percentiles (see percentiles) keyed by (stage_name, instrument)
+        """
+        with self._lock:
+            keys = list(self._measurements.keys())
+        return {key: self.percentiles(*key, quantity=quantity) for key in sorted(keys)}
+
+    def clear(self):
+        with self._lock:
+            self._measurements.clear()
+
+
+STAGE_STATISTICS = StageStatistics(settings.STAGE_STATISTICS_WINDOW)
+_FRAME_COUNTER = {'frames_since_summary': 0}
+
+
+def _instrument_name(image):
+    instrument_name = getattr(getattr(image, 'instrument', None), 'name', None)
+    if not instrument_name:
+        instrument_name = getattr(image, 'camera', '')
+    return instrument_name
+
+
+def record_stage_measurement(stage_name, measurement, image, processed_image=None, extra_tags=None):
+    """
+    Log a stage measurement, add it to STAGE_STATISTICS and keep it with the image for the per-frame summary
+
+    Parameters
+    ----------
+    stage_name: str
+                Full name of the stage
+    measurement: dict
+                 Measurement from StageTimer.stop
+    image: banzai.images.Image
+           Image the stage was run on, used for the logging tags
+    processed_image: banzai.images.Image
+                     Image returned by the stage. The measurement is appended to its stage_measurements.
+    extra_tags: dict
+                Extra logging tags
+    """
+    STAGE_STATISTICS.add(stage_name, _instrument_name(image), measurement)
+    logging_tags = {'stage': stage_name}
+    logging_tags.update(measurement)
+    if extra_tags is not None:
+        logging_tags.update(extra_tags)
+    logger.info('Finished {0}'.format(stage_name), image=image, extra_tags=logging_tags)
+    if processed_image is not None:
+        if getattr(processed_image, 'stage_measurements', None) is None:
+            processed_image.stage_measurements = []
+        processed_image.stage_measurements.append((stage_name, measurement))
+
+
+def summarize_frame(image, runtime_context):
+    """
+    Record the stage measurements of a frame that has finished reducing
+
+    The measurements are written to the header as HISTORY records if settings.STAGE_TIMING_HISTORY is set and to
+    the QC database if settings.STAGE_TIMING_QC is set. Every settings.STAGE_STATISTICS_LOG_INTERVAL frames the
+    rolling percentiles of every stage are logged.
+    """
+    stage_measurements = getattr(image, 'stage_measurements', None) or []
+    if settings.STAGE_TIMING_HISTORY and stage_measurements:
+        image.header.add_history('Stage timings: wall time [s], CPU time [s], peak memory increase [MB]')
+        for stage_name, measurement in stage_measurements:
+            image.header.add_history('{stage} {wall:.3f} {cpu:.3f} {memory:.1f}'.format(
+                stage=stage_name.split('.')[-1], wall=measurement['wall_time'], cpu=measurement['cpu_time'],
+                memory=measurement.get('peak_traced_memory', measurement['peak_rss_increase']) / 1024 ** 2))
+    if settings.STAGE_TIMING_QC and stage_measurements:
+        qc_results = {}
+        for stage_name, measurement in stage_measurements:
+            for quantity in ['wall_time', 'cpu_time']:
+                qc_results['stage_timing.{stage}.{quantity}'.format(stage=stage_name.split('.')[-1],
+                                                                    quantity=quantity)] = measurement[quantity]
+        qc.save_qc_results(runtime_context, qc_results, image)
+
+    _FRAME_COUNTER['frames_since_summary'] += 1
+    if settings.STAGE_STATISTICS_LOG_INTERVAL > 0 and \
+            _FRAME_COUNTER['frames_since_summary'] >= settings.STAGE_STATISTICS_LOG_INTERVAL:
+        _FRAME_COUNTER['frames_since_summary'] = 0
+        log_stage_statistics()
+
+
+def log_stage_statistics():
+    """
+    Log the rolling wall time percentiles of every stage on every instrument
+    """
+    for (stage_name, instrument), percentiles in STAGE_STATISTICS.summary().items():
+        logging_tags = {'stage': stage_name, 'instrument': instrument}
+        logging_tags.update(percentiles)
+        logger.info('Stage wall time percentiles', extra_tags=logging_tags)
@@ -1,8 +1,10 @@
 # cython: boundscheck=False, nonecheck=False, wraparound=False
 # cython: cdivision=True
 from __future__ import absolute_import, division, print_function, unicode_literals
-from libc.stdint cimport uint8_t
+from libc.stdint cimport uint8_t, uint32_t, int64_t
 from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy
+from libc.math cimport fabsf
 import numpy as np
 cimport numpy as np
 
@@ -11,8 +13,20 @@ from cython.parallel import parallel, prange
 
 np.import_array()
 
+# Arrays at least this long are handed to parallel_median1d by median1d
+DEF PARALLEL_MEDIAN_MIN_SIZE = 1048576
+# Number of pixels each thread histograms at a time in parallel_median1d
+DEF RADIX_CHUNK_SIZE = 262144
+# integer_histogram counts integer values from 0 up to this size. Enough for raw 16 bit data.
+DEF INTEGER_HISTOGRAM_SIZE = 65536
+# Approximate number of pixels each thread histograms at a time in integer_histogram
+DEF INTEGER_HISTOGRAM_CHUNK_SIZE = 1048576
+# Maximum number of per-thread histograms integer_histogram keeps in memory at once
+DEF INTEGER_HISTOGRAM_MAX_CHUNKS = 16
+
 cdef extern from "quick_select.h":
     float quick_select(float * k, int k, int n) nogil
+    float median_select(float * a, int n) nogil
 
 
 @cython.boundscheck(False)
@@ -29,12 +43,8 @@ def _quick_select(float[::1] a not None, int k):
 @cython.wraparound(False)
 cdef float _cmedian1d(float* ptr, int n) nogil:
     cdef float med = 0.0
-    cdef int k = (n - 1) // 2
     if n > 0:
-        med = quick_select(ptr, k, n)
-        if n % 2 == 0:
-            med += quick_select(ptr, k + 1, n)
-            med /= 2.0
+        med = median_select(ptr, n)
     return med
 
 
@@ -58,6 +68,7 @@ def median1d(float[::1] d not None, uint8_t[::1] mask not None):
     Notes
     -----
     Makes extensive use of the quick select algorithm written in C, included in median_utils.c.
+    Arrays with more than a million elements are handed to parallel_median1d instead.
     If all of the elements in the array are masked (or all of the elements of the axis of interest
     are masked), we return zero. This has comparable performance to np.median on unmasked data,
     but does not require the gil. For masked arrays, the performance is significantly better
@@ -66,6 +77,8 @@ def median1d(float[::1] d not None, uint8_t[::1] mask not None):
     """
 
     cdef int n = d.shape[0]
+    if n >= PARALLEL_MEDIAN_MIN_SIZE:
+        return parallel_median1d(d, mask)
 
     cdef float[::1] median_array = np.empty(n, dtype=np.float32)
 
@@ -79,6 +92,194 @@ def median1d(float[::1] d not None, uint8_t[::1] mask not None):
     return _cmedian1d(&median_array[0], n_unmasked_pixels)
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline uint32_t _float_to_key(float value) nogil:
+    # Map a float to an unsigned integer with the same ordering
+    cdef uint32_t bits
+    memcpy(&bits, &value, sizeof(float))
+    if bits & 0x80000000u:
+        return ~bits
+    return bits | 0x80000000u
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline float _key_to_float(uint32_t key) nogil:
+    cdef float value
+    if key & 0x80000000u:
+        key = key & 0x7fffffffu
+    else:
+        key = ~key
+    memcpy(&value, &key, sizeof(float))
+    return value
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef _radix_histogram(float[::1] d, uint8_t[::1] mask, uint32_t prefix, int prefix_bits, int shift, int n_bits):
+    # Histogram bits [shift, shift + n_bits) of the keys of the unmasked elements whose highest prefix_bits bits
+    # are prefix. Each chunk of the array gets its own row of the histogram so the chunks can be done in parallel.
+    cdef int n = d.shape[0]
+    cdef int n_chunks = (n + RADIX_CHUNK_SIZE - 1) // RADIX_CHUNK_SIZE
+    cdef uint32_t bin_mask = (1u << n_bits) - 1
+    cdef int prefix_shift = 32 - prefix_bits
+    histogram = np.zeros((n_chunks, 1 << n_bits), dtype=np.int64)
+    cdef int64_t[:, ::1] histogram_view = histogram
+    cdef int chunk, i, stop
+    cdef uint32_t key
+    with nogil:
+        for chunk in prange(n_chunks, schedule='dynamic'):
+            stop = min((chunk + 1) * RADIX_CHUNK_SIZE, n)
+            for i in range(chunk * RADIX_CHUNK_SIZE, stop):
+                if mask[i] == 0:
+                    key = _float_to_key(d[i])
+                    # Compare in 64 bits because shifting a 32 bit integer by 32 is undefined
+                    if (<unsigned long long> key) >> prefix_shift == prefix:
+                        histogram_view[chunk, (key >> shift) & bin_mask] += 1
+    return histogram.sum(axis=0)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef uint32_t _smallest_key_above(float[::1] d, uint8_t[::1] mask, uint32_t threshold):
+    cdef int n = d.shape[0]
+    cdef int n_chunks = (n + RADIX_CHUNK_SIZE - 1) // RADIX_CHUNK_SIZE
+    smallest_keys = np.full(n_chunks, 0xffffffff, dtype=np.uint32)
+    cdef uint32_t[::1] smallest_keys_view = smallest_keys
+    cdef int chunk, i, stop
+    cdef uint32_t key
+    with nogil:
+        for chunk in prange(n_chunks, schedule='dynamic'):
+            stop = min((chunk + 1) * RADIX_CHUNK_SIZE, n)
+            for i in range(chunk * RADIX_CHUNK_SIZE, stop):
+                if mask[i] == 0:
+                    key = _float_to_key(d[i])
+                    if key > threshold and key < smallest_keys_view[chunk]:
+                        smallest_keys_view[chunk] = key
+    return smallest_keys.min()
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def parallel_median1d(float[::1] d not None, uint8_t[::1] mask not None):
+    """parallel_median1d(d, mask)\n
+    Find the median of a large numpy array using all of the available threads.
+    Parameters
+    ----------
+    d : float numpy array
+        Input array to find the median.
+    mask: unit8 numpy array
+          Numpy array of bitmask values. Non-zero values are ignored when calculating the median.
+    Returns
+    -------
+    med : float
+        The median value. Exactly the same as median1d.
+    Notes
+    -----
+    This is a radix select: the floats are mapped to unsigned integers with the same ordering and the
+    median is found 11 bits at a time by histogramming the integers in parallel, keeping only the elements
+    in the histogram bin that contains the median for the next round. Three passes over the array pin down
+    the exact value of the median without copying or reordering the data, and the passes split the array
+    between the threads, unlike quick select which has to partition a single copy of the array. Returns zero
+    if all of the elements are masked.
+    """
+    cdef int64_t rank = 0
+    cdef int64_t n_unmasked_pixels = 0
+    cdef uint32_t prefix = 0
+    cdef int prefix_bits = 0
+    cdef int n_bits, shift
+    cdef float lower, upper
+
+    counts = None
+    bin_index = 0
+    for n_bits in (11, 11, 10):
+        shift = 32 - prefix_bits - n_bits
+        counts = _radix_histogram(d, mask, prefix, prefix_bits, shift, n_bits)
+        cumulative_counts = np.cumsum(counts)
+        if prefix_bits == 0:
+            n_unmasked_pixels = cumulative_counts[len(cumulative_counts) - 1]
+            if n_unmasked_pixels == 0:
+                return 0.0
+            rank = (n_unmasked_pixels - 1) // 2
+        bin_index = np.searchsorted(cumulative_counts, rank, side='right')
+        rank -= cumulative_counts[bin_index] - counts[bin_index]
+        prefix = (prefix << n_bits) | bin_index
+        prefix_bits += n_bits
+
+    lower = _key_to_float(prefix)
+    if n_unmasked_pixels % 2 == 1:
+        return lower
+    # The last histogram counts each distinct value so we know if the upper middle element is a copy of the lower one
+    if rank + 1 < counts[bin_index]:
+        upper = lower
+    else:
+        upper = _key_to_float(_smallest_key_above(d, mask, prefix))
+    lower += upper
+    lower /= 2.0
+    return lower
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def integer_histogram(float[:, :] d not None, uint8_t[:, :] mask):
+    """integer_histogram(d, mask)\n
+    Count how many times each integer value between 0 and 65535 appears in a 2d array.
+    Parameters
+    ----------
+    d : float32 numpy array
+        Input array. Does not need to be contiguous.
+    mask: unit8 numpy array or None
+          Numpy array of bitmask values. Non-zero values are not counted.
+    Returns
+    -------
+    histogram : int64 numpy array or None
+        The number of unmasked elements equal to each value from 0 to 65535. None if any unmasked
+        element is not an integer in that range, e.g. the data has already been bias subtracted.
+    Notes
+    -----
+    Blocks of rows are histogrammed in parallel, each into its own histogram, and the histograms are
+    added together at the end, so the data is only read once and is never copied. A block stops at the
+    first element that cannot be counted, so data that is not integer valued is rejected quickly.
+    """
+    cdef Py_ssize_t ny = d.shape[0]
+    cdef Py_ssize_t nx = d.shape[1]
+    cdef bint has_mask = mask is not None
+    cdef Py_ssize_t n_chunks = max(1, min(ny, INTEGER_HISTOGRAM_MAX_CHUNKS, (ny * nx) // INTEGER_HISTOGRAM_CHUNK_SIZE))
+    cdef Py_ssize_t rows_per_chunk = (ny + n_chunks - 1) // n_chunks
+
+    histograms = np.zeros((n_chunks, INTEGER_HISTOGRAM_SIZE), dtype=np.int32)
+    cdef int[:, ::1] histograms_view = histograms
+    not_integer = np.zeros(n_chunks, dtype=np.uint8)
+    cdef uint8_t[::1] not_integer_view = not_integer
+
+    cdef Py_ssize_t chunk, j, i
+    cdef float value
+    cdef int bin_index
+    with nogil:
+        for chunk in prange(n_chunks, schedule='dynamic'):
+            for j in range(chunk * rows_per_chunk, min((chunk + 1) * rows_per_chunk, ny)):
+                if not_integer_view[chunk]:
+                    break
+                for i in range(nx):
+                    if has_mask and mask[j, i] != 0:
+                        continue
+                    value = d[j, i]
+                    # Written so that NaNs fail the check
+                    if not (value >= 0 and value < INTEGER_HISTOGRAM_SIZE):
+                        not_integer_view[chunk] = 1
+                        break
+                    bin_index = <int> value
+                    if bin_index != value:
+                        not_integer_view[chunk] = 1
+                        break
+                    histograms_view[chunk, bin_index] += 1
+
+    if not_integer.any():
+        return None
+    return histograms.sum(axis=0, dtype=np.int64)
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 def median2d(float[:, ::1] d, uint8_t[:, ::1] mask):
@@ -105,3 +306,110 @@ def median2d(float[:, ::1] d, uint8_t[:, ::1] mask):
             output_array[j] = _cmedian1d(median_array, n_unmasked_pixels)
         free(median_array)
     return output_array
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef float _pairwise_sum(float* a, int n) nogil:
+    # Sum in the same order as numpy's pairwise summation so the results are bit-for-bit identical to np.sum
+    cdef float res = 0.0
+    cdef float r[8]
+    cdef int i, j, n2
+    if n < 8:
+        for i in range(n):
+            res = res + a[i]
+        return res
+    elif n <= 128:
+        for j in range(8):
+            r[j] = a[j]
+        i = 8
+        while i < n - (n % 8):
+            for j in range(8):
+                r[j] = r[j] + a[i + j]
+            i = i + 8
+        res = ((r[0] + r[1]) + (r[2] + r[3])) + ((r[4] + r[5]) + (r[6] + r[7]))
+        while i < n:
+            res = res + a[i]
+            i = i + 1
+        return res
+    else:
+        n2 = n // 2
+        n2 = n2 - n2 % 8
+        return _pairwise_sum(a, n2) + _pairwise_sum(a + n2, n - n2)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def sigma_clipped_mean2d(float[:, ::1] d, uint8_t[:, ::1] mask, float sigma, float fill_value):
+    """sigma_clipped_mean2d(d, mask, sigma, fill_value)\n
+    Find the sigma clipped mean of each row of a 2d array.
+    Parameters
+    ----------
+    d : float32 numpy array
+        Input array. The mean is taken along the second axis.
+    mask: unit8 numpy array
+          Numpy array of bitmask values. Non-zero values are ignored.
+    sigma: float
+           Values more than sigma robust standard deviations from the median are ignored.
+    fill_value: float
+                Value to use for rows where every element is masked or clipped
+    Returns
+    -------
+    mean : float32 numpy array
+        The sigma clipped mean of each row
+    Notes
+    -----
+    This fuses the median, the median absolute deviation, the clipping and the mean into a single
+    pass over each row, so the only memory it needs beyond the output is two rows of scratch space per
+    thread. The arithmetic matches banzai.utils.stats.sigma_clipped_mean exactly.
+    """
+
+    cdef int nx = d.shape[1]
+    cdef int ny = d.shape[0]
+
+    cdef int j = 0
+    cdef int i
+
+    cdef float[::1] output_array = np.empty(ny, dtype=np.float32)
+    cdef float* scratch_array
+    cdef float* sum_array
+    cdef int n_unmasked_pixels = 0
+    cdef int n_good_pixels = 0
+    cdef float row_median, row_mad, threshold
+    cdef float robust_std_scale = 1.4826
+
+    with nogil, parallel():
+        scratch_array = <float *> malloc(nx * sizeof(float))
+        sum_array = <float *> malloc(nx * sizeof(float))
+        for j in prange(ny):
+            n_unmasked_pixels = 0
+            for i in range(nx):
+                if mask[j, i] == 0:
+                    scratch_array[n_unmasked_pixels] = d[j, i]
+                    n_unmasked_pixels = n_unmasked_pixels + 1
+            row_median = _cmedian1d(scratch_array, n_unmasked_pixels)
+
+            n_unmasked_pixels = 0
+            for i in range(nx):
+                if mask[j, i] == 0:
+                    scratch_array[n_unmasked_pixels] = fabsf(d[j, i] - row_median)
+                    n_unmasked_pixels = n_unmasked_pixels + 1
+            row_mad = _cmedian1d(scratch_array, n_unmasked_pixels)
+            threshold = sigma * (robust_std_scale * row_mad)
+
+            # Clipped values are zeroed rather than skipped so the sum is done in the same order as numpy
+            n_good_pixels = 0
+            for i in range(nx):
+                if mask[j, i] == 0 and not fabsf(d[j, i] - row_median) > threshold:
+                    sum_array[i] = d[j, i]
+                    n_good_pixels = n_good_pixels + 1
+                else:
+                    sum_array[i] = 0.0
+
+            if n_good_pixels > 0:
+                output_array[j] = <float> (<double> _pairwise_sum(sum_array, nx) / n_good_pixels)
+            else:
+                output_array[j] = fill_value
+        free(scratch_array)
+        free(sum_array)
+    return output_array
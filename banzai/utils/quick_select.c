@@ -3,6 +3,109 @@
 #include<stdint.h>
 
 #define ELEM_SWAP(a,b) { float t=(a); (a)=(b); (b)=t; }
+/* Branch-free compare and exchange: compiles to a min and a max instead of a conditional jump */
+#define COMPARE_EXCHANGE(a,b) { float x=(a); float y=(b); (a)=(y < x) ? y : x; (b)=(x < y) ? y : x; }
+
+
+static void
+heap_sift_down(float* a, int root, int n)
+{
+    /* Restore the max-heap property of the heap a[0:n] below root */
+    int child;
+    float value = a[root];
+    while ((child = 2 * root + 1) < n) {
+        if (child + 1 < n && a[child] < a[child + 1])
+            child++;
+        if (!(value < a[child]))
+            break;
+        a[root] = a[child];
+        root = child;
+    }
+    a[root] = value;
+}
+
+
+static void
+heap_sort(float* a, int n)
+{
+    /* In place heap sort. Used as the guaranteed O(n log n) fallback of quick_select. */
+    int i;
+    for (i = n / 2 - 1; i >= 0; i--)
+        heap_sift_down(a, i, n);
+    for (i = n - 1; i > 0; i--) {
+        ELEM_SWAP(a[0], a[i]);
+        heap_sift_down(a, 0, i);
+    }
+}
+
+
+void
+sorting_network(float* a, int n)
+{
+    /* Sort a short array with Batcher's merge exchange network
+     * (Knuth, The Art of Computer Programming Vol. 3, Section 5.2.2, Algorithm M).
+     * The sequence of comparisons only depends on n, not on the data, so there are no
+     * branches to mispredict. The number of comparisons grows as n log^2 n, so this is only
+     * worth it for small arrays, e.g. the per-pixel stacks of a master calibration.
+     */
+    int t = 0, p, q, r, d, i, j;
+    if (n < 2)
+        return;
+    while ((1 << t) < n)
+        t++;
+    for (p = 1 << (t - 1); p > 0; p >>= 1) {
+        q = 1 << (t - 1);
+        r = 0;
+        d = p;
+        while (1) {
+            /* Compare a[i] with a[i + d] for every i with (i & p) == r */
+            for (j = r; j < n - d; j += 2 * p) {
+                for (i = j; i < j + p && i < n - d; i++)
+                    COMPARE_EXCHANGE(a[i], a[i + d]);
+            }
+            if (q == p)
+                break;
+            d = q - p;
+            q >>= 1;
+            r = p;
+        }
+    }
+}
+
+
+float
+median_select(float* a, int n)
+{
+    /* Get the median of an array "a" with length "n" > 0, reordering "a" in the process.
+     * For even n the median is the mean of the two middle elements.
+     * Short arrays are sorted with a branch-free sorting network. Longer arrays use
+     * quick_select for the lower middle element. Quick_select leaves every element after the
+     * kth element no smaller than it, so the upper middle element is the smallest of those
+     * and is found with a single linear scan rather than a second selection.
+     */
+    int k = (n - 1) / 2;
+    int i;
+    float lower, upper;
+    if (n <= SORTING_NETWORK_MAX_SIZE) {
+        sorting_network(a, n);
+        lower = a[k];
+        upper = a[n / 2];
+    }
+    else {
+        lower = quick_select(a, k, n);
+        upper = lower;
+        if (n % 2 == 0) {
+            upper = a[k + 1];
+            for (i = k + 2; i < n; i++)
+                upper = (a[i] < upper) ? a[i] : upper;
+        }
+    }
+    if (n % 2 == 0) {
+        lower += upper;
+        lower /= 2.0;
+    }
+    return lower;
+}
 
 
 float
@@ -14,6 +117,9 @@ quick_select(float* a, int k, int n)
      * "Numerical recipes in C", Second Edition, Cambridge University Press,
      * 1992, Section 8.5, ISBN 0-521-43108-5
      * This code adapted from code by Nicolas Devillard - 1998. Used with permission. Public domain.
+     * Like introselect, if the partitioning has not converged after 2 log2(n) rounds (i.e. the
+     * pivots are consistently bad) the remaining partition is heap sorted, which bounds the
+     * worst case at O(n log n).
      */
 
     PyDoc_STRVAR(quick_select__doc__, "quick_select(a, k, n) -> float\n\n"
@@ -28,8 +134,10 @@ quick_select(float* a, int k, int n)
     /* The value to return */
     float value;
 
-    /* running index i */
-    int i;
+    /* Number of partitioning rounds left before falling back to heap sort */
+    int depth_limit = 0;
+    for (middle = n; middle > 0; middle >>= 1)
+        depth_limit += 2;
 
     /* Start an infinite loop */
     while (1) {
@@ -43,6 +151,11 @@ quick_select(float* a, int k, int n)
             return value;
         }
 
+        if (depth_limit-- == 0) {
+            heap_sort(a + low, high - low + 1);
+            return a[k];
+        }
+
         /* Find median of low, middle and high items;
          * swap into position low */
         middle = (low + high) / 2;
@@ -88,3 +201,4 @@ quick_select(float* a, int k, int n)
 }
 
 #undef ELEM_SWAP
+#undef COMPARE_EXCHANGE
@@ -5,3 +5,12 @@
 
 /*Get the kth element of an array "a" with length "n" using the Quickselect algorithm. */
 float quick_select(float* a, int k, int n);
+
+/* Arrays up to this length are sorted with a sorting network rather than partitioned by quick_select */
+#define SORTING_NETWORK_MAX_SIZE 32
+
+/* Sort a short array in place with a branch-free sorting network. */
+void sorting_network(float* a, int n);
+
+/* Get the median of an array "a" with length "n" > 0, reordering "a". */
+float median_select(float* a, int n);
@@ -7,17 +7,7 @@ logger = logging.getLogger('banzai')
 
 
 def set_file_as_processed(path, db_address=dbs._DEFAULT_DB):
-    image = dbs.get_processed_image(path, db_address=db_address)
-    if image is not None:
-        image.success = True
-        dbs.commit_processed_image(image, db_address=db_address)
-
-
-def increment_try_number(path, db_address=dbs._DEFAULT_DB):
-    image = dbs.get_processed_image(path, db_address=db_address)
-    # Otherwise increment the number of tries
-    image.tries += 1
-    dbs.commit_processed_image(image, db_address=db_address)
+    dbs.mark_processed_image_as_successful(path, db_address=db_address)
 
 
 def need_to_process_image(path, context):
@@ -40,6 +30,7 @@ def need_to_process_image(path, context):
     -----
     If the file has changed on disk, we reset the success flags and the number of tries to zero.
     We only attempt to make images if the instrument is in the database and passes the given criteria.
+    When this returns True the frame has been claimed and the attempt is already counted in the number of tries.
     """
     logger.info("Checking if file needs to be processed", extra_tags={"filename": path})
 
@@ -59,23 +50,6 @@ def need_to_process_image(path, context):
         logger.info('Image will not be processed because instrument is not schedulable', extra_tags={"filename": path})
         return False
 
-    # Get the image in db. If it doesn't exist add it.
-    image = dbs.get_processed_image(path, db_address=context.db_address)
-    need_to_process = False
-    # Check the md5.
+    # Check the md5 and claim the frame in a single transaction
     checksum = file_utils.get_md5(path)
-
-    # Reset the number of tries if the file has changed on disk
-    if image.checksum != checksum:
-        need_to_process = True
-        image.checksum = checksum
-        image.tries = 0
-        image.success = False
-        dbs.commit_processed_image(image, context.db_address)
-
-    # Check if we need to try again
-    elif image.tries < context.max_tries and not image.success:
-        need_to_process = True
-        dbs.commit_processed_image(image, context.db_address)
-
-    return need_to_process
+    return dbs.claim_processed_image(path, checksum, context.max_tries, db_address=context.db_address)
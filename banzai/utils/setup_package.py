@@ -65,12 +65,13 @@ def get_extensions():
 
     libraries = []
 
+    # No -ffast-math: median_utils reproduces numpy's summation order so its results are bit-for-bit identical
     ext_med = Extension(name=str('banzai.utils.median_utils'),
                         sources=med_sources,
                         include_dirs=include_dirs,
                         libraries=libraries,
                         language="c",
-                        extra_compile_args=['-g', '-O3', '-funroll-loops', '-ffast-math'])
+                        extra_compile_args=['-g', '-O3', '-funroll-loops'])
 
     has_openmp, outputs = check_openmp()
     if has_openmp:
@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+import logging
+
+import numpy as np
+
+logger = logging.getLogger('banzai')
+
+
+class SharedArrayStore:
+    """
+    Node-local store of read-only arrays shared between processes
+
+    Parameters
+    ----------
+    directory: str
+               Directory to keep the arrays in. This should be on a memory backed file system
+               like /dev/shm so the arrays never touch the disk.
+    max_bytes: int
+               Total size of the stored arrays above which the least recently used entries are removed
+
+    Notes
+    -----
+    Each entry is a directory of .npy files that every process memory maps read-only, so the
+    operating system keeps a single copy of the data in memory no matter how many workers use it.
+    Entries are written to a temporary directory and renamed into place, so a process never sees a
+    partially written entry. Evicting an entry only unlinks the files: the kernel reference counts
+    the mappings and frees the memory once the last process that mapped the arrays releases them.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def get(self, name, loader):
+        """
+        Get the arrays stored under a name, loading and storing them if they are not present yet
+
+        Parameters
+        ----------
+        name: str
+              Name of the entry. Must be a valid file name.
+        loader: callable
+                Function that returns a dictionary of numpy arrays (or None) to store
+
+        Returns
+        -------
+        arrays: dict
+                Read-only memory mapped arrays with the keys returned by the loader. If another process evicts
+                the entry before it can be mapped, the arrays returned by the loader are used directly.
+        """
+        entry_directory = os.path.join(self.directory, name)
+        try:
+            arrays = self._load(entry_directory)
+        except FileNotFoundError:
+            # Also reached when another process evicts the entry while we map it
+            loaded_arrays = loader()
+            self._store(entry_directory, loaded_arrays)
+            self.evict(keep=name)
+            try:
+                arrays = self._load(entry_directory)
+            except FileNotFoundError:
+                # Another process evicted the entry before we could map it, so use our own copy
+                return loaded_arrays
+        try:
+            # Mark the entry as recently used
+            os.utime(entry_directory)
+        except FileNotFoundError:
+            pass
+        return arrays
+
+    def _store(self, entry_directory, arrays):
+        os.makedirs(self.directory, exist_ok=True)
+        temp_directory = tempfile.mkdtemp(dir=self.directory, prefix='.tmp')
+        try:
+            for key, array in arrays.items():
+                if array is not None:
+                    # Store in native byte order so readers never have to convert the data
+                    native_array = array.astype(array.dtype.newbyteorder('='), copy=False)
+                    np.save(os.path.join(temp_directory, key + '.npy'), np.ascontiguousarray(native_array))
+                else:
+                    open(os.path.join(temp_directory, key + '.none'), 'w').close()
+            try:
+                os.rename(temp_directory, entry_directory)
+            except OSError:
+                # Another process stored the same entry first
+                if not os.path.isdir(entry_directory):
+                    raise
+        finally:
+            if os.path.exists(temp_directory):
+                shutil.rmtree(temp_directory, ignore_errors=True)
+
+    @staticmethod
+    def _load(entry_directory):
+        arrays = {}
+        for filename in os.listdir(entry_directory):
+            key, extension = os.path.splitext(filename)
+            if extension == '.npy':
+                arrays[key] = np.load(os.path.join(entry_directory, filename), mmap_mode='r')
+            elif extension == '.none':
+                arrays[key] = None
+        return arrays
+
+    def entries(self):
+        """
+        List the stored entries
+
+        Returns
+        -------
+        entries: list of (name, size, last_used)
+                 Entries sorted from least to most recently used
+        """
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for name in os.listdir(self.directory):
+            entry_directory = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(entry_directory):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_directory, filename))
+                           for filename in os.listdir(entry_directory))
+                last_used = os.path.getmtime(entry_directory)
+            except OSError:
+                # Another process evicted the entry
+                continue
+            entries.append((name, size, last_used))
+        entries.sort(key=lambda entry: entry[2])
+        return entries
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the store is within its size budget
+
+        Parameters
+        ----------
+        keep: str
+              Name of an entry that should not be removed
+        """
+        entries = self.entries()
+        total_size = sum(entry[1] for entry in entries)
+        for name, size, last_used in entries:
+            if name == keep:
+                continue
+            if total_size <= self.max_bytes:
+                break
+            logger.debug('Evicting arrays from shared memory', extra_tags={'shared_array': name})
+            # Rename first so other processes never see a partially removed entry
+            evicted_directory = tempfile.mkdtemp(dir=self.directory, prefix='.evicted')
+            try:
+                os.rename(os.path.join(self.directory, name), os.path.join(evicted_directory, name))
+            except OSError:
+                # Another process already evicted the entry
+                pass
+            shutil.rmtree(evicted_directory, ignore_errors=True)
+            total_size -= size
@@ -1,6 +1,12 @@
-from banzai import settings
-from banzai.utils import import_utils, image_utils
+from banzai import settings, calibrations, logs
+from banzai.exceptions import PipelineConfigurationException
+from banzai.stages import Stage, BandStreamer
+from banzai.utils import import_utils, image_utils, instrumentation_utils
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import logging
+import threading
+import time
 
 logger = logging.getLogger('banzai')
 
@@ -28,6 +34,24 @@ def get_stages_todo(ordered_stages, last_stage=None, extra_stages=None):
     -----
     Extra stages can be other stages that are not in the ordered_stages list.
     """
+    stage_names = get_stage_names(ordered_stages, last_stage, extra_stages)
+    return [import_utils.import_attribute(stage) for stage in stage_names]
+
+
+def get_stage_names(ordered_stages, last_stage=None, extra_stages=None):
+    """
+    Names of the stages to run, see get_stages_todo
+
+    Returns
+    -------
+    stage_names: list of str
+                 Dotted paths of the stages that need to be done
+
+    Raises
+    ------
+    ValueError
+        If last_stage is not in ordered_stages
+    """
     if extra_stages is None:
         extra_stages = []
 
@@ -36,29 +60,352 @@ def get_stages_todo(ordered_stages, last_stage=None, extra_stages=None):
     else:
         last_index = ordered_stages.index(last_stage) + 1
 
-    stages_todo = [import_utils.import_attribute(stage) for stage in ordered_stages[:last_index]]
+    stage_names = list(ordered_stages[:last_index])
+    if settings.FUSE_CALIBRATION_STAGES:
+        stage_names = fuse_calibration_stages(stage_names)
 
-    stages_todo += [import_utils.import_attribute(stage) for stage in extra_stages]
+    return stage_names + list(extra_stages)
 
-    return stages_todo
+
+def fuse_calibration_stages(stage_names):
+    """
+    Replace the stages in settings.FUSED_CALIBRATION_STAGES with settings.FUSED_CALIBRATION_STAGE
+
+    Parameters
+    ----------
+    stage_names: list of str
+                 Names of the stages to run
+
+    Returns
+    -------
+    stage_names: list of str
+                 The same stages with the fused stage in place of the first one it replaces. Returned unchanged
+                 unless all of the replaced stages are in the list, e.g. not for darks that have no flat applied.
+    """
+    if not all(stage in stage_names for stage in settings.FUSED_CALIBRATION_STAGES):
+        return stage_names
+    fused_index = min(stage_names.index(stage) for stage in settings.FUSED_CALIBRATION_STAGES)
+    fused_stage_names = [stage for stage in stage_names if stage not in settings.FUSED_CALIBRATION_STAGES]
+    fused_stage_names.insert(fused_index, settings.FUSED_CALIBRATION_STAGE)
+    return fused_stage_names
+
+
+class PipelinePlan:
+    """
+    The chain of stages that reduces frames of one observation type, imported and instantiated once
+
+    Parameters
+    ----------
+    obstype: str
+             Observation type, a key of settings.LAST_STAGE and settings.EXTRA_STAGES
+    runtime_context: banzai.context.Context
+                     Context the stages are created with
+
+    Raises
+    ------
+    PipelineConfigurationException
+        If the stage list for obstype is misconfigured. Every problem found is listed in the message.
+    """
+    def __init__(self, obstype, runtime_context):
+        self.obstype = obstype
+        self.runtime_context = runtime_context
+        self.stage_names = _plan_stage_names(obstype)
+        self.stages = [stage(runtime_context) for stage in resolve_stages(self.stage_names, obstype)]
+        if settings.BAND_STREAMING:
+            self.stages = stream_band_stages(self.stages, runtime_context, settings.BAND_STREAMING_BAND_SIZE)
+
+    def is_compiled_for(self, runtime_context):
+        """
+        Whether the stages of this plan were created with an equivalent runtime context
+        """
+        return runtime_context is self.runtime_context or vars(runtime_context) == vars(self.runtime_context)
+
+    def run(self, image):
+        for stage in self.stages:
+            image = stage.run(image)
+        return image
+
+
+def stream_band_stages(stages, runtime_context, band_size):
+    """
+    Replace each run of consecutive band streamable stages with a BandStreamer
+
+    Parameters
+    ----------
+    stages: list of banzai.stages.Stage
+    runtime_context: banzai.context.Context
+    band_size: int
+               Approximate number of pixels in each band
+
+    Returns
+    -------
+    stages: list of banzai.stages.Stage
+            The same stages where every run of two or more band streamable stages is a single BandStreamer.
+            Other stages (e.g. the source detection) are still run on the whole frame. A stage that only
+            rejects images once it has seen every band (e.g. the saturation test) ends a run, so the stages
+            after it are never run on an image it rejects.
+    """
+    streamed_stages, band_stages = [], []
+
+    def end_band_stages():
+        if len(band_stages) > 1:
+            streamed_stages.append(BandStreamer(runtime_context, list(band_stages), band_size))
+        else:
+            streamed_stages.extend(band_stages)
+        del band_stages[:]
+
+    for stage in stages:
+        if stage.band_streamable:
+            band_stages.append(stage)
+            if stage.rejects_after_bands:
+                end_band_stages()
+        else:
+            end_band_stages()
+            streamed_stages.append(stage)
+    end_band_stages()
+    return streamed_stages
+
+
+def _plan_stage_names(obstype):
+    last_stage = settings.LAST_STAGE[obstype]
+    if last_stage is not None and last_stage not in settings.ORDERED_STAGES:
+        raise PipelineConfigurationException('Last stage {stage} for {obstype} frames is not in '
+                                             'ORDERED_STAGES'.format(stage=last_stage, obstype=obstype))
+    return get_stage_names(settings.ORDERED_STAGES, last_stage=last_stage,
+                           extra_stages=settings.EXTRA_STAGES.get(obstype))
+
+
+def resolve_stages(stage_names, obstype=None):
+    """
+    Import the stages and check that each one is a single frame stage
+
+    Parameters
+    ----------
+    stage_names: list of str
+                 Dotted paths of the stages
+    obstype: str
+             Observation type the stages are for, only used in the error message
+
+    Returns
+    -------
+    stages: list of banzai.stages.Stage subclasses
+
+    Raises
+    ------
+    PipelineConfigurationException
+        If any stage cannot be imported or is not a banzai.stages.Stage
+    """
+    stages, problems = [], []
+    for stage_name in stage_names:
+        try:
+            stage = import_utils.import_attribute(stage_name)
+        except (ImportError, AttributeError, ValueError) as exception:
+            problems.append('{stage} cannot be imported: {error}'.format(stage=stage_name, error=exception))
+            continue
+        if not (isinstance(stage, type) and issubclass(stage, Stage)):
+            problems.append('{stage} is not a banzai.stages.Stage'.format(stage=stage_name))
+            continue
+        stages.append(stage)
+    if problems:
+        raise PipelineConfigurationException('Misconfigured stages for {obstype} frames: {problems}'.format(
+            obstype=obstype, problems='; '.join(problems)))
+    return stages
+
+
+_PIPELINE_PLANS = {}
+_PIPELINE_PLANS_LOCK = threading.Lock()
+
+
+def get_pipeline_plan(obstype, runtime_context):
+    """
+    Pipeline plan for an observation type, compiled the first time it is needed and reused afterwards
+
+    Notes
+    -----
+    Plans are cached per process by the observation type, the stage names and whether stages are streamed in
+    bands (which depend on the settings) and are recompiled if the runtime context changes, e.g. a celery task was
+    sent with different arguments.
+    """
+    stage_names = _plan_stage_names(obstype)
+    key = (obstype, tuple(stage_names), settings.BAND_STREAMING, settings.BAND_STREAMING_BAND_SIZE)
+    plan = _PIPELINE_PLANS.get(key)
+    if plan is None or not plan.is_compiled_for(runtime_context):
+        plan = PipelinePlan(obstype, runtime_context)
+        with _PIPELINE_PLANS_LOCK:
+            _PIPELINE_PLANS[key] = plan
+    return plan
+
+
+def validate_stage_settings(obstypes=None):
+    """
+    Check that the stage lists of every observation type can be resolved without creating any stages
+
+    Parameters
+    ----------
+    obstypes: list of str
+              Observation types to check. Defaults to all of the keys of settings.LAST_STAGE.
+
+    Raises
+    ------
+    PipelineConfigurationException
+        If the stage list of any observation type is misconfigured. The problems of all of them are reported.
+    """
+    _for_each_obstype(lambda obstype: resolve_stages(_plan_stage_names(obstype), obstype), obstypes)
+
+
+def _for_each_obstype(function, obstypes=None):
+    if obstypes is None:
+        obstypes = list(settings.LAST_STAGE.keys())
+    results, problems = {}, []
+    for obstype in obstypes:
+        try:
+            results[obstype] = function(obstype)
+        except PipelineConfigurationException as exception:
+            problems.append(str(exception))
+    if problems:
+        raise PipelineConfigurationException('\n'.join(problems))
+    return results
+
+
+def compile_pipeline_plans(runtime_context, obstypes=None):
+    """
+    Compile and cache the pipeline plans so that misconfigured stage lists fail at startup
+
+    Parameters
+    ----------
+    runtime_context: banzai.context.Context
+    obstypes: list of str
+              Observation types to compile plans for. Defaults to all of the keys of settings.LAST_STAGE.
+
+    Returns
+    -------
+    plans: dict
+           banzai.utils.stage_utils.PipelinePlan keyed by observation type
+
+    Raises
+    ------
+    PipelineConfigurationException
+        If the stage list of any observation type is misconfigured. The problems of all of them are reported.
+    """
+    return _for_each_obstype(lambda obstype: get_pipeline_plan(obstype, runtime_context), obstypes)
+
+
+def clear_pipeline_plans():
+    with _PIPELINE_PLANS_LOCK:
+        _PIPELINE_PLANS.clear()
 
 
 def run(image_path, runtime_context):
     """
     Main driver script for banzai.
+
+    Returns
+    -------
+    image: banzai.images.Image
+           The reduced image, or None if the frame could not be reduced
     """
     image = image_utils.read_image(image_path, runtime_context)
     if image is None:
         return
-    stages_to_do = get_stages_todo(settings.ORDERED_STAGES,
-                                   last_stage=settings.LAST_STAGE[image.obstype],
-                                   extra_stages=settings.EXTRA_STAGES[image.obstype])
+    pipeline_plan = get_pipeline_plan(image.obstype, runtime_context)
     logger.info("Starting to reduce frame", image=image)
-    for stage in stages_to_do:
-        stage_to_run = stage(runtime_context)
-        image = stage_to_run.run(image)
+    image = pipeline_plan.run(image)
     if image is None:
         logger.error('Reduction stopped', extra_tags={'filename': image_path})
         return
+    instrumentation_utils.summarize_frame(image, runtime_context)
     image.write(runtime_context)
+    if image.obstype in settings.CALIBRATION_IMAGE_TYPES:
+        calibrations.accumulate_calibration_frame(image, runtime_context)
     logger.info("Finished reducing frame", image=image)
+    return image
+
+
+def reduce_frames(frames, runtime_context, n_processes=1):
+    """
+    Reduce frames in a pool of processes, one calibration type at a time before the science frames
+
+    Parameters
+    ----------
+    frames: list of tuples
+            (filename, obstype) of each frame, e.g. from image_utils.select_frames_to_reduce
+    runtime_context: banzai.context.Context
+    n_processes: int
+                 Number of worker processes. The frames are reduced in this process if this is 1.
+
+    Returns
+    -------
+    summary: dict
+             Number of frames reduced and failed, wall time, throughput in frames per second and the failed
+             filenames
+
+    Notes
+    -----
+    All of the frames of one calibration type (in the order of settings.CALIBRATION_IMAGE_TYPES) are finished
+    before any frame of the next type is started, and all calibrations are finished before the science frames.
+    A failure only affects its own frame, unless a worker process dies, in which case the frames that had not
+    finished in that phase are counted as failed.
+    """
+    start_time = time.perf_counter()
+    phases = defaultdict(list)
+    for filename, obstype in frames:
+        phases[image_utils.get_reduction_phase(obstype, settings.CALIBRATION_IMAGE_TYPES)].append(filename)
+
+    results = []
+    for phase in sorted(phases):
+        filenames = phases[phase]
+        logger.info('Reducing frames', extra_tags={'n_frames': len(filenames), 'n_processes': n_processes,
+                                                   'obstype': _phase_name(phase)})
+        if n_processes > 1 and len(filenames) > 1:
+            results += _reduce_in_process_pool(filenames, runtime_context, n_processes)
+        else:
+            results += [_reduce_frame(filename, runtime_context) for filename in filenames]
+
+    wall_time = time.perf_counter() - start_time
+    failed = [filename for filename, succeeded, _ in results if not succeeded]
+    frame_times = [frame_time for _, _, frame_time in results if frame_time is not None]
+    summary = {'n_frames': len(results), 'n_reduced': len(results) - len(failed), 'n_failed': len(failed),
+               'wall_time': wall_time, 'frames_per_second': len(results) / wall_time if wall_time > 0 else 0.0,
+               'mean_frame_time': sum(frame_times) / len(frame_times) if frame_times else 0.0,
+               'n_processes': n_processes}
+    logger.info('Finished reducing frames', extra_tags=summary)
+    summary['failed'] = failed
+    return summary
+
+
+def _phase_name(phase):
+    if phase < len(settings.CALIBRATION_IMAGE_TYPES):
+        return settings.CALIBRATION_IMAGE_TYPES[phase]
+    return 'SCIENCE'
+
+
+def _reduce_in_process_pool(filenames, runtime_context, n_processes):
+    results = []
+    with ProcessPoolExecutor(max_workers=min(n_processes, len(filenames))) as executor:
+        futures = {executor.submit(_reduce_frame, filename, runtime_context): filename for filename in filenames}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception:
+                logger.error('Worker process failed: {error}'.format(error=logs.format_exception()),
+                             extra_tags={'filename': futures[future]})
+                results.append((futures[future], False, None))
+    return results
+
+
+def _reduce_frame(filename, runtime_context):
+    """
+    Reduce a single frame, catching any error so it does not affect the other frames
+
+    Returns
+    -------
+    result: tuple
+            (filename, whether the frame was reduced, wall time in seconds)
+    """
+    start_time = time.perf_counter()
+    try:
+        succeeded = run(filename, runtime_context) is not None
+    except Exception:
+        logger.error(logs.format_exception(), extra_tags={'filename': filename})
+        succeeded = False
+    return filename, succeeded, time.perf_counter() - start_time
@@ -5,6 +5,16 @@ from banzai.utils import median_utils
 
 __author__ = 'cmccully'
 
+# Arrays with fewer elements than this are not worth histogramming, even if they are integer valued
+INTEGER_HISTOGRAM_MIN_SIZE = 65536
+
+# Number of elements the subsampled estimators start with
+SUBSAMPLE_INITIAL_SIZE = 10000
+
+# Standard error of the robust standard deviation of normally distributed data in units of sigma / sqrt(n)
+# (the median absolute deviation has an asymptotic efficiency of 37% relative to the standard deviation)
+ROBUST_STANDARD_DEVIATION_ERROR_FACTOR = 1.1664
+
 
 def median(d, axis=None, mask=None):
     """
@@ -31,9 +41,14 @@ def median(d, axis=None, mask=None):
     -----
     Makes extensive use of the quick select algorithm written in C, included in quick_select.c.
     If all of the elements in the array are masked (or all of the elements of the axis of interest
-    are masked), we return zero.
+    are masked), we return zero. If axis is None and the data are integers between 0 and 65535
+    (e.g. raw frames), the median is read off a histogram of the data instead, which gives exactly
+    the same value.
     """
     if axis is None:
+        histogram = integer_histogram(d, mask=mask)
+        if histogram is not None:
+            return histogram_median(histogram)
         if mask is not None:
             median_mask = mask.ravel()
         else:
@@ -93,7 +108,159 @@ def absolute_deviation(a, axis=None, mask=None):
     return np.abs(a - a_median)
 
 
+def integer_histogram(d, mask=None):
+    """
+    Histogram an array if all of its unmasked values are integers between 0 and 65535
+
+    Parameters
+    ----------
+    d : float32 numpy array
+        Input array
+    mask : unit8 or boolean numpy array (default is None)
+           Numpy array of bitmask values. Non-zero values are not counted.
+
+    Returns
+    -------
+    histogram : int64 numpy array or None
+        The number of unmasked elements equal to each integer from 0 to 65535. None if the array is not
+        float32, is smaller than INTEGER_HISTOGRAM_MIN_SIZE or has unmasked values that are not integers
+        in that range.
+
+    Notes
+    -----
+    Raw 16 bit data is converted to float32 when it is read, but it is still integer valued until the
+    bias is subtracted. The exact median, median absolute deviation and sigma clipped mean of such data
+    can be found from its histogram, which is built in a single parallel pass without copying the data.
+    """
+    if d.dtype != np.float32 or d.size < INTEGER_HISTOGRAM_MIN_SIZE:
+        return None
+    if d.ndim == 2:
+        data = d
+    elif d.ndim == 1:
+        data = d.reshape(1, -1)
+    else:
+        data = d.reshape(-1, d.shape[-1])
+    if mask is not None:
+        if mask.dtype == np.bool_:
+            mask = mask.view(np.uint8)
+        elif mask.dtype != np.uint8:
+            mask = (mask != 0).view(np.uint8)
+        mask = mask.reshape(data.shape)
+    return median_utils.integer_histogram(data, mask)
+
+
+def histogram_median(histogram, values=None):
+    """
+    Find the median of data from its histogram
+
+    Parameters
+    ----------
+    histogram : int numpy array
+                Number of elements in each bin
+    values : float32 numpy array (default is None)
+             Value of the elements in each bin, in increasing order. Defaults to the bin index.
+
+    Returns
+    -------
+    med : float
+        The median value. The mean of the two middle elements is taken in float32, like median does.
+        Zero if the histogram is empty.
+    """
+    if values is None:
+        values = np.arange(len(histogram), dtype=np.float32)
+    cumulative_counts = np.cumsum(histogram)
+    n_elements = cumulative_counts[-1]
+    if n_elements == 0:
+        return 0.0
+    lower_index = (n_elements - 1) // 2
+    lower = values[np.searchsorted(cumulative_counts, lower_index, side='right')]
+    if n_elements % 2 == 1:
+        return float(lower)
+    upper = values[np.searchsorted(cumulative_counts, lower_index + 1, side='right')]
+    return float((lower + upper) / np.float32(2.0))
+
+
+def _histogram_absolute_deviations(histogram, data_median):
+    # Histogram of the absolute deviations of integer valued data from its median, which is either an integer or
+    # halfway between two integers. The deviations are exactly representable so match np.abs(a - a_median).
+    n_bins = len(histogram)
+    lower_middle = int(np.floor(data_median))
+    deviation_histogram = np.zeros(n_bins, dtype=np.int64)
+    if data_median == lower_middle:
+        # Values median + i and median - i both have a deviation of i
+        deviation_histogram[:n_bins - lower_middle] += histogram[lower_middle:]
+        if lower_middle > 0:
+            deviation_histogram[1:lower_middle + 1] += histogram[lower_middle - 1::-1]
+        deviations = np.arange(n_bins, dtype=np.float32)
+    else:
+        # Values lower_middle + 1 + i and lower_middle - i both have a deviation of i + 0.5
+        deviation_histogram[:n_bins - lower_middle - 1] += histogram[lower_middle + 1:]
+        deviation_histogram[:lower_middle + 1] += histogram[lower_middle::-1]
+        deviations = np.arange(n_bins, dtype=np.float32) + np.float32(0.5)
+    return deviation_histogram, deviations
+
+
+def histogram_median_absolute_deviation(histogram, data_median=None):
+    """
+    Find the median absolute deviation of integer valued data from its histogram
+
+    Parameters
+    ----------
+    histogram : int numpy array
+                Number of elements equal to each bin index, e.g. from integer_histogram
+    data_median : float (default is None)
+                  Median of the data if it is already known
+
+    Returns
+    -------
+    mad : float
+        The median absolute deviation from the median. Exactly the same as median_absolute_deviation.
+    """
+    if data_median is None:
+        data_median = histogram_median(histogram)
+    return histogram_median(*_histogram_absolute_deviations(histogram, data_median))
+
+
+def histogram_sigma_clipped_mean(histogram, sigma, fill_value=0.0):
+    """
+    Find the sigma clipped mean of integer valued data from its histogram
+
+    Parameters
+    ----------
+    histogram : int numpy array
+                Number of elements equal to each bin index, e.g. from integer_histogram
+    sigma : float
+            Values further than sigma * 1.4826 * the median absolute deviation from the median are clipped
+    fill_value : float
+                 Value to return if every element is clipped
+
+    Returns
+    -------
+    mean_value : float
+        The sigma clipped mean
+
+    Notes
+    -----
+    The same elements are clipped as in sigma_clipped_mean, but the sum of the remaining elements is done in
+    exact integer arithmetic, so the mean can differ from the floating point sum in the last few bits.
+    """
+    data_median = histogram_median(histogram)
+    mad = histogram_median_absolute_deviation(histogram, data_median=data_median)
+    # Round the threshold to float32 like the comparison with the float32 deviations does in sigma_clipped_mean
+    threshold = np.float32(sigma * (1.4826 * mad))
+    values = np.arange(len(histogram), dtype=np.float32)
+    good_bins = np.logical_not(np.abs(values - np.float32(data_median)) > threshold)
+    n_good_pixels = histogram[good_bins].sum()
+    if n_good_pixels == 0:
+        return fill_value
+    return float(np.dot(histogram[good_bins], np.arange(len(histogram), dtype=np.int64)[good_bins])) / n_good_pixels
+
+
 def median_absolute_deviation(a, axis=None, abs_deviation=None, mask=None):
+    if axis is None and abs_deviation is None:
+        histogram = integer_histogram(a, mask=mask)
+        if histogram is not None:
+            return histogram_median_absolute_deviation(histogram)
     if abs_deviation is None:
         abs_deviation = absolute_deviation(a, axis=axis, mask=mask)
 
@@ -106,7 +273,62 @@ def robust_standard_deviation(a, axis=None, abs_deviation=None, mask=None):
 
 def sigma_clipped_mean(a, sigma, axis=None, mask=None, fill_value=0.0, inplace=False):
     """
+    Find the mean of a numpy array ignoring values that are more than sigma robust standard deviations
+    from the median. If an axis is provided, then the mean is taken along the given axis.
+
+    Parameters
+    ----------
+    a : float32 numpy array
+        Input array
+    sigma : float
+            Values further than sigma * 1.4826 * the median absolute deviation from the median are clipped
+    axis : int (default is None)
+           Index of the array to take the mean along
+    mask : unit8 or boolean numpy array (default is None)
+           Numpy array of bitmask values. Non-zero values are ignored.
+    fill_value : float
+                 Value to use where every element is masked or clipped
+    inplace : bool
+              Allow the input array to be overwritten to save memory
+
+    Returns
+    -------
+    mean_values : float32 numpy array
+        The sigma clipped mean. If axis is None, then we return a single float.
+
+    Notes
+    -----
+    When taking the mean along the last axis of a C-contiguous float32 array, the median, MAD, clipping
+    and mean are computed in one pass by median_utils.sigma_clipped_mean2d. This avoids all of the full
+    size temporary arrays and gives exactly the same results as the numpy implementation. When axis is None
+    and the data are integers between 0 and 65535 (e.g. raw frames), everything is computed from a histogram
+    of the data by histogram_sigma_clipped_mean.
     """
+    if axis is None:
+        histogram = integer_histogram(a, mask=mask)
+        if histogram is not None:
+            return histogram_sigma_clipped_mean(histogram, sigma, fill_value=fill_value)
+    if _can_use_fused_sigma_clipped_mean(a, axis, mask):
+        nx = a.shape[-1]
+        ny = a.size // nx
+        if mask is None:
+            mask = np.zeros((ny, nx), dtype=np.uint8)
+        mean_values = median_utils.sigma_clipped_mean2d(a.reshape(ny, nx),
+                                                        np.ascontiguousarray(mask).view(np.uint8).reshape(ny, nx),
+                                                        sigma, fill_value)
+        return np.asarray(mean_values).reshape(a.shape[:-1])
+    return _sigma_clipped_mean_numpy(a, sigma, axis=axis, mask=mask, fill_value=fill_value, inplace=inplace)
+
+
+def _can_use_fused_sigma_clipped_mean(a, axis, mask):
+    if axis is None or a.ndim < 2 or a.size == 0 or axis % a.ndim != a.ndim - 1:
+        return False
+    if a.dtype != np.float32 or not a.flags.c_contiguous:
+        return False
+    return mask is None or mask.dtype in [np.uint8, np.bool_]
+
+
+def _sigma_clipped_mean_numpy(a, sigma, axis=None, mask=None, fill_value=0.0, inplace=False):
     abs_deviation = absolute_deviation(a, axis=axis, mask=mask)
 
     robust_std = robust_standard_deviation(a, axis=axis, abs_deviation=abs_deviation, mask=mask)
@@ -140,3 +362,143 @@ def sigma_clipped_mean(a, sigma, axis=None, mask=None, fill_value=0.0, inplace=F
         mean_values[n_good_pixels == 0] = fill_value
 
     return mean_values
+
+
+def subsample(a, n_samples, mask=None, method='strided', seed=0):
+    """
+    Draw at least n_samples elements from an array without copying the whole array
+
+    Parameters
+    ----------
+    a : numpy array
+        Input array
+    n_samples : int
+                Number of elements to draw. The whole array is returned if it is not larger than this.
+    mask : numpy array (default is None)
+           Mask to subsample in the same way as the data
+    method : str
+             'strided' takes a regular grid of elements, every step-th element along each of the last two axes.
+             'random' draws elements without replacement, seeded with seed so the results are reproducible.
+    seed : int
+           Seed of the random number generator for the 'random' method
+
+    Returns
+    -------
+    samples, sample_mask : 1d numpy arrays
+        The drawn elements and their mask values. sample_mask is None if mask is None.
+    """
+    if n_samples >= a.size:
+        index = Ellipsis
+    elif method == 'strided':
+        if a.ndim == 1:
+            index = slice(None, None, a.size // n_samples)
+        else:
+            step = max(1, int(np.sqrt(a.size / n_samples)))
+            index = (Ellipsis, slice(None, None, step), slice(None, None, step))
+    elif method == 'random':
+        random_indices = np.random.default_rng(seed).choice(a.size, n_samples, replace=False)
+        index = np.unravel_index(np.sort(random_indices), a.shape)
+    else:
+        raise ValueError('Unknown subsampling method: {method}'.format(method=method))
+    samples = np.ravel(a[index])
+    sample_mask = None if mask is None else np.ravel(mask[index])
+    return samples, sample_mask
+
+
+def _subsampled_estimate(a, estimator, standard_error, mask, relative, method, initial_samples):
+    n_samples = initial_samples
+    while True:
+        samples, sample_mask = subsample(a, n_samples, mask=mask, method=method)
+        value, error = estimator(samples, sample_mask)
+        target_error = standard_error * abs(value) if relative else standard_error
+        if error <= target_error or n_samples >= a.size:
+            return value, error
+        # The error falls as the square root of the number of samples. Overshoot a little so we rarely need a
+        # third round, and at least double the sample so we never take lots of small steps.
+        n_samples = min(a.size, int(n_samples * max(2.0, 1.2 * (error / target_error) ** 2)))
+
+
+def _count_unmasked(samples, sample_mask):
+    if sample_mask is None:
+        return samples.size
+    return samples.size - np.count_nonzero(sample_mask)
+
+
+def subsampled_sigma_clipped_mean(a, sigma, standard_error, mask=None, fill_value=0.0, relative=False,
+                                  method='strided', initial_samples=SUBSAMPLE_INITIAL_SIZE):
+    """
+    Estimate the sigma clipped mean of an array from a subsample of its elements
+
+    Parameters
+    ----------
+    a : float32 numpy array
+        Input array
+    sigma : float
+            Values further than sigma * 1.4826 * the median absolute deviation from the median are clipped
+    standard_error : float
+                     Standard error to reach. The sample is enlarged until the estimate is at least this precise.
+    mask : unit8 or boolean numpy array (default is None)
+           Numpy array of bitmask values. Non-zero values are ignored.
+    fill_value : float
+                 Value to use if every sampled element is masked or clipped
+    relative : bool
+               Interpret standard_error as a fraction of the mean rather than in the units of the data
+    method : str
+             How to draw the samples, 'strided' or 'random'. See subsample.
+    initial_samples : int
+                      Number of elements in the first sample
+
+    Returns
+    -------
+    mean_value, error : float, float
+        The sigma clipped mean of the sample and its standard error
+
+    Notes
+    -----
+    The standard error is estimated as the robust standard deviation of the sample divided by the square
+    root of the number of unmasked elements in it. If the whole array is needed to reach the requested
+    precision the result is the same as sigma_clipped_mean.
+    """
+    def estimator(samples, sample_mask):
+        mean_value = sigma_clipped_mean(samples, sigma, mask=sample_mask, fill_value=fill_value)
+        n_unmasked = max(_count_unmasked(samples, sample_mask), 1)
+        error = robust_standard_deviation(samples, mask=sample_mask) / np.sqrt(n_unmasked)
+        return mean_value, error
+    return _subsampled_estimate(a, estimator, standard_error, mask, relative, method, initial_samples)
+
+
+def subsampled_robust_standard_deviation(a, standard_error, mask=None, relative=False, method='strided',
+                                         initial_samples=SUBSAMPLE_INITIAL_SIZE):
+    """
+    Estimate the robust standard deviation of an array from a subsample of its elements
+
+    Parameters
+    ----------
+    a : float32 numpy array
+        Input array
+    standard_error : float
+                     Standard error to reach. The sample is enlarged until the estimate is at least this precise.
+    mask : unit8 or boolean numpy array (default is None)
+           Numpy array of bitmask values. Non-zero values are ignored.
+    relative : bool
+               Interpret standard_error as a fraction of the standard deviation rather than in the units of the data
+    method : str
+             How to draw the samples, 'strided' or 'random'. See subsample.
+    initial_samples : int
+                      Number of elements in the first sample
+
+    Returns
+    -------
+    robust_std, error : float, float
+        1.4826 times the median absolute deviation of the sample and its standard error
+
+    Notes
+    -----
+    The standard error is the asymptotic standard error for normally distributed data,
+    ROBUST_STANDARD_DEVIATION_ERROR_FACTOR * robust_std / sqrt(n).
+    """
+    def estimator(samples, sample_mask):
+        robust_std = robust_standard_deviation(samples, mask=sample_mask)
+        n_unmasked = max(_count_unmasked(samples, sample_mask), 1)
+        return robust_std, ROBUST_STANDARD_DEVIATION_ERROR_FACTOR * robust_std / np.sqrt(n_unmasked)
+    return _subsampled_estimate(a, estimator, standard_error, mask, relative, method, initial_samples)